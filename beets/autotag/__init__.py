@@ -17,6 +17,8 @@
 import os
 import logging
 import re
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from beets import library, mediafile, config
 from beets.util import sorted_walk, ancestry, displayable_path
@@ -33,33 +35,84 @@ log = logging.getLogger('beets')
 MULTIDISC_MARKERS = (r'dis[ck]', r'cd')
 MULTIDISC_PAT_FMT = r'^(.*%s[\W_]*)\d'
 
+# The number of files per worker thread that may be read ahead of the
+# directory being processed.
+READ_AHEAD = 8
+
 
 # Additional utilities for the main interface.
 
-def albums_in_dir(path):
-    """Recursively searches the given directory and returns an iterable
-    of (paths, items) where paths is a list of directories and items is
-    a list of Items that is probably an album. Specifically, any folder
-    containing any media files is an album.
+def _read_item(path):
+    """Read an Item from the media file at `path`. Returns None if the
+    file is not a media file or cannot be read.
+    """
+    try:
+        return library.Item.from_path(path)
+    except mediafile.FileTypeError:
+        pass
+    except mediafile.UnreadableFileError:
+        log.warn(u'unreadable file: {0}'.format(
+            displayable_path(os.path.basename(path)))
+        )
+
+def _read_items(entries):
+    """Given a list of file paths and Items (as generated by
+    `album_paths_in_dir`), get the list of Items, reading files that
+    have not been read yet and dropping those that are not media files.
+    """
+    items = []
+    for entry in entries:
+        if not isinstance(entry, library.Item):
+            entry = _read_item(entry)
+        if entry:
+            items.append(entry)
+    return items
+
+def _read_entry(entry):
+    """Get the Item for a file path or an already-read Item.
+    """
+    if isinstance(entry, library.Item):
+        return entry
+    return _read_item(entry)
+
+def _nested_multidisc(dirs, marker_pat):
+    """Determine whether the subdirectories `dirs` look like the discs
+    of a nested multi-disc album: the first one matches the marker
+    pattern and the rest share its prefix.
+    """
+    subdir_pat = None
+    for subdir in dirs:
+        # The first directory dictates the pattern for the remaining
+        # directories.
+        if not subdir_pat:
+            match = marker_pat.match(subdir)
+            if match:
+                subdir_pat = re.compile(r'^%s\d' %
+                    re.escape(match.group(1)), re.I)
+            else:
+                return False
+
+        # Subsequent directories must match the pattern.
+        elif not subdir_pat.match(subdir):
+            return False
+    return True
+
+def album_paths_in_dir(path, workers=None):
+    """Recursively searches the given directory for albums, like
+    `albums_in_dir`, but without reading the files. Generates (paths,
+    entries) pairs where paths is a list of directories and entries is
+    a list of the paths of the files in them (or Items for files that
+    had to be read to group the directories). The files may turn out
+    not to be media files; `read_albums` reads them.
     """
-    collapse_pat = collapse_paths = collapse_items = None
+    if workers is None:
+        workers = config['import']['read_workers'].get(int)
+    collapse_pat = collapse_paths = collapse_entries = None
 
     for root, dirs, files in sorted_walk(path,
                                          ignore=config['ignore'].as_str_seq(),
-                                         logger=log):
-        # Get a list of items in the directory.
-        items = []
-        for filename in files:
-            try:
-                i = library.Item.from_path(os.path.join(root, filename))
-            except mediafile.FileTypeError:
-                pass
-            except mediafile.UnreadableFileError:
-                log.warn(u'unreadable file: {0}'.format(
-                    displayable_path(filename))
-                )
-            else:
-                items.append(i)
+                                         logger=log, workers=workers):
+        entries = [os.path.join(root, filename) for filename in files]
 
         # If we're currently collapsing the constituent directories in a
         # multi-disc album, check whether we should continue collapsing
@@ -71,14 +124,14 @@ def albums_in_dir(path):
                      collapse_pat.match(os.path.basename(root))):
                 # Still collapsing.
                 collapse_paths.append(root)
-                collapse_items += items
+                collapse_entries += entries
                 continue
             else:
                 # Collapse finished. Yield the collapsed directory and
                 # proceed to process the current one.
-                if collapse_items:
-                    yield collapse_paths, collapse_items
-                collapse_pat = collapse_paths = collapse_items = None
+                if collapse_entries:
+                    yield collapse_paths, collapse_entries
+                collapse_pat = collapse_paths = collapse_entries = None
 
         # Check whether this directory looks like the *first* directory
         # in a multi-disc sequence. There are two indicators: the file
@@ -86,35 +139,24 @@ def albums_in_dir(path):
         # 1") or it contains no items but only directories that are
         # named in this way.
         start_collapsing = False
+        read = False
         for marker in MULTIDISC_MARKERS:
             marker_pat = re.compile(MULTIDISC_PAT_FMT % marker, re.I)
             match = marker_pat.match(os.path.basename(root))
+            nested = dirs and _nested_multidisc(dirs, marker_pat)
 
-            # Is this directory the root of a nested multi-disc album?
-            if dirs and not items:
-                # Check whether all subdirectories have the same prefix.
-                start_collapsing = True
-                subdir_pat = None
-                for subdir in dirs:
-                    # The first directory dictates the pattern for
-                    # the remaining directories.
-                    if not subdir_pat:
-                        match = marker_pat.match(subdir)
-                        if match:
-                            subdir_pat = re.compile(r'^%s\d' %
-                                re.escape(match.group(1)), re.I)
-                        else:
-                            start_collapsing = False
-                            break
-
-                    # Subsequent directories must match the pattern.
-                    elif not subdir_pat.match(subdir):
-                        start_collapsing = False
-                        break
+            # Whether the directory has items only matters when one of
+            # the heuristics applies, so only then are its files read.
+            if dirs and (nested or match) and not read:
+                entries = _read_items(entries)
+                read = True
 
+            # Is this directory the root of a nested multi-disc album?
+            if dirs and not entries:
                 # If all subdirectories match, don't check other
                 # markers.
-                if start_collapsing:
+                if nested:
+                    start_collapsing = True
                     break
 
             # Is this directory the first in a flattened multi-disc album?
@@ -132,16 +174,75 @@ def albums_in_dir(path):
         if start_collapsing:
             # Start collapsing; continue to the next iteration.
             collapse_paths = [root]
-            collapse_items = items
+            collapse_entries = entries
             continue
 
         # If it's nonempty, yield it.
-        if items:
-            yield [root], items
+        if entries:
+            yield [root], entries
 
     # Clear out any unfinished collapse.
-    if collapse_paths and collapse_items:
-        yield collapse_paths, collapse_items
+    if collapse_paths and collapse_entries:
+        yield collapse_paths, collapse_entries
+
+def read_albums(albums, workers=None):
+    """Read the items for (paths, entries) pairs generated by
+    `album_paths_in_dir`, generating (paths, items) pairs in the same
+    order and skipping albums without any media files. Files are read
+    by `workers` threads, which defaults to the ``import.read_workers``
+    option; with more than one, files from the following albums are
+    read ahead.
+    """
+    if workers is None:
+        workers = config['import']['read_workers'].get(int)
+
+    if workers <= 1:
+        for paths, entries in albums:
+            items = _read_items(entries)
+            if items:
+                yield paths, items
+        return
+
+    pool = ThreadPool(workers)
+    try:
+        # Albums whose files are being read, in order, and the number
+        # of files in them.
+        pending = deque()
+        pending_files = 0
+        for paths, entries in albums:
+            results = [pool.apply_async(_read_entry, (entry,))
+                       for entry in entries]
+            pending.append((paths, results))
+            pending_files += len(results)
+
+            # Wait for the oldest albums once enough files have been
+            # queued.
+            while pending and pending_files >= workers * READ_AHEAD:
+                paths, results = pending.popleft()
+                pending_files -= len(results)
+                items = [res.get() for res in results]
+                items = [i for i in items if i]
+                if items:
+                    yield paths, items
+
+        while pending:
+            paths, results = pending.popleft()
+            items = [res.get() for res in results]
+            items = [i for i in items if i]
+            if items:
+                yield paths, items
+    finally:
+        # Stop reading files when the generator is closed early.
+        pool.terminate()
+
+def albums_in_dir(path, workers=None):
+    """Recursively searches the given directory and returns an iterable
+    of (paths, items) where paths is a list of directories and items is
+    a list of Items that is probably an album. Specifically, any folder
+    containing any media files is an album. Files are read by `workers`
+    threads, which defaults to the ``import.read_workers`` option.
+    """
+    return read_albums(album_paths_in_dir(path, workers), workers)
 
 def apply_item_metadata(item, track_info):
     """Set an item's metadata from its matched TrackInfo object.
@@ -18,9 +18,17 @@ autotagging music files.
 from __future__ import print_function
 
 import os
+import sys
 import logging
+import functools
+import array
+import bisect
 import pickle
+import sqlite3
+import threading
+import time
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 from beets import autotag
 from beets import library
@@ -52,47 +60,209 @@ class ImportAbort(Exception):
 
 # Utilities.
 
-def _duplicate_check(lib, task):
-    """Check whether an album already exists in the library. Returns a
-    list of Album objects (empty if no duplicates are found).
+class _HashIndex(object):
+    """A compact map from hashable keys to lists of database ids. Only
+    the keys' hashes are kept, in sorted arrays, so a lookup may also
+    return the ids of other keys; callers must check them. Ids added
+    later are kept in a dictionary.
     """
-    assert task.choice_flag in (action.ASIS, action.APPLY)
-    artist, album = task.chosen_ident()
+    def __init__(self, pairs):
+        """Build the index from an iterable of (key, id) pairs.
+        """
+        entries = sorted((hash(key), id) for key, id in pairs)
+        self._hashes = array.array('l', [h for h, _ in entries])
+        self._ids = array.array('l', [id for _, id in entries])
+        self._added = defaultdict(list)
+
+    def add(self, key, id):
+        self._added[hash(key)].append(id)
 
-    if artist is None:
-        # As-is import with no artist. Skip check.
-        return []
+    def get(self, key):
+        """Get the ids that may belong to `key`.
+        """
+        h = hash(key)
+        ids = []
+        pos = bisect.bisect_left(self._hashes, h)
+        while pos < len(self._hashes) and self._hashes[pos] == h:
+            ids.append(self._ids[pos])
+            pos += 1
+        return ids + self._added.get(h, [])
+
+class DuplicateIndex(object):
+    """Finds the albums and items in the library that an import task
+    would duplicate. They are looked up in memory by the identity from
+    `ImportTask.chosen_ident`---(artist, album) for albums and (artist,
+    title) for items---and by the MusicBrainz album or track ID of an
+    applied match. Each index is built from one narrow query the first
+    time it is needed and then kept current with `add_album` and
+    `add_items`. Tasks passed to `reserve`, which are on their way to
+    the library, also count as duplicates of later tasks.
+
+    The lock is never held while the database is queried, so that it
+    does not matter whether new albums are added from inside a
+    transaction.
+    """
+    def __init__(self, lib):
+        self.lib = lib
+        self._lock = threading.Lock()
+        # The album (True) and item (False) indexes, once built.
+        self._indexes = {}
+        # The entries added while an index is being built.
+        self._added = {}
+        self._reserved = set()
+
+    @staticmethod
+    def _task_keys(task):
+        """Get the index keys for a task's chosen identity.
+        """
+        assert task.choice_flag in (action.ASIS, action.APPLY)
+        keys = [task.chosen_ident()]
+        if task.choice_flag is action.APPLY:
+            if task.is_album:
+                mbid = task.match.info.album_id
+            else:
+                mbid = task.match.info.track_id
+            if mbid:
+                keys.append(mbid)
+        return keys
 
-    found_albums = []
-    cur_paths = set(i.path for i in task.items if i)
-    for album_cand in lib.albums(library.MatchQuery('albumartist', artist)):
-        if album_cand.album == album:
+    def _index(self, table, key_fields, mbid_field):
+        """Build an index over the rows of `table`.
+        """
+        fields = ', '.join(('id', mbid_field) + key_fields)
+        with self.lib.transaction(read_only=True) as tx:
+            rows = tx.query('SELECT {0} FROM {1}'.format(fields, table))
+        log.debug(u'indexed {0} {1} for duplicate checks'.format(
+            len(rows), table
+        ))
+
+        def pairs():
+            for row in rows:
+                yield tuple(row[f] for f in key_fields), row['id']
+                if row[mbid_field]:
+                    yield row[mbid_field], row['id']
+        return _HashIndex(pairs())
+
+    def _get_index(self, albums):
+        """Get the album or item index, building it (without the lock)
+        if necessary.
+        """
+        with self._lock:
+            if albums in self._indexes:
+                return self._indexes[albums]
+            self._added.setdefault(albums, [])
+
+        if albums:
+            index = self._index('albums', ('albumartist', 'album'),
+                                'mb_albumid')
+        else:
+            index = self._index('items', ('artist', 'title'), 'mb_trackid')
+
+        with self._lock:
+            # Another thread may have built the index meanwhile.
+            if albums not in self._indexes:
+                for key, id in self._added.pop(albums):
+                    index.add(key, id)
+                self._indexes[albums] = index
+            return self._indexes[albums]
+
+    def _add(self, albums, key, id):
+        """Add an entry to an index, if it is built or being built.
+        Must be called with the lock held.
+        """
+        if albums in self._indexes:
+            self._indexes[albums].add(key, id)
+        elif albums in self._added:
+            self._added[albums].append((key, id))
+
+    def _candidates(self, albums, keys):
+        """Get the ids of the albums or items that may match `keys`,
+        building the index if necessary.
+        """
+        index = self._get_index(albums)
+        ids = set()
+        with self._lock:
+            for key in keys:
+                ids.update(index.get(key))
+        return sorted(ids)
+
+    def albums(self, task):
+        """Get the albums in the library that duplicate an album task.
+        An album with exactly the task's files is not a duplicate (it
+        will be replaced).
+        """
+        keys = self._task_keys(task)
+        artist, album = keys[0]
+        if artist is None:
+            # As-is import with no artist. Skip check.
+            return []
+
+        found_albums = []
+        cur_paths = set(i.path for i in task.items if i)
+        for album_id in self._candidates(True, keys):
+            album_cand = self.lib.get_album(album_id)
+            if album_cand is None:
+                # Removed from the library.
+                continue
+            if (album_cand.albumartist, album_cand.album) != keys[0] and \
+                    album_cand.mb_albumid not in keys[1:]:
+                # Another album with the same key hash.
+                continue
             # Check whether the album is identical in contents, in which
             # case it is not a duplicate (will be replaced).
             other_paths = set(i.path for i in album_cand.items())
             if other_paths == cur_paths:
                 continue
             found_albums.append(album_cand)
-    return found_albums
-
-def _item_duplicate_check(lib, task):
-    """Check whether an item already exists in the library. Returns a
-    list of Item objects.
-    """
-    assert task.choice_flag in (action.ASIS, action.APPLY)
-    artist, title = task.chosen_ident()
-
-    found_items = []
-    query = library.AndQuery((
-        library.MatchQuery('artist', artist),
-        library.MatchQuery('title', title),
-    ))
-    for other_item in lib.items(query):
-        # Existing items not considered duplicates.
-        if other_item.path == task.item.path:
-            continue
-        found_items.append(other_item)
-    return found_items
+        return found_albums
+
+    def items(self, task):
+        """Get the items in the library that duplicate a singleton
+        task. The task's own file is not a duplicate.
+        """
+        keys = self._task_keys(task)
+        found_items = []
+        for item_id in self._candidates(False, keys):
+            other_item = self.lib.get_item(item_id)
+            if other_item is None:
+                continue
+            if (other_item.artist, other_item.title) != keys[0] and \
+                    other_item.mb_trackid not in keys[1:]:
+                continue
+            # Existing items not considered duplicates.
+            if other_item.path == task.item.path:
+                continue
+            found_items.append(other_item)
+        return found_items
+
+    def reserve(self, task):
+        """Remember a task that will be added to the library. Returns
+        whether an earlier reserved task had the same identity.
+        """
+        keys = [(task.is_album, key) for key in self._task_keys(task)]
+        with self._lock:
+            found = any(key in self._reserved for key in keys)
+            self._reserved.update(keys)
+        return found
+
+    def add_album(self, album):
+        """Index an album that was added to the library, along with its
+        items.
+        """
+        with self._lock:
+            self._add(True, (album.albumartist, album.album), album.id)
+            if album.mb_albumid:
+                self._add(True, album.mb_albumid, album.id)
+        self.add_items(album.items())
+
+    def add_items(self, items):
+        """Index items that were added to the library.
+        """
+        with self._lock:
+            for item in items:
+                self._add(False, (item.artist, item.title), item.id)
+                if item.mb_trackid:
+                    self._add(False, item.mb_trackid, item.id)
 
 def _infer_album_fields(task):
     """Given an album and an associated import task, massage the
@@ -146,74 +316,400 @@ def _resume():
     """
     return config['import']['resume'].as_choice([True, False, 'ask'])
 
-def _open_state():
-    """Reads the state file, returning a dictionary."""
-    try:
-        with open(config['statefile'].as_filename()) as f:
-            return pickle.load(f)
-    except (IOError, EOFError):
-        return {}
-def _save_state(state):
-    """Writes the state dictionary out to disk."""
-    try:
-        with open(config['statefile'].as_filename(), 'w') as f:
-            pickle.dump(state, f)
-    except IOError as exc:
-        log.error(u'state file could not be written: %s' % unicode(exc))
+# The import state: the progress of interrupted imports, which allows
+# long tagging tasks to be resumed when they pause (or crash), and the
+# "incremental" import history, which keeps track of all directories
+# that were ever imported so the importer can only import new stuff.
+# Both are kept in a small SQLite database next to the library.
 
-
-# Utilities for reading and writing the beets progress file, which
-# allows long tagging tasks to be resumed when they pause (or crash).
 PROGRESS_KEY = 'tagprogress'
+HISTORY_KEY = 'taghistory'
+
+class ImportState(object):
+    """The import progress and history stored in the SQLite database
+    at `path`. Each lookup and change touches a single indexed row.
+    Changes are committed in batches: after `COMMIT_CHANGES` changes,
+    once `COMMIT_INTERVAL` seconds have passed since the last commit,
+    or when `flush` is called. If `pickle_path` names a state file
+    from an earlier version of beets, its contents are imported the
+    first time the database is opened.
+    """
+    COMMIT_CHANGES = 100
+    COMMIT_INTERVAL = 1.0
+
+    def __init__(self, path, pickle_path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path,
+                                     timeout=config['timeout'].as_number(),
+                                     check_same_thread=False)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS progress (
+                toppath BLOB PRIMARY KEY,
+                paths BLOB
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                paths BLOB PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self._conn.commit()
+        self._changes = 0
+        self._last_commit = time.time()
+
+        if pickle_path:
+            self._migrate(pickle_path)
+
+    @staticmethod
+    def _encode(paths):
+        """Encode a sequence of paths as a single blob. (A None path,
+        as for tasks without a top-level directory, is encoded as an
+        empty string.)
+        """
+        return sqlite3.Binary('\0'.join(util.bytestring_path(p or '')
+                                         for p in paths))
+
+    @staticmethod
+    def _decode(blob):
+        """Decode a blob from `_encode` into a list of paths.
+        """
+        return str(blob).split('\0')
+
+    def _migrate(self, pickle_path):
+        """Import the contents of an old pickled state file, unless
+        that has already been done.
+        """
+        with self._lock:
+            done = self._conn.execute(
+                "SELECT value FROM meta WHERE key='migrated'"
+            ).fetchone()
+            if done:
+                return
+
+            try:
+                with open(pickle_path) as f:
+                    state = pickle.load(f)
+            except (IOError, EOFError):
+                state = {}
+            else:
+                log.debug(u'importing state file {0}'.format(
+                    displayable_path(pickle_path)
+                ))
+
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO progress VALUES (?, ?)',
+                [(self._encode([toppath]), self._encode(paths))
+                 for toppath, paths in state.get(PROGRESS_KEY, {}).items()]
+            )
+            self._conn.executemany(
+                'INSERT OR IGNORE INTO history VALUES (?)',
+                [(self._encode(paths),)
+                 for paths in state.get(HISTORY_KEY, ())]
+            )
+            self._conn.execute(
+                "INSERT INTO meta VALUES ('migrated', '1')"
+            )
+            self._conn.commit()
+
+    def _changed(self):
+        """Note a change, committing the pending changes if the batch
+        is full or old enough. Must be called with the lock held.
+        """
+        self._changes += 1
+        if self._changes >= self.COMMIT_CHANGES or \
+                time.time() - self._last_commit >= self.COMMIT_INTERVAL:
+            self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._changes = 0
+        self._last_commit = time.time()
+
+    def flush(self):
+        """Commit all pending changes.
+        """
+        with self._lock:
+            if self._changes:
+                self._commit()
+
+    def close(self):
+        """Commit all pending changes and close the database.
+        """
+        try:
+            self.flush()
+        except sqlite3.Error as exc:
+            log.error(u'state database could not be written: %s' %
+                      unicode(exc))
+        self._conn.close()
+
+    def progress_set(self, toppath, paths):
+        """Record that tagging for the given `toppath` was successful
+        up to `paths`. If paths is None, then clear the progress value
+        (indicating that the tagging completed).
+        """
+        with self._lock:
+            if paths is None:
+                self._conn.execute('DELETE FROM progress WHERE toppath=?',
+                                   (self._encode([toppath]),))
+            else:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO progress VALUES (?, ?)',
+                    (self._encode([toppath]), self._encode(paths))
+                )
+            self._changed()
+
+    def progress_get(self, toppath):
+        """Get the last successfully tagged subpath of toppath. If
+        toppath has no progress information, returns None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT paths FROM progress WHERE toppath=?',
+                (self._encode([toppath]),)
+            ).fetchone()
+        if row:
+            return self._decode(row[0])
+
+    def history_add(self, paths):
+        """Indicate that the import of the album in `paths` is
+        completed and should not be repeated in incremental imports.
+        """
+        with self._lock:
+            self._conn.execute('INSERT OR IGNORE INTO history VALUES (?)',
+                               (self._encode(paths),))
+            self._changed()
+
+    def in_history(self, paths):
+        """Check whether the album in `paths` has been imported before.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT 1 FROM history WHERE paths=?',
+                (self._encode(paths),)
+            ).fetchone()
+        return bool(row)
+
+    def history(self):
+        """Get the set of all completed path tuples.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT paths FROM history').fetchall()
+        return set(tuple(self._decode(row[0])) for row in rows)
+
+_state = None
+_state_lock = threading.Lock()
+def import_state():
+    """Get the ImportState for the configured state database, opening
+    it (and importing the old state file) if necessary.
+    """
+    global _state
+    path = config['statedb'].as_filename()
+    with _state_lock:
+        if _state is None or _state.path != path:
+            if _state is not None:
+                _state.close()
+            _state = ImportState(path, config['statefile'].as_filename())
+        return _state
+
 def progress_set(toppath, paths):
     """Record that tagging for the given `toppath` was successful up to
     `paths`. If paths is None, then clear the progress value (indicating
     that the tagging completed).
     """
-    state = _open_state()
-    if PROGRESS_KEY not in state:
-        state[PROGRESS_KEY] = {}
-
-    if paths is None:
-        # Remove progress from file.
-        if toppath in state[PROGRESS_KEY]:
-            del state[PROGRESS_KEY][toppath]
-    else:
-        state[PROGRESS_KEY][toppath] = paths
+    import_state().progress_set(toppath, paths)
 
-    _save_state(state)
 def progress_get(toppath):
     """Get the last successfully tagged subpath of toppath. If toppath
     has no progress information, returns None.
     """
-    state = _open_state()
-    if PROGRESS_KEY not in state:
-        return None
-    return state[PROGRESS_KEY].get(toppath)
-
+    return import_state().progress_get(toppath)
 
-# Similarly, utilities for manipulating the "incremental" import log.
-# This keeps track of all directories that were ever imported, which
-# allows the importer to only import new stuff.
-HISTORY_KEY = 'taghistory'
 def history_add(paths):
     """Indicate that the import of the album in `paths` is completed and
     should not be repeated in incremental imports.
     """
-    state = _open_state()
-    if HISTORY_KEY not in state:
-        state[HISTORY_KEY] = set()
-
-    state[HISTORY_KEY].add(tuple(paths))
+    import_state().history_add(paths)
 
-    _save_state(state)
 def history_get():
     """Get the set of completed path tuples in incremental imports.
     """
-    state = _open_state()
-    if HISTORY_KEY not in state:
-        return set()
-    return state[HISTORY_KEY]
+    return import_state().history()
+
+
+# Committing the library changes of several tasks together.
+
+class GroupCommit(object):
+    """Commits the library changes of several import tasks at once.
+    As a context manager around the import pipeline, it defers the
+    library's commits (see `Library.deferred_commits`). Each finished
+    task is reported to `task_done` along with a function to call once
+    the task's changes are committed, such as one that records the
+    import progress. The changes are committed once `max_tasks` tasks
+    are waiting, `max_delay` seconds after the first of them finished,
+    and when the block ends, even if the pipeline was aborted. With a
+    `max_tasks` of one or less, or outside the block, every task's
+    change is committed right away.
+
+    The functions are always called in the thread that reports the
+    tasks: after a commit on a timer, they wait for the next call to
+    `task_done` or `flush`, or for the block to end. If one raises an
+    exception, the others stay queued.
+    """
+    def __init__(self, lib, max_tasks=1, max_delay=1.0):
+        self.lib = lib
+        self.max_tasks = max_tasks
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._pending = []  # Functions of uncommitted tasks.
+        self._committed = []  # Functions ready to be called.
+        self._timer = None
+        self._deferred = None
+
+    def __enter__(self):
+        if self.max_tasks > 1:
+            self._deferred = self.lib.deferred_commits()
+            self._deferred.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            with self._lock:
+                self._commit()
+            # Do not hide the exception that ended the block, if any.
+            self._run_callbacks(exc_type is not None)
+        finally:
+            if self._deferred is not None:
+                deferred, self._deferred = self._deferred, None
+                deferred.__exit__(exc_type, exc_value, traceback)
+
+    def task_done(self, callback):
+        """Note that a task's changes are complete. `callback` is
+        called without arguments once they are committed.
+        """
+        with self._lock:
+            self._pending.append(callback)
+            if self._deferred is None or \
+                    len(self._pending) >= self.max_tasks:
+                self._commit()
+            elif self._timer is None:
+                # Bound the time the batch waits for more tasks.
+                self._timer = threading.Timer(self.max_delay, self._expire)
+                self._timer.daemon = True
+                self._timer.start()
+        self._run_callbacks()
+
+    def flush(self):
+        """Commit the changes made so far and call the functions of
+        the finished tasks.
+        """
+        self.commit()
+        self._run_callbacks()
+
+    def commit(self):
+        """Commit the changes made so far. The functions of the
+        finished tasks are called at the next `task_done` or `flush`.
+        """
+        with self._lock:
+            self._commit()
+
+    def _expire(self):
+        """Commit the batch when it has waited long enough. Called on
+        the timer's thread.
+        """
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.lib.commit()
+        self._committed += self._pending
+        self._pending = []
+
+    def _run_callbacks(self, log_errors=False):
+        """Call the functions of the committed tasks in order. If
+        `log_errors`, exceptions are logged instead of raised.
+        """
+        while True:
+            with self._lock:
+                if not self._committed:
+                    return
+                callback = self._committed.pop(0)
+            if log_errors:
+                try:
+                    callback()
+                except Exception as exc:
+                    log.error(u'error finishing import task: {0}'
+                              .format(exc))
+            else:
+                callback()
+
+
+# Running file operations in parallel.
+
+class _Done(object):
+    """The result of an operation that already ran.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+class FileOperations(object):
+    """Runs the file operations of import tasks on a pool of `workers`
+    threads. Operations on the same destination directory run one at a
+    time, in the order they were submitted, so that file names are
+    made unique consistently. With a single worker, operations run
+    right away in the submitting thread.
+    """
+    def __init__(self, workers=1):
+        self.workers = workers
+        self._pool = ThreadPool(workers) if workers > 1 else None
+        self._lock = threading.Lock()
+        # The completion event of the latest operation submitted for
+        # each directory.
+        self._last = {}
+
+    def submit(self, directory, func, *args):
+        """Run `func(*args)` once the operations submitted earlier for
+        `directory` are done. Returns an object whose `get` method
+        waits for the function's result, re-raising its exception if
+        it failed.
+        """
+        if self._pool is None:
+            return _Done(func(*args))
+
+        done = threading.Event()
+        with self._lock:
+            previous = self._last.get(directory)
+            self._last[directory] = done
+
+        def run():
+            try:
+                # The pool starts operations in order, so the previous
+                # one is already running.
+                if previous is not None:
+                    previous.wait()
+                return func(*args)
+            finally:
+                done.set()
+                with self._lock:
+                    if self._last.get(directory) is done:
+                        del self._last[directory]
+        return self._pool.apply_async(run)
+
+    def close(self):
+        """Stop the worker threads. Operations that have not started
+        are abandoned.
+        """
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
 
 
 # Abstract session class.
@@ -233,6 +729,21 @@ class ImportSession(object):
         self.paths = paths
         self.query = query
 
+        # Set to a pipeline.PipelineStats to record how long each
+        # pipeline stage takes.
+        self.stats = None
+
+        # Commits the tasks' library changes; replaced by a batching
+        # GroupCommit while the import runs.
+        self.commits = GroupCommit(lib)
+
+        # Finds the library's albums and items that tasks duplicate.
+        self.duplicates = DuplicateIndex(lib)
+
+        # Runs the tasks' file operations; replaced by a thread pool
+        # while the import runs.
+        self.file_ops = FileOperations()
+
         # Normalize the paths.
         if self.paths:
             self.paths = map(normpath, self.paths)
@@ -254,9 +765,12 @@ class ImportSession(object):
             iconfig['resume'] = False
             iconfig['incremental'] = False
 
-        # Copy and move are mutually exclusive.
+        # Copy, link and move are mutually exclusive.
         if iconfig['move']:
             iconfig['copy'] = False
+            iconfig['link'] = False
+        elif iconfig['link']:
+            iconfig['copy'] = False
 
         # Only delete when copying.
         if not iconfig['copy']:
@@ -314,36 +828,62 @@ class ImportSession(object):
             stages = [read_tasks(self)]
         else:
             stages = [query_tasks(self)]
+        # Look up several tasks at once, keeping their order.
+        lookup_workers = config['import']['lookup_workers'].get(int)
         if config['import']['singletons']:
             # Singleton importer.
             if config['import']['autotag']:
-                stages += [item_lookup(self), item_query(self)]
+                stages += [_lookup_stage(item_lookup, self, lookup_workers),
+                           item_query(self)]
             else:
                 stages += [item_progress(self)]
         else:
             # Whole-album importer.
             if config['import']['autotag']:
                 # Only look up and query the user when autotagging.
-                stages += [initial_lookup(self), user_query(self)]
+                stages += [_lookup_stage(initial_lookup, self,
+                                         lookup_workers),
+                           user_query(self)]
             else:
                 # When not autotagging, just display progress.
                 stages += [show_progress(self)]
         stages += [apply_choices(self)]
+        # Name plugin stages after their functions in statistics.
+        names = [None] * len(stages)
         for stage_func in plugins.import_stages():
             stages.append(plugin_stage(self, stage_func))
+            names.append('plugin_stage({0})'.format(stage_func.__name__))
+        # Move or copy the files of several tasks at once.
+        file_workers = config['import']['file_workers'].get(int)
+        if file_workers > 1:
+            stages += [schedule_files(self)]
         stages += [manipulate_files(self)]
         stages += [finalize(self)]
-        pl = pipeline.Pipeline(stages)
+        pl = pipeline.Pipeline(stages, names)
+
+        # Commit the library changes of several tasks at once.
+        self.commits = GroupCommit(
+            self.lib,
+            config['import']['commit_tasks'].get(int),
+            config['import']['commit_delay'].as_number(),
+        )
 
         # Run the pipeline.
+        self.file_ops = FileOperations(file_workers)
         try:
-            if config['threaded']:
-                pl.run_parallel(QUEUE_SIZE)
-            else:
-                pl.run_sequential()
+            with self.commits:
+                if config['threaded']:
+                    pl.run_parallel(QUEUE_SIZE, self.stats)
+                else:
+                    pl.run_sequential(self.stats)
         except ImportAbort:
             # User aborted operation. Silently stop.
             pass
+        finally:
+            self.file_ops.close()
+            # Commit the progress and history recorded so far.
+            if _state is not None:
+                _state.flush()
 
 
 # The importer task class.
@@ -359,6 +899,7 @@ class ImportTask(object):
         self.sentinel = False
         self.remove_duplicates = False
         self.is_album = True
+        self.file_jobs = None
 
     @classmethod
     def done_sentinel(cls, toppath):
@@ -549,10 +1090,8 @@ def read_tasks(session):
                     # Clear progress; we're starting from the top.
                     progress_set(path, None)
 
-    # Look for saved incremental directories.
-    if config['import']['incremental']:
-        incremental_skipped = 0
-        history_dirs = history_get()
+    # The number of directories skipped in incremental mode.
+    skipped = [0]
 
     for toppath in session.paths:
         # Check whether the path is to a file.
@@ -577,26 +1116,19 @@ def read_tasks(session):
             yield ImportTask.done_sentinel(toppath)
             continue
 
-        # Produce paths under this directory.
+        # Produce paths under this directory. Directories are skipped
+        # before their files are read.
         if _resume():
             resume_dir = resume_dirs.get(toppath)
-        for path, items in autotag.albums_in_dir(toppath):
-            # Skip according to progress.
-            if _resume() and resume_dir:
-                # We're fast-forwarding to resume a previous tagging.
-                if path == resume_dir:
-                    # We've hit the last good path! Turn off the
-                    # fast-forwarding.
-                    resume_dir = None
-                continue
-
-            # When incremental, skip paths in the history.
-            if config['import']['incremental'] and tuple(path) in history_dirs:
-                log.debug(u'Skipping previously-imported path: %s' %
-                          displayable_path(path))
-                incremental_skipped += 1
-                continue
-
+        else:
+            resume_dir = None
+        if config['import']['incremental']:
+            state = import_state()
+        else:
+            state = None
+        albums = _skip_albums(autotag.album_paths_in_dir(toppath),
+                              resume_dir, state, skipped)
+        for path, items in autotag.read_albums(albums):
             # Yield all the necessary tasks.
             if config['import']['singletons']:
                 for item in items:
@@ -609,9 +1141,36 @@ def read_tasks(session):
         yield ImportTask.done_sentinel(toppath)
 
     # Show skipped directories.
-    if config['import']['incremental'] and incremental_skipped:
+    if config['import']['incremental'] and skipped[0]:
         log.info(u'Incremental import: skipped %i directories.' %
-                 incremental_skipped)
+                 skipped[0])
+
+def _skip_albums(albums, resume_dir, state, skipped):
+    """Filter the (paths, entries) pairs from
+    `autotag.album_paths_in_dir`, so no files are read for albums that
+    will not be imported. If `resume_dir` is given, albums up to and
+    including that one are dropped, since they were imported before an
+    interruption. If an ImportState is given, albums in its history
+    are dropped and counted in the one-element list `skipped`.
+    """
+    for path, entries in albums:
+        # Skip according to progress.
+        if resume_dir:
+            # We're fast-forwarding to resume a previous tagging.
+            if path == resume_dir:
+                # We've hit the last good path! Turn off the
+                # fast-forwarding.
+                resume_dir = None
+            continue
+
+        # When incremental, skip paths in the history.
+        if state is not None and state.in_history(path):
+            log.debug(u'Skipping previously-imported path: %s' %
+                      displayable_path(path))
+            skipped[0] += 1
+            continue
+
+        yield path, entries
 
 def query_tasks(session):
     """A generator that works as a drop-in-replacement for read_tasks.
@@ -631,6 +1190,15 @@ def query_tasks(session):
             items = list(album.items())
             yield ImportTask(None, [album.item_dir()], items)
 
+def _lookup_stage(lookup, session, workers):
+    """Make a pipeline stage that runs the `lookup` coroutine for
+    `session` in `workers` threads while passing the tasks on in their
+    original order.
+    """
+    if workers <= 1:
+        return lookup(session)
+    return pipeline.OrderedStage([lookup(session) for _ in range(workers)])
+
 def initial_lookup(session):
     """A coroutine for performing the initial MusicBrainz lookup for an
     album. It accepts lists of Items and yields
@@ -656,7 +1224,6 @@ def user_query(session):
     a file-like object for logging the import process. The coroutine
     accepts and yields ImportTask objects.
     """
-    recent = set()
     task = None
     while True:
         task = yield task
@@ -687,16 +1254,14 @@ def user_query(session):
             task = pipeline.multiple(item_tasks)
             continue
 
-        # Check for duplicates if we have a match (or ASIS).
+        # Check for duplicates if we have a match (or ASIS). Reserving
+        # the task also catches recently chosen albums, which haven't
+        # reached the database yet.
         if task.choice_flag in (action.ASIS, action.APPLY):
-            ident = task.chosen_ident()
-            # The "recent" set keeps track of identifiers for recently
-            # imported albums -- those that haven't reached the database
-            # yet.
-            if ident in recent or _duplicate_check(session.lib, task):
+            if session.duplicates.reserve(task) or \
+                    session.duplicates.albums(task):
                 session.resolve_duplicate(task)
                 session.log_choice(task, True)
-            recent.add(ident)
 
 def show_progress(session):
     """This stage replaces the initial_lookup and user_query stages
@@ -765,10 +1330,10 @@ def apply_choices(session):
         duplicate_items = []
         if task.remove_duplicates:
             if task.is_album:
-                for album in _duplicate_check(session.lib, task):
+                for album in session.duplicates.albums(task):
                     duplicate_items += album.items()
             else:
-                duplicate_items = _item_duplicate_check(session.lib, task)
+                duplicate_items = session.duplicates.items(task)
             log.debug('removing %i old duplicated items' %
                       len(duplicate_items))
 
@@ -799,8 +1364,13 @@ def apply_choices(session):
                 task.album_id = album.id
             else:
                 # Add tracks.
-                for item in items:
-                    session.lib.add(item)
+                session.lib.add_many(items)
+
+        # Index the new music for later duplicate checks.
+        if task.is_album:
+            session.duplicates.add_album(album)
+        else:
+            session.duplicates.add_items(items)
 
 def plugin_stage(session, func):
     """A coroutine (pipeline stage) that calls the given function with
@@ -814,13 +1384,128 @@ def plugin_stage(session, func):
             continue
         func(session, task)
 
-        # Stage may modify DB, so re-load cached item data.
+        # Stage may modify DB, so re-load the items whose rows were
+        # changed other than through the items themselves.
         for item in task.imported_items():
-            item.load()
+            if item.is_stale():
+                item.load()
+
+def _start_file_ops(session, task):
+    """Delete the duplicates that a task replaces, then submit the
+    moves, copies and tag writes for its items to the session's
+    FileOperations, grouped by destination directory. The pending
+    operations are stored in the task's `file_jobs`.
+    """
+    # Files are about to leave their original places, so the task's
+    # new rows must not be rolled back if the import is interrupted.
+    if config['import']['move'] or task.remove_duplicates:
+        session.commits.commit()
+
+    # Remove duplicate files marked for deletion.
+    if task.remove_duplicates:
+        for duplicate_path in task.duplicate_paths:
+            log.debug(u'deleting replaced duplicate %s' %
+                      util.displayable_path(duplicate_path))
+            util.remove(duplicate_path)
+            util.prune_dirs(os.path.dirname(duplicate_path),
+                            session.lib.directory)
+
+    items = task.imported_items()
+    # Save the original paths of all items for deletion and pruning
+    # in the next step (finalization).
+    task.old_paths = [item.path for item in items]
+
+    # Decide what happens to each file: moved (copy is False), copied
+    # or linked (copy is True) or left in place (copy is None).
+    link = bool(config['import']['link'])
+    groups = util.OrderedDict()
+    for item in items:
+        copy = _copy_flag(session, item.path)
+        if copy is False and not config['import']['move']:
+            if task.replaced_items[item]:
+                # We will move the item, so remove the soon to be
+                # nonexistent file from old_paths.
+                task.old_paths.remove(item.path)
+            else:
+                # Only files that are already part of the library are
+                # moved.
+                copy = True
+
+        if copy is None:
+            dest = item.path
+        else:
+            dest = item.destination()
+        groups.setdefault(os.path.dirname(dest), []).append(
+            (item, dest, copy)
+        )
+
+    write = config['import']['write'] and task.should_write_tags()
+    task.file_jobs = [
+        session.file_ops.submit(directory, _move_files, ops, write, link)
+        for directory, ops in groups.items()
+    ]
+
+def _copy_flag(session, path):
+    """Decide whether the file at `path`, which belongs to the library
+    if it is in the library directory, should be moved (False), copied
+    or linked (True) or left in place (None) by an import.
+    """
+    if config['import']['move']:
+        # Just move the file.
+        return False
+    elif config['import']['copy'] or config['import']['link']:
+        # Move in-library files (on reimports) and copy out-of-library
+        # files, keeping track of their old paths.
+        if session.lib.directory in util.ancestry(path):
+            return False
+        return True
+    return None
+
+def _move_files(ops, write, link=False):
+    """Move or copy items to their destinations, given as (item,
+    destination, copy) triples, and optionally write their tags. Items
+    whose `copy` flag is None stay in place. If `link`, copies are made
+    as hard links.
+
+    Errors do not propagate, so the caller can record the files that
+    were handled before one. Returns a list of (item, old path) pairs
+    for the moved files and the `sys.exc_info()` of the error that
+    stopped the operations, or None.
+    """
+    moved = []
+    try:
+        for item, dest, copy in ops:
+            if copy is not None:
+                util.mkdirall(dest)
+                source = item.path
+                item.path, _ = item._transfer_file(dest, copy,
+                                                   link and copy)
+                if not copy:
+                    moved.append((item, source))
+            if write:
+                item.write()
+    except Exception:
+        return moved, sys.exc_info()
+    return moved, None
+
+def schedule_files(session):
+    """A coroutine (pipeline stage) that starts the file manipulations
+    of each task on the session's I/O threads and passes the task on
+    without waiting for them, so they overlap with those of the tasks
+    before it. It precedes `manipulate_files`, which waits for them.
+    """
+    task = None
+    while True:
+        task = yield task
+        if task.should_skip():
+            continue
+        _start_file_ops(session, task)
 
 def manipulate_files(session):
     """A coroutine (pipeline stage) that performs necessary file
-    manipulations *after* items have been added to the library.
+    manipulations *after* items have been added to the library. The
+    manipulations are started here unless `schedule_files` already
+    did; the new paths are then stored in the order of the tasks.
     """
     task = None
     while True:
@@ -828,51 +1513,37 @@ def manipulate_files(session):
         if task.should_skip():
             continue
 
-        # Remove duplicate files marked for deletion.
-        if task.remove_duplicates:
-            for duplicate_path in task.duplicate_paths:
-                log.debug(u'deleting replaced duplicate %s' %
-                          util.displayable_path(duplicate_path))
-                util.remove(duplicate_path)
-                util.prune_dirs(os.path.dirname(duplicate_path),
-                                session.lib.directory)
-
-        # Move/copy/write files.
+        if task.file_jobs is None:
+            _start_file_ops(session, task)
+        # Wait for all of the files, even if some fail, so that the
+        # files moved so far are recorded.
+        moved = []
+        error = None
+        for job in task.file_jobs:
+            job_moved, job_error = job.get()
+            moved += job_moved
+            error = error or job_error
+        for item, source in moved:
+            plugins.send('item_moved', item=item, source=source,
+                         destination=item.path)
+
+        # Save new paths, and move any album art along with the items.
         items = task.imported_items()
-        # Save the original paths of all items for deletion and pruning
-        # in the next step (finalization).
-        task.old_paths = [item.path for item in items]
-        for item in items:
-            if config['import']['move']:
-                # Just move the file.
-                item.move(False)
-            elif config['import']['copy']:
-                # If it's a reimport, move in-library files and copy
-                # out-of-library files. Otherwise, copy and keep track
-                # of the old path.
-                old_path = item.path
-                if task.replaced_items[item]:
-                    # This is a reimport. Move in-library files and copy
-                    # out-of-library files.
-                    if session.lib.directory in util.ancestry(old_path):
-                        item.move(False)
-                        # We moved the item, so remove the
-                        # now-nonexistent file from old_paths.
-                        task.old_paths.remove(old_path)
-                    else:
-                        item.move(True)
-                else:
-                    # A normal import. Just copy files and keep track of
-                    # old paths.
-                    item.move(True)
-
-            if config['import']['write'] and task.should_write_tags():
-                item.write()
-
-        # Save new paths.
         with session.lib.transaction():
             for item in items:
                 item.store()
+            album = items[0].get_album() if items else None
+            if not error and album and album.artpath:
+                copy = _copy_flag(session, album.artpath)
+                if copy is not None:
+                    album.move_art(copy)
+                    album.store()
+        if error:
+            raise error[0], error[1], error[2]
+
+        # Prune directories vacated by moves.
+        for item, source in moved:
+            util.prune_dirs(os.path.dirname(source), session.lib.directory)
 
         # Plugin event.
         plugins.send('import_task_files', session=session, task=task)
@@ -885,10 +1556,7 @@ def finalize(session):
     while True:
         task = yield
         if task.should_skip():
-            if _resume():
-                task.save_progress()
-            if config['import']['incremental']:
-                task.save_history()
+            session.commits.task_done(functools.partial(_save_state, task))
             continue
 
         items = task.imported_items()
@@ -903,26 +1571,39 @@ def finalize(session):
                 plugins.send('item_imported',
                              lib=session.lib, item=item)
 
-        # When copying and deleting originals, delete old files.
-        if config['import']['copy'] and config['import']['delete']:
-            new_paths = [os.path.realpath(item.path) for item in items]
-            for old_path in task.old_paths:
-                # Only delete files that were actually copied.
-                if old_path not in new_paths:
-                    util.remove(syspath(old_path), False)
-                    task.prune(old_path)
-
-        # When moving, prune empty directories containing the original
-        # files.
-        elif config['import']['move']:
-            for old_path in task.old_paths:
+        # Clean up the original files and update the progress once the
+        # new paths are committed to the library.
+        session.commits.task_done(functools.partial(_finish_files, task))
+
+def _finish_files(task):
+    """Delete or prune the original files of a finished task, as
+    configured, and record the task's progress.
+    """
+    # When copying and deleting originals, delete old files.
+    if config['import']['copy'] and config['import']['delete']:
+        new_paths = [os.path.realpath(item.path)
+                     for item in task.imported_items()]
+        for old_path in task.old_paths:
+            # Only delete files that were actually copied.
+            if old_path not in new_paths:
+                util.remove(syspath(old_path), False)
                 task.prune(old_path)
 
-        # Update progress.
-        if _resume():
-            task.save_progress()
-        if config['import']['incremental']:
-            task.save_history()
+    # When moving, prune empty directories containing the original
+    # files.
+    elif config['import']['move']:
+        for old_path in task.old_paths:
+            task.prune(old_path)
+
+    _save_state(task)
+
+def _save_state(task):
+    """Record a finished task in the import progress and history.
+    """
+    if _resume():
+        task.save_progress()
+    if config['import']['incremental']:
+        task.save_history()
 
 
 # Singleton pipeline stages.
@@ -946,7 +1627,6 @@ def item_query(session):
     lookups.
     """
     task = None
-    recent = set()
     while True:
         task = yield task
         if task.sentinel:
@@ -959,11 +1639,10 @@ def item_query(session):
 
         # Duplicate check.
         if task.choice_flag in (action.ASIS, action.APPLY):
-            ident = task.chosen_ident()
-            if ident in recent or _item_duplicate_check(session.lib, task):
+            if session.duplicates.reserve(task) or \
+                    session.duplicates.items(task):
                 session.resolve_duplicate(task)
                 session.log_choice(task, True)
-            recent.add(ident)
 
 def item_progress(session):
     """Skips the lookup and query stages in a non-autotagged singleton
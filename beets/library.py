@@ -25,6 +25,8 @@ import threading
 import contextlib
 import traceback
 import time
+import itertools
+import copy
 from collections import defaultdict
 from unidecode import unidecode
 from beets.mediafile import MediaFile
@@ -167,6 +169,23 @@ SQLITE_TYPES = {
 SQLITE_KEY_TYPE = 'INTEGER PRIMARY KEY'
 
 
+# Indexes that are always maintained on the main tables. Each entry is
+# a table name and a sequence of columns. These speed up fetching an
+# album's items, the importer's duplicate and re-import checks, path
+# queries, and the %aunique template function.
+DEFAULT_INDEXES = (
+    ('items', ('album_id',)),
+    ('items', ('mb_trackid',)),
+    ('items', ('mb_albumid',)),
+    ('items', ('path',)),
+    ('albums', ('mb_albumid',)),
+    ('albums', ('albumartist', 'album')),
+)
+
+# The prefix of the names of the indexes that beets creates and drops.
+INDEX_PREFIX = 'beets_'
+
+
 # Default search fields for each model.
 ALBUM_DEFAULT_FIELDS = ('album', 'albumartist', 'genre')
 ITEM_DEFAULT_FIELDS = ALBUM_DEFAULT_FIELDS + ('artist', 'title', 'comments')
@@ -175,6 +194,10 @@ ITEM_DEFAULT_FIELDS = ALBUM_DEFAULT_FIELDS + ('artist', 'title', 'comments')
 # Special path format key.
 PF_KEY_DEFAULT = 'default'
 
+# The number of recently written rows whose write counts the library
+# remembers for change tracking (see `LibModel.is_stale`).
+ROW_VERSIONS_SIZE = 10000
+
 
 # Logger.
 log = logging.getLogger('beets')
@@ -193,6 +216,37 @@ def _orelse(exp1, exp2):
                       'ELSE {0} END)').format(exp1, exp2)
 
 
+# SQLite functions for queries that cannot be expressed in plain SQL.
+_regexp_cache = {}
+REGEXP_CACHE_SIZE = 100
+
+def _compile_regexp(pattern):
+    """Compile a regular expression, reusing a previous compilation of
+    the same pattern if possible. Returns None if the pattern is not a
+    valid regular expression.
+    """
+    try:
+        return _regexp_cache[pattern]
+    except KeyError:
+        pass
+
+    try:
+        regexp = re.compile(pattern)
+    except re.error:
+        regexp = None
+    if len(_regexp_cache) >= REGEXP_CACHE_SIZE:
+        _regexp_cache.clear()
+    _regexp_cache[pattern] = regexp
+    return regexp
+
+def _sqlite_regexp(pattern, value):
+    """Implements SQLite's ``value REGEXP pattern`` operator by
+    searching for the regular expression in the value. The value is
+    converted to a string in the same way as for `RegexpQuery.match`.
+    """
+    return RegexpQuery.value_match(pattern, util.as_string(value))
+
+
 # Path element formatting for templating.
 def format_for_path(value, key=None, pathmod=None):
     """Sanitize the value for inclusion in a path: replace separators
@@ -286,9 +340,17 @@ class FlexModel(object):
         source = self._values_fixed if key in self._fields \
                  else self._values_flex
         old_value = source.get(key)
-        source[key] = value
-        if old_value != value:
+        if key not in source or old_value != value:
             self._dirty.add(key)
+        source[key] = value
+
+    def __delitem__(self, key):
+        """Remove a flex field. Fixed fields cannot be removed.
+        """
+        if key in self._fields:
+            raise KeyError(u'fixed field {0} cannot be removed'.format(key))
+        del self._values_flex[key]
+        self._dirty.add(key)
 
     def update(self, values):
         """Assign all values in the given dict.
@@ -334,6 +396,15 @@ class FlexModel(object):
         else:
             self[key] = value
 
+    def __delattr__(self, key):
+        if key.startswith('_'):
+            super(FlexModel, self).__delattr__(key)
+        else:
+            try:
+                del self[key]
+            except KeyError:
+                raise AttributeError('cannot remove field {0!r}'.format(key))
+
 
 class LibModel(FlexModel):
     """A model base class that includes a reference to a Library object.
@@ -358,6 +429,15 @@ class LibModel(FlexModel):
     terms.
     """
 
+    _fts_table = None
+    """The SQLite full-text index table over the search fields.
+    """
+
+    _version = 0
+    """The library's write count when the object was last known to
+    match its database row (see `is_stale`).
+    """
+
     def __init__(self, lib=None, **values):
         self._lib = lib
         super(LibModel, self).__init__(**values)
@@ -392,6 +472,8 @@ class LibModel(FlexModel):
         assignments = assignments[:-1]  # Knock off last ,
 
         with self._lib.transaction() as tx:
+            tx._tracked = True
+
             # Main table update.
             if assignments:
                 query = 'UPDATE {0} SET {1} WHERE id=?'.format(
@@ -400,30 +482,63 @@ class LibModel(FlexModel):
                 subvars.append(self.id)
                 tx.mutate(query, subvars)
 
-            # Flexible attributes.
-            for key, value in self._values_flex.items():
-                tx.mutate(
+            # Flexible attributes. Only write the ones that changed and
+            # remove the ones that were deleted.
+            flex_updates = []
+            flex_deletes = []
+            for key in self._dirty:
+                if key in self._fields:
+                    continue
+                elif key in self._values_flex:
+                    flex_updates.append((self.id, key, self._values_flex[key]))
+                else:
+                    flex_deletes.append((self.id, key))
+            if flex_updates:
+                tx.mutate_many(
                     'INSERT INTO {0} '
                     '(entity_id, key, value) '
                     'VALUES (?, ?, ?);'.format(self._flex_table),
-                    (self.id, key, value),
+                    flex_updates,
+                )
+            if flex_deletes:
+                tx.mutate_many(
+                    'DELETE FROM {0} '
+                    'WHERE entity_id=? AND key=?;'.format(self._flex_table),
+                    flex_deletes,
                 )
 
+            self._lib._touch(self)
+
         self.clear_dirty()
+        self._lib._uncache(type(self), self.id)
 
     def load(self):
         """Refresh the object's metadata from the library database.
         """
         self._check_db()
-        stored_obj = self._lib._get(type(self), self.id)
+        version = self._lib._version
+        stored_obj = self._lib._get(type(self), self.id, False)
         self.update(dict(stored_obj))
         self.clear_dirty()
+        self._version = version
+
+    def is_stale(self):
+        """Check whether the object's database row may have changed
+        since the object last matched it, other than through the
+        object itself: by another object for the same row, or by SQL
+        statements not made by a model object. A stale object should
+        be `load`ed before it is used further.
+        """
+        if not self._lib or not self.id:
+            return False
+        return self._lib._row_version(type(self), self.id) > self._version
 
     def remove(self):
         """Remove the object's associated rows from the database.
         """
         self._check_db()
         with self._lib.transaction() as tx:
+            tx._tracked = True
             tx.mutate(
                 'DELETE FROM {0} WHERE id=?'.format(self._table),
                 (self.id,)
@@ -432,6 +547,8 @@ class LibModel(FlexModel):
                 'DELETE FROM {0} WHERE entity_id=?'.format(self._flex_table),
                 (self.id,)
             )
+            self._lib._touch(self)
+        self._lib._uncache(type(self), self.id)
 
 
 class Item(LibModel):
@@ -439,6 +556,7 @@ class Item(LibModel):
     _table = 'items'
     _flex_table = 'item_attributes'
     _search_fields = ITEM_DEFAULT_FIELDS
+    _fts_table = 'items_fts'
 
     @classmethod
     def from_path(cls, path):
@@ -542,22 +660,42 @@ class Item(LibModel):
 
     # Files themselves.
 
-    def move_file(self, dest, copy=False):
+    def move_file(self, dest, copy=False, link=False):
         """Moves or copies the item's file, updating the path value if
         the move succeeds. If a file exists at ``dest``, then it is
-        slightly modified to be unique.
+        slightly modified to be unique. If `link`, the file is hard
+        linked (or, where that is impossible, copied) instead. Returns
+        the name of the method used (see `util.copy`).
         """
-        if not util.samefile(self.path, dest):
-            dest = util.unique_path(dest)
-        if copy:
-            util.copy(self.path, dest)
-        else:
-            util.move(self.path, dest)
+        dest, method = self._transfer_file(dest, copy, link)
+        if not copy and not link:
             plugins.send("item_moved", item=self, source=self.path,
                          destination=dest)
 
         # Either copying or moving succeeded, so update the stored path.
         self.path = dest
+        return method
+
+    def _transfer_file(self, dest, copy=False, link=False):
+        """Move, copy or link the item's file as `move_file` does, but
+        without updating the item or sending the `item_moved` event.
+        Returns the path the file now has at the destination and the
+        name of the method used.
+        """
+        if not util.samefile(self.path, dest):
+            dest = util.unique_path(dest)
+        if link:
+            method = util.link(self.path, dest)
+        elif copy:
+            method = util.copy(self.path, dest)
+        else:
+            method = util.move(self.path, dest)
+        if method:
+            log.debug(u'{0}: {1} -> {2}'.format(
+                method, util.displayable_path(self.path),
+                util.displayable_path(dest)
+            ))
+        return dest, method
 
     def current_mtime(self):
         """Returns the current mtime of the file, rounded to the nearest
@@ -586,8 +724,6 @@ class Item(LibModel):
             util.remove(self.path)
             util.prune_dirs(os.path.dirname(self.path), self._lib.directory)
 
-        self._lib._memotable = {}
-
     def move(self, copy=False, basedir=None, with_album=True):
         """Move the item to its designated location within the library
         directory (provided by destination()). Subdirectories are
@@ -634,76 +770,25 @@ class Item(LibModel):
     # Templating.
 
     def evaluate_template(self, template, sanitize=False,
-                          pathmod=None):
+                          pathmod=None, album=None):
         """Evaluates a Template object using the item's fields. If
         `sanitize`, then each value will be sanitized for inclusion in a
-        file path.
+        file path. `album` may be given to supply the item's album when
+        it is already known; otherwise, it is looked up.
         """
-        pathmod = pathmod or os.path
-
-        # Get the item's Album if it has one.
-        album = self.get_album()
-
-        # Build the mapping for substitution in the template,
-        # beginning with the values from the database.
-        mapping = {}
-        for key in ITEM_KEYS:
-            # Get the values from either the item or its album.
-            if key in ALBUM_KEYS_ITEM and album is not None:
-                # From album.
-                value = getattr(album, key)
-            else:
-                # From Item.
-                value = getattr(self, key)
-            if sanitize:
-                value = format_for_path(value, key, pathmod)
-            mapping[key] = value
-
-        # Include the path if we're not sanitizing to construct a path.
-        if sanitize:
-            del mapping['path']
-        else:
-            mapping['path'] = displayable_path(self.path)
-
-        # Use the album artist if the track artist is not set and
-        # vice-versa.
-        if not mapping['artist']:
-            mapping['artist'] = mapping['albumartist']
-        if not mapping['albumartist']:
-            mapping['albumartist'] = mapping['artist']
-
-        # Flexible attributes.
-        for key, value in self._values_flex.items():
-            if sanitize:
-                value = format_for_path(value, None, pathmod)
-            mapping[key] = value
-
-        # Get values from plugins.
-        for key, value in plugins.template_values(self).items():
-            if sanitize:
-                value = format_for_path(value, key, pathmod)
-            mapping[key] = value
-        if album:
-            for key, value in plugins.album_template_values(album).items():
-                if sanitize:
-                    value = format_for_path(value, key, pathmod)
-                mapping[key] = value
-
-        # Get template functions.
-        funcs = DefaultTemplateFunctions(self, self._lib, pathmod).functions()
-        funcs.update(plugins.template_funcs())
-
-        # Perform substitution.
-        return template.substitute(mapping, funcs)
+        formatter = TemplateFormatter(template, sanitize, pathmod)
+        return formatter.format(self, album)
 
     def destination(self, pathmod=None, fragment=False,
-                    basedir=None, platform=None, path_formats=None):
+                    basedir=None, platform=None, path_formats=None,
+                    album=None):
         """Returns the path in the library directory designated for the
         item (i.e., where the file ought to be). fragment makes this
         method return just the path fragment underneath the root library
         directory; the path is also returned as Unicode instead of
         encoded as a bytestring. basedir can override the library's base
-        directory for the destination.
+        directory for the destination. album can supply the item's
+        album if it is already known.
         """
         self._check_db()
         pathmod = pathmod or os.path
@@ -713,28 +798,19 @@ class Item(LibModel):
 
         # Use a path format based on a query, falling back on the
         # default.
-        for query, path_format in path_formats:
-            if query == PF_KEY_DEFAULT:
-                continue
-            query = AndQuery.from_string(query)
+        conditional, default = self._lib._compile_path_formats(path_formats)
+        for query, subpath_tmpl in conditional:
             if query.match(self):
                 # The query matches the item! Use the corresponding path
                 # format.
                 break
         else:
             # No query matched; fall back to default.
-            for query, path_format in path_formats:
-                if query == PF_KEY_DEFAULT:
-                    break
-            else:
-                assert False, "no default path format"
-        if isinstance(path_format, Template):
-            subpath_tmpl = path_format
-        else:
-            subpath_tmpl = Template(path_format)
+            assert default is not None, "no default path format"
+            subpath_tmpl = default
 
         # Evaluate the selected template.
-        subpath = self.evaluate_template(subpath_tmpl, True, pathmod)
+        subpath = self.evaluate_template(subpath_tmpl, True, pathmod, album)
 
         # Prepare path for output: normalize Unicode characters.
         if platform == 'darwin':
@@ -755,10 +831,7 @@ class Item(LibModel):
         subpath += extension.lower()
 
         # Truncate too-long components.
-        maxlen = beets.config['max_filename_length'].get(int)
-        if not maxlen:
-            # When zero, try to determine from filesystem.
-            maxlen = util.max_filename_length(self._lib.directory)
+        maxlen = self._lib._max_filename_length(basedir)
         subpath = util.truncate_path(subpath, pathmod, maxlen)
 
         if fragment:
@@ -776,6 +849,7 @@ class Album(LibModel):
     _table = 'albums'
     _flex_table = 'album_attributes'
     _search_fields = ALBUM_DEFAULT_FIELDS
+    _fts_table = 'albums_fts'
 
     def __setitem__(self, key, value):
         """Set the value of an album attribute."""
@@ -800,6 +874,7 @@ class Album(LibModel):
         Set with_items to False to avoid removing the album's items.
         """
         super(Album, self).remove()
+        self._lib._album_changed(self.id)
 
         # Delete art file.
         if delete:
@@ -920,24 +995,7 @@ class Album(LibModel):
     def evaluate_template(self, template):
         """Evaluates a Template object using the album's fields.
         """
-        # Get template field values.
-        mapping = {}
-        for key, value in dict(self).items():
-            mapping[key] = format_for_path(value, key)
-
-        mapping['artpath'] = displayable_path(mapping['artpath'])
-        mapping['path'] = displayable_path(self.item_dir())
-
-        # Get values from plugins.
-        for key, value in plugins.album_template_values(self).iteritems():
-            mapping[key] = value
-
-        # Get template functions.
-        funcs = DefaultTemplateFunctions().functions()
-        funcs.update(plugins.template_funcs())
-
-        # Perform substitution.
-        return template.substitute(mapping, funcs)
+        return TemplateFormatter(template).format(self)
 
     def store(self):
         """Update the database with the album information. The album's
@@ -948,6 +1006,7 @@ class Album(LibModel):
         for key in ALBUM_KEYS_ITEM:
             if key in self._dirty:
                 track_updates[key] = self[key]
+        changed = bool(self._dirty)
 
         with self._lib.transaction():
             super(Album, self).store()
@@ -956,6 +1015,10 @@ class Album(LibModel):
                     for key, value in track_updates.items():
                         item[key] = value
                     item.store()
+        # Outside the transaction: the %aunique tables query the
+        # database without holding their locks.
+        if changed:
+            self._lib._album_changed(self.id)
 
 
 
@@ -967,14 +1030,29 @@ class Query(object):
     """
     def clause(self):
         """Generate an SQLite expression implementing the query.
-        Return a clause string, a sequence of substitution values for
-        the clause, and a Query object representing the "remainder"
         Returns (clause, subvals) where clause is a valid sqlite
         WHERE clause implementing the query and subvals is a list of
-        items to be substituted for ?s in the clause.
+        items to be substituted for ?s in the clause. If the query
+        cannot be expressed in SQL, the clause is None.
         """
         return None, ()
 
+    def split_clause(self, model_cls=None):
+        """Split the query into a part that can be evaluated by SQLite
+        and a part that must be checked in Python. Returns a clause
+        string, a sequence of substitution values for the clause, and a
+        Query object representing the "remainder" (or None if the
+        clause implements the whole query). The clause is None when no
+        part of the query can be expressed in SQL. `model_cls`, if
+        provided, is the LibModel subclass being queried; it lets
+        queries on flexible attributes use the attribute table.
+        """
+        clause, subvals = self.clause()
+        if clause:
+            return clause, subvals, None
+        else:
+            return None, (), self
+
     def match(self, item):
         """Check whether this query matches a given Item. Can be used to
         perform queries on arbitrary sets of Items.
@@ -1004,6 +1082,34 @@ class FieldQuery(Query):
             # Matching a flexattr. This is a slow query.
             return None, ()
 
+    def flex_clause(self, flex_table):
+        """Generate an SQLite expression that matches the pattern
+        against a flexible attribute stored in `flex_table`. The
+        expression applies `col_clause` to the attribute table's value
+        column. Returns (None, ()) if that is not possible, including
+        when the pattern would also match objects that lack the
+        attribute entirely.
+        """
+        if self._raw_value_match(self.pattern, None):
+            return None, ()
+        value_query = copy.copy(self)
+        value_query.field = 'value'
+        value_clause, value_subvals = value_query.col_clause()
+        if not value_clause:
+            return None, ()
+        clause = 'id IN (SELECT entity_id FROM {0} ' \
+                 'WHERE key = ? AND {1})'.format(flex_table, value_clause)
+        return clause, [self.field] + list(value_subvals)
+
+    def split_clause(self, model_cls=None):
+        if self.fast or model_cls is None:
+            return super(FieldQuery, self).split_clause(model_cls)
+        clause, subvals = self.flex_clause(model_cls._flex_table)
+        if clause:
+            return clause, subvals, None
+        else:
+            return None, (), self
+
     @classmethod
     def value_match(cls, pattern, value):
         """Determine whether the value matches the pattern. Both
@@ -1053,16 +1159,19 @@ class SubstringQuery(FieldQuery):
 
 class RegexpQuery(FieldQuery):
     """A query that matches a regular expression in a specific item
-    field.
+    field. The expression is evaluated in SQLite using the ``REGEXP``
+    operator, which is implemented by `_sqlite_regexp`.
     """
+    def col_clause(self):
+        return self.field + " REGEXP ?", [self.pattern]
+
     @classmethod
     def value_match(cls, pattern, value):
-        try:
-            res = re.search(pattern, value)
-        except re.error:
+        regexp = _compile_regexp(pattern)
+        if regexp is None:
             # Invalid regular expression.
             return False
-        return res is not None
+        return regexp.search(value) is not None
 
 
 class BooleanQuery(MatchQuery):
@@ -1189,15 +1298,19 @@ class CollectionQuery(Query):
         return clause, subvals
 
     @classmethod
-    def from_strings(cls, query_parts, default_fields, all_keys):
+    def from_strings(cls, query_parts, default_fields, all_keys,
+                     fts_table=None):
         """Creates a query from a list of strings in the format used by
         parse_query_part. If default_fields are specified, they are the
         fields to be searched by unqualified search terms. Otherwise,
-        all fields are searched for those terms.
+        all fields are searched for those terms. If `fts_table` is
+        given, unqualified terms are matched as words using that
+        full-text index.
         """
         subqueries = []
         for part in query_parts:
-            subq = construct_query_part(part, default_fields, all_keys)
+            subq = construct_query_part(part, default_fields, all_keys,
+                                        fts_table)
             if subq:
                 subqueries.append(subq)
         if not subqueries:  # No terms in query.
@@ -1244,6 +1357,54 @@ class AnyFieldQuery(CollectionQuery):
         return False
 
 
+class FullTextQuery(Query):
+    """A query that matches if the words in a pattern appear, in order,
+    in any of the given fields. Words are runs of letters and digits
+    and are compared case-insensitively. If `prefix` is set, the last
+    word of the pattern only needs to begin a word in the field.
+
+    When the name of the library's full-text index table is provided
+    as `fts_table`, the query is evaluated using that index; otherwise,
+    it is a slow query.
+    """
+    def __init__(self, pattern, fields, fts_table=None, prefix=False):
+        self.pattern = pattern
+        self.fields = fields
+        self.fts_table = fts_table
+        self.prefix = prefix
+        self.words = fts_words(pattern)
+
+    def clause(self):
+        if not self.fts_table or not self.words:
+            return None, ()
+        # Quote the words as a phrase so that SQLite does not interpret
+        # any of them as operators.
+        phrase = u'"{0}{1}"'.format(u' '.join(self.words),
+                                    u'*' if self.prefix else u'')
+        return 'id IN (SELECT docid FROM {0} WHERE {0} MATCH ?)'.format(
+            self.fts_table
+        ), [phrase]
+
+    def match(self, item):
+        if not self.words:
+            return False
+        num_words = len(self.words)
+        for field in self.fields:
+            value = item.get(field)
+            if not value:
+                continue
+            words = fts_words(util.as_string(value))
+            for start in range(len(words) - num_words + 1):
+                window = words[start:start + num_words]
+                if window[:-1] != self.words[:-1]:
+                    continue
+                if window[-1] == self.words[-1] or \
+                        (self.prefix and
+                         window[-1].startswith(self.words[-1])):
+                    return True
+        return False
+
+
 class MutableCollectionQuery(CollectionQuery):
     """A collection query whose subqueries may be modified after the
     query is initialized.
@@ -1260,6 +1421,34 @@ class AndQuery(MutableCollectionQuery):
     def clause(self):
         return self.clause_with_joiner('and')
 
+    def split_clause(self, model_cls=None):
+        """Push every conjunct that SQLite can evaluate into the clause
+        and leave only the others to be matched in Python. This way, a
+        single slow subquery does not turn the whole query into a full
+        table scan.
+        """
+        clause_parts = []
+        subvals = []
+        remainder = []
+        for subq in self.subqueries:
+            subq_clause, subq_subvals, subq_rest = \
+                subq.split_clause(model_cls)
+            if subq_clause:
+                clause_parts.append('(' + subq_clause + ')')
+                subvals += subq_subvals
+            if subq_rest is not None:
+                remainder.append(subq_rest)
+
+        if not clause_parts:
+            return None, (), self
+        clause = ' and '.join(clause_parts)
+        if not remainder:
+            return clause, subvals, None
+        elif len(remainder) == 1:
+            return clause, subvals, remainder[0]
+        else:
+            return clause, subvals, AndQuery(remainder)
+
     def match(self, item):
         return all([q.match(item) for q in self.subqueries])
 
@@ -1295,14 +1484,32 @@ class PathQuery(Query):
                item.path.startswith(self.dir_path)
 
     def clause(self):
-        dir_pat = buffer(self.dir_path + '%')
+        # Match the directory prefix as a range of blobs (rather than
+        # with LIKE) so the index on the path column can be used.
+        dir_blob = buffer(self.dir_path)
+        dir_end = buffer(self.dir_path[:-1] + chr(ord(self.dir_path[-1]) + 1))
         file_blob = buffer(self.file_path)
-        return '(path = ?) || (path LIKE ?)', (file_blob, dir_pat)
+        return '(path = ?) OR (path >= ? AND path < ?)', \
+               (file_blob, dir_blob, dir_end)
 
 
 
 # Query construction and parsing helpers.
 
+FTS_WORD_REGEX = re.compile(u'[0-9A-Za-z\u0080-\uffff]+')
+FTS_LOWER = dict((ord(c), ord(c.lower())) for c in
+                 u'ABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+def fts_words(text):
+    """Split a string into a list of lowercase words in the same way
+    as SQLite's "simple" full-text tokenizer: words are runs of ASCII
+    letters and digits and non-ASCII characters, and only ASCII letters
+    are folded to lowercase.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf8', 'ignore')
+    return [w.translate(FTS_LOWER) for w in FTS_WORD_REGEX.findall(text)]
+
 
 PARSE_QUERY_PART_REGEX = re.compile(
     # Non-capturing optional segment for the keyword.
@@ -1353,9 +1560,12 @@ def parse_query_part(part):
         return key, term, SubstringQuery  # The default query type.
 
 
-def construct_query_part(query_part, default_fields, all_keys):
+def construct_query_part(query_part, default_fields, all_keys,
+                         fts_table=None):
     """Create a query from a single query component. Return a Query
-    instance or None if the value cannot be parsed.
+    instance or None if the value cannot be parsed. If `fts_table` is
+    provided, plain unqualified terms are matched as words using that
+    full-text index table.
     """
     parsed = parse_query_part(query_part)
     if not parsed:
@@ -1368,6 +1578,17 @@ def construct_query_part(query_part, default_fields, all_keys):
         if os.sep in pattern and 'path' in all_keys:
             # This looks like a path.
             return PathQuery(pattern)
+        elif query_class is SubstringQuery and fts_table and \
+                pattern.endswith('*') and fts_words(pattern[:-1]):
+            # A word prefix. (Without the index, the asterisk is just
+            # part of the substring, as it always was.)
+            return FullTextQuery(pattern[:-1], default_fields, fts_table,
+                                 True)
+        elif query_class is SubstringQuery and fts_table and \
+                fts_words(pattern):
+            # Plain words, which can be looked up in the full-text
+            # index.
+            return FullTextQuery(pattern, default_fields, fts_table)
         elif issubclass(query_class, FieldQuery):
             # The query type matches a specific field, but none was
             # specified. So we use a version of the query that matches
@@ -1401,12 +1622,13 @@ def construct_query_part(query_part, default_fields, all_keys):
         return query_class(key.lower(), pattern, key in all_keys)
 
 
-def get_query(val, model_cls):
+def get_query(val, model_cls, fts=False):
     """Takes a value which may be None, a query string, a query string
     list, or a Query object, and returns a suitable Query object.
     `model_cls` is the subclass of LibModel indicating which entity this
     is a query for (i.e., Album or Item) and is used to determine which
-    fields are searched.
+    fields are searched. If `fts` is set, unqualified terms are matched
+    using the model's full-text index.
     """
     # Convert a single string into a list of space-separated
     # criteria.
@@ -1417,7 +1639,8 @@ def get_query(val, model_cls):
         return TrueQuery()
     elif isinstance(val, list) or isinstance(val, tuple):
         return AndQuery.from_strings(val, model_cls._search_fields,
-                                     model_cls._fields)
+                                     model_cls._fields,
+                                     model_cls._fts_table if fts else None)
     elif isinstance(val, Query):
         return val
     else:
@@ -1431,46 +1654,166 @@ def get_query(val, model_cls):
 class Results(object):
     """An item query result set. Iterating over the collection lazily
     constructs LibModel objects that reflect database rows.
+
+    The rows are only fetched from the database when they are first
+    needed. Slicing a result set (``results[100:150]``) produces a new
+    result set that uses SQL ``LIMIT`` and ``OFFSET`` clauses, and the
+    length of the set is determined with ``COUNT(*)``, whenever the
+    query can be evaluated by the database directly.
     """
-    def __init__(self, model_class, rows, lib, query=None):
+    flex_batch_size = 500
+    """The number of objects whose flexible attributes are fetched
+    together in a single query. This must stay below SQLite's limit on
+    the number of substitution variables in a statement (999). It is
+    also the number of rows fetched at a time in streaming mode.
+    """
+
+    def __init__(self, model_class, lib, where=None, subvals=(),
+                 order_by=None, query=None, limit=None, offset=0,
+                 stream=False):
         """Create a result set that will construct objects of type
         `model_class`, which should be a subclass of `LibModel`, out of
-        the query result mapping in `rows`. The new objects are
-        associated with the library `lib`. If `query` is provided, it is
-        used as a predicate to filter the results for a "slow query" that
-        cannot be evaluated by the database directly.
+        the rows matching the SQLite WHERE clause `where` (with
+        substitution values `subvals`), sorted by the ORDER BY clause
+        `order_by`. The new objects are associated with the library
+        `lib`. If `query` is provided, it is used as a predicate to
+        filter the results for a "slow query" that cannot be evaluated
+        by the database directly.
+
+        `limit` and `offset` restrict the result set to a window of the
+        matching objects. If `stream` is set, the rows are not all
+        loaded into memory at once: only their ids are fetched up
+        front and the full rows are read in batches during iteration.
         """
         self.model_class = model_class
-        self.rows = rows
         self.lib = lib
+        self.where = where or '1'
+        self.subvals = list(subvals)
+        self.order_by = order_by
         self.query = query
+        self.limit = limit
+        self.offset = offset
+        self.stream = stream
+        self._rows = None
+        # The library's write count before the rows were fetched.
+        self._version = 0
+
+    def _statement(self, columns='*', ordered=True):
+        """Build the SQL statement that fetches the given columns for
+        the rows in this result set. Returns the statement and its
+        substitution values. The window is only applied in SQL for fast
+        queries; slow queries must be windowed after filtering.
+        """
+        sql = 'SELECT {0} FROM {1} WHERE {2}'.format(
+            columns, self.model_class._table, self.where
+        )
+        subvals = list(self.subvals)
+        if ordered and self.order_by:
+            sql += ' ORDER BY {0}'.format(self.order_by)
+        if not self.query and (self.limit is not None or self.offset):
+            sql += ' LIMIT ? OFFSET ?'
+            subvals += [-1 if self.limit is None else self.limit,
+                        self.offset]
+        return sql, subvals
+
+    @property
+    def rows(self):
+        """The database rows in this result set. They are fetched (all
+        at once) the first time this property is accessed.
+        """
+        if self._rows is None:
+            sql, subvals = self._statement()
+            self._version = self.lib._version
+            with self.lib.transaction(read_only=True) as tx:
+                self._rows = tx.query(sql, subvals)
+        return self._rows
+
+    def _stream_rows(self):
+        """Generate the database rows in this result set without
+        holding all of them in memory. The (sorted) ids are fetched
+        first; the rows themselves are then fetched in batches. Rows
+        that disappear in the meantime are skipped.
+        """
+        sql, subvals = self._statement('id')
+        self._version = self.lib._version
+        with self.lib.transaction(read_only=True) as tx:
+            ids = [row[0] for row in tx.query(sql, subvals)]
+
+        for start in range(0, len(ids), self.flex_batch_size):
+            batch_ids = ids[start:start + self.flex_batch_size]
+            with self.lib.transaction(read_only=True) as tx:
+                rows = tx.query(
+                    'SELECT * FROM {0} WHERE id IN ({1})'.format(
+                        self.model_class._table,
+                        ','.join(['?'] * len(batch_ids)),
+                    ),
+                    batch_ids
+                )
+            rows_by_id = dict((row['id'], row) for row in rows)
+            for obj_id in batch_ids:
+                if obj_id in rows_by_id:
+                    yield rows_by_id[obj_id]
+
+    def _get_flex(self, ids):
+        """Fetch the flexible attributes for all the objects with the
+        given ids in one query. Return a dictionary mapping each id to
+        a dictionary of attributes.
+        """
+        flex_values = defaultdict(dict)
+        with self.lib.transaction(read_only=True) as tx:
+            flex_rows = tx.query(
+                'SELECT entity_id, key, value FROM {0} '
+                'WHERE entity_id IN ({1})'.format(
+                    self.model_class._flex_table,
+                    ','.join(['?'] * len(ids)),
+                ),
+                ids
+            )
+        for row in flex_rows:
+            flex_values[row['entity_id']][row['key']] = row['value']
+        return flex_values
 
-    def __iter__(self):
+    def _objects(self):
         """Construct Python objects for all rows that pass the query
         predicate.
         """
-        for row in self.rows:
-            # Get the flexible attributes for the object.
-            with self.lib.transaction() as tx:
-                flex_rows = tx.query(
-                    'SELECT * FROM {0} WHERE entity_id=?'.format(
-                        self.model_class._flex_table
-                    ),
-                    (row['id'],)
-                )
-            values = dict(row)
-            values.update(
-                dict((row['key'], row['value']) for row in flex_rows)
-            )
+        if self.stream and self._rows is None:
+            rows = self._stream_rows()
+        else:
+            rows = iter(self.rows)
 
-            # Construct the Python object and yield it if it passes the
-            # predicate.
-            obj = self.model_class(self.lib, **values)
-            if not self.query or self.query.match(obj):
-                yield obj
+        while True:
+            # Get the flexible attributes for a batch of objects.
+            batch = list(itertools.islice(rows, self.flex_batch_size))
+            if not batch:
+                break
+            flex_values = self._get_flex([row['id'] for row in batch])
 
-    def __len__(self):
-        """Get the number of matching objects.
+            for row in batch:
+                values = dict(row)
+                values.update(flex_values.get(row['id'], {}))
+
+                # Construct the Python object and yield it if it passes
+                # the predicate.
+                obj = self.model_class(self.lib, **values)
+                obj._version = self._version
+                if not self.query or self.query.match(obj):
+                    yield obj
+
+    def __iter__(self):
+        """Iterate over the objects in this result set.
+        """
+        objs = self._objects()
+        if self.query and (self.limit is not None or self.offset):
+            # Slow query: apply the window after filtering.
+            stop = None if self.limit is None else self.offset + self.limit
+            objs = itertools.islice(objs, self.offset, stop)
+        return objs
+
+    def count(self):
+        """Get the number of matching objects. For fast queries, the
+        database counts the rows; slow queries fall back to testing
+        every object.
         """
         if self.query:
             # A slow query. Fall back to testing every object.
@@ -1479,34 +1822,80 @@ class Results(object):
                 count += 1
             return count
 
+        elif self._rows is not None:
+            # Rows already fetched.
+            return len(self._rows)
+
         else:
-            # A fast query. Just count the rows.
-            return len(self.rows)
+            # A fast query. Let the database count the rows.
+            sql, subvals = self._statement('id', False)
+            with self.lib.transaction(read_only=True) as tx:
+                rows = tx.query(
+                    'SELECT COUNT(*) FROM ({0})'.format(sql), subvals
+                )
+            return rows[0][0]
+
+    def __len__(self):
+        """Get the number of matching objects.
+        """
+        return self.count()
 
     def __nonzero__(self):
         """Does this result contain any objects?
         """
-        return bool(len(self))
+        return self.get() is not None
 
-    def __getitem__(self, n):
-        """Get the nth item in this result set. This is inefficient: all
-        items up to n are materialized and thrown away.
+    def _slice(self, start, stop=None):
+        """Get a new result set containing the objects from index
+        `start` up to (but not including) `stop` in this set. The
+        indices must be nonnegative.
         """
-        it = iter(self)
-        try:
-            for i in range(n):
-                it.next()
-            return it.next()
-        except StopIteration:
-            raise IndexError('result index {0} out of range'.format(n))
+        limit = None if stop is None else max(0, stop - start)
+        if self.limit is not None:
+            remaining = max(0, self.limit - start)
+            limit = remaining if limit is None else min(limit, remaining)
+
+        res = Results(self.model_class, self.lib, self.where, self.subvals,
+                      self.order_by, self.query, limit, self.offset + start,
+                      self.stream)
+        if self._rows is not None and not self.query:
+            # Rows are already in memory; no need to query again.
+            res._rows = self._rows[start:stop]
+        return res
+
+    def __getitem__(self, key):
+        """Get the nth object in this result set or, if `key` is a
+        slice, a new result set restricted to the slice. For fast
+        queries, only the requested rows are fetched from the database.
+        Negative indices require counting the result set first.
+        """
+        if isinstance(key, slice):
+            if key.step not in (None, 1):
+                raise ValueError('result slices must not have a step')
+            start, stop = key.start or 0, key.stop
+            if start < 0 or (stop is not None and stop < 0):
+                start, stop, _ = key.indices(len(self))
+            return self._slice(start, stop)
+
+        n = key
+        if n < 0:
+            n += len(self)
+        obj = self._slice(n, n + 1).get() if n >= 0 else None
+        if obj is None:
+            raise IndexError('result index {0} out of range'.format(key))
+        return obj
 
     def get(self):
         """Return the first matching object, or None if no objects
         match.
         """
-        it = iter(self)
+        if self.query or self._rows is not None:
+            objs = iter(self)
+        else:
+            # Only fetch the first row.
+            objs = iter(self._slice(0, 1))
         try:
-            return it.next()
+            return objs.next()
         except StopIteration:
             return None
 
@@ -1514,9 +1903,19 @@ class Results(object):
 class Transaction(object):
     """A context manager for safe, concurrent access to the database.
     All SQL commands should be executed through a transaction.
+
+    A `read_only` transaction may only query the database. When the
+    library is in concurrent mode, read-only transactions in different
+    threads can run at the same time; other transactions always run
+    one at a time.
     """
-    def __init__(self, lib):
+    def __init__(self, lib, read_only=False):
         self.lib = lib
+        self.read_only = read_only
+        self._shared = False
+        # Set by model objects whose writes record the rows they
+        # change (see `Library._touch`).
+        self._tracked = False
 
     def __enter__(self):
         """Begin a transaction. This transaction may be created while
@@ -1524,11 +1923,20 @@ class Transaction(object):
         """
         with self.lib._tx_stack() as stack:
             first = not stack
+            if not first and stack[0].read_only and not self.read_only:
+                raise ValueError('cannot write inside a read-only '
+                                 'transaction')
             stack.append(self)
         if first:
             # Beginning a "root" transaction, which corresponds to an
-            # SQLite transaction.
-            self.lib._db_lock.acquire()
+            # SQLite transaction. While commits are deferred, all
+            # threads share one connection and so take turns.
+            self._shared = self.read_only and self.lib.concurrent and \
+                self.lib._deferred_conn is None
+            if self._shared:
+                self.lib._db_lock.acquire_read()
+            else:
+                self.lib._db_lock.acquire_write()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -1540,9 +1948,14 @@ class Transaction(object):
             assert stack.pop() is self
             empty = not stack
         if empty:
-            # Ending a "root" transaction. End the SQLite transaction.
-            self.lib._connection().commit()
-            self.lib._db_lock.release()
+            # Ending a "root" transaction. End the SQLite transaction,
+            # unless its changes are held back for a later commit.
+            if self.lib._deferred_conn is None:
+                self.lib._connection().commit()
+            if self._shared:
+                self.lib._db_lock.release_read()
+            else:
+                self.lib._db_lock.release_write()
 
     def query(self, statement, subvals=()):
         """Execute an SQL statement with substitution values and return
@@ -1551,17 +1964,45 @@ class Transaction(object):
         cursor = self.lib._connection().execute(statement, subvals)
         return cursor.fetchall()
 
+    def _check_writable(self):
+        """Raise a ValueError if this is a read-only transaction.
+        """
+        if self.read_only:
+            raise ValueError('read-only transaction cannot modify the '
+                             'database')
+
     def mutate(self, statement, subvals=()):
         """Execute an SQL statement with substitution values and return
         the row ID of the last affected row.
         """
+        self._check_writable()
         cursor = self.lib._connection().execute(statement, subvals)
+        self._count_write()
         plugins.send('database_change', lib=self.lib)
         return cursor.lastrowid
 
+    def mutate_many(self, statement, subvals_seq):
+        """Execute an SQL statement once for each sequence of
+        substitution values in `subvals_seq`.
+        """
+        self._check_writable()
+        self.lib._connection().executemany(statement, subvals_seq)
+        self._count_write()
+        plugins.send('database_change', lib=self.lib)
+
+    def _count_write(self):
+        """Count a write in the library's change tracking. Writes not
+        made by model objects may have changed any row.
+        """
+        self.lib._version += 1
+        if not self._tracked:
+            self.lib._untracked_version = self.lib._version
+
     def script(self, statements):
         """Execute a string containing multiple SQL statements."""
+        self._check_writable()
         self.lib._connection().executescript(statements)
+        self._count_write()
 
 
 class Library(object):
@@ -1573,7 +2014,11 @@ class Library(object):
                                       '$artist/$album/$track $title'),),
                        replacements=None,
                        item_fields=ITEM_FIELDS,
-                       album_fields=ALBUM_FIELDS):
+                       album_fields=ALBUM_FIELDS,
+                       indexes=(),
+                       fts=False,
+                       concurrent=False,
+                       cache_size=0):
         if path == ':memory:':
             self.path = path
         else:
@@ -1582,10 +2027,39 @@ class Library(object):
         self.path_formats = path_formats
         self.replacements = replacements
 
-        self._memotable = {}  # Used for template substitution performance.
+        # Parsed path formats and filename length limits for
+        # destination(), keyed by the path format list and the base
+        # directory respectively.
+        self._path_format_cache = {}
+        self._maxlen_cache = {}
+
+        # Precomputed %aunique disambiguation, keyed by the template
+        # function's arguments.
+        self._aunique_tables = {}
+        self._aunique_lock = threading.Lock()
+
+        # An identity map of recently fetched items and albums, keyed by
+        # (class, id). Objects returned by `get_item` and `get_album`
+        # are shared; storing, removing, or adding an object evicts it.
+        self._cache = util.LRUCache(cache_size) if cache_size else None
 
         self._connections = {}
         self._tx_stacks = defaultdict(list)
+        # The connection used by all threads while commits are deferred.
+        self._deferred_conn = None
+        # The plugin SQL functions registered with each open connection.
+        self._conn_functions = {}
+
+        # Change tracking. `_version` counts the writes to the database
+        # (which are serialized by the database lock). `_row_versions`
+        # maps recently written rows, as (model class, id) pairs, to
+        # the count at their last write by a model object, oldest
+        # first. `_untracked_version` is the count at the last write
+        # that could have changed any row: one not made by a model
+        # object, or one to a row since dropped from `_row_versions`.
+        self._version = 0
+        self._row_versions = util.OrderedDict()
+        self._untracked_version = 0
         # A lock to protect the _connections and _tx_stacks maps, which
         # both map thread IDs to private resources.
         self._shared_map_lock = threading.Lock()
@@ -1597,13 +2071,25 @@ class Library(object):
         # whole-second sleeps (!) that would trigger its internal
         # timeout. Using this lock ensures only one SQLite transaction
         # is active at a time.
-        self._db_lock = threading.Lock()
+        #
+        # In concurrent mode, the database uses a write-ahead log so
+        # that readers do not contend with each other, and read-only
+        # transactions share this (reader/writer) lock: they may run in
+        # parallel with each other but not with writes.
+        self.concurrent = concurrent and self.path != ':memory:'
+        self._db_lock = util.ReadWriteLock()
 
         # Set up database schema.
         self._make_table(Item._table, item_fields)
         self._make_table(Album._table, album_fields)
         self._make_attribute_table(Item._flex_table)
         self._make_attribute_table(Album._flex_table)
+        # The indexes the library was opened with, default and
+        # configured, as (table, columns) pairs.
+        self.indexes = DEFAULT_INDEXES + tuple(indexes)
+        self._make_indexes(self.indexes)
+        self.fts = all([self._make_fts(model_cls, fts)
+                        for model_cls in (Item, Album)])
 
     def _make_table(self, table, fields):
         """Set up the schema of the library file. fields is a list of
@@ -1672,26 +2158,246 @@ class Library(object):
                     ON {0} (entity_id);
                 """.format(flex_table))
 
+    def _make_indexes(self, indexes):
+        """Create the indexes described by `indexes`, a sequence of
+        (table, columns) pairs, and drop the indexes previously created
+        by beets that are no longer wanted. Columns that are flexible
+        attributes are served by an index on the keys and values of the
+        corresponding attribute table. The names of beets' indexes start
+        with `INDEX_PREFIX`, so other indexes are left alone.
+        """
+        table_columns = {}
+        with self.transaction() as tx:
+            for table in (Item._table, Album._table):
+                rows = tx.query('PRAGMA table_info(%s)' % table)
+                table_columns[table] = set(row[1] for row in rows)
+
+        wanted = {}
+        for table, columns in indexes:
+            model_cls = {Item._table: Item, Album._table: Album}[table]
+            fixed = [c for c in columns if c in model_cls._fields]
+            if not set(fixed).issubset(table_columns[table]):
+                # The schema was customized to omit some columns.
+                continue
+            if len(fixed) < len(columns):
+                # Some columns are flexible attributes.
+                name = '{0}{1}_by_key'.format(INDEX_PREFIX,
+                                              model_cls._flex_table)
+                wanted[name] = 'CREATE INDEX {0} ON {1} (key, value);\n' \
+                               .format(name, model_cls._flex_table)
+            if fixed:
+                name = '{0}{1}_by_{2}'.format(INDEX_PREFIX, table,
+                                              '_'.join(fixed))
+                wanted[name] = 'CREATE INDEX {0} ON {1} ({2});\n'.format(
+                    name, table, ', '.join(fixed)
+                )
+
+        with self.transaction() as tx:
+            rows = tx.query("SELECT name FROM sqlite_master "
+                            "WHERE type='index'")
+        existing = set(row[0] for row in rows)
+
+        setup_sql = ''
+        for name in existing:
+            if name.startswith(INDEX_PREFIX) and name not in wanted:
+                setup_sql += 'DROP INDEX {0};\n'.format(name)
+        for name, sql in wanted.items():
+            if name not in existing:
+                setup_sql += sql
+        if setup_sql:
+            with self.transaction() as tx:
+                tx.script(setup_sql)
+
+    def _make_fts(self, model_cls, enabled):
+        """Create (if `enabled`) or remove (otherwise) the full-text
+        index over the search fields of `model_cls`. The index is kept
+        up to date by triggers on the main table, so every way of
+        adding, storing, or removing objects updates it. Returns a flag
+        indicating whether the index is available.
+        """
+        fts_table = model_cls._fts_table
+        triggers = ['{0}_{1}'.format(fts_table, suffix)
+                    for suffix in ('ai', 'bu', 'au', 'bd')]
+
+        if not enabled:
+            with self.transaction() as tx:
+                tx.script(''.join(
+                    ['DROP TRIGGER IF EXISTS {0};\n'.format(t)
+                     for t in triggers] +
+                    ['DROP TABLE IF EXISTS {0};\n'.format(fts_table)]
+                ))
+            return False
+
+        with self.transaction() as tx:
+            rows = tx.query("SELECT name FROM sqlite_master "
+                            "WHERE name=?", (fts_table,))
+        if rows:
+            # Index already exists.
+            return True
+
+        columns = ', '.join(model_cls._search_fields)
+        new_values = ', '.join(['new.' + field
+                                for field in model_cls._search_fields])
+        insert = 'INSERT INTO {0} (docid, {1}) VALUES (new.id, {2});' \
+                 .format(fts_table, columns, new_values)
+        delete = 'DELETE FROM {0} WHERE docid=old.id;'.format(fts_table)
+        setup_sql = """
+            CREATE VIRTUAL TABLE {fts} USING fts4(content="{table}", {cols});
+            CREATE TRIGGER {ai} AFTER INSERT ON {table}
+                BEGIN {insert} END;
+            CREATE TRIGGER {bu} BEFORE UPDATE OF {cols} ON {table}
+                BEGIN {delete} END;
+            CREATE TRIGGER {au} AFTER UPDATE OF {cols} ON {table}
+                BEGIN {insert} END;
+            CREATE TRIGGER {bd} BEFORE DELETE ON {table}
+                BEGIN {delete} END;
+            INSERT INTO {fts} ({fts}) VALUES ('rebuild');
+            """.format(fts=fts_table, table=model_cls._table, cols=columns,
+                       insert=insert, delete=delete,
+                       **dict(zip(('ai', 'bu', 'au', 'bd'), triggers)))
+        try:
+            with self.transaction() as tx:
+                tx.script(setup_sql)
+        except sqlite3.OperationalError as exc:
+            # SQLite was built without full-text search.
+            log.warn(u'full-text index unavailable: {0}'.format(exc))
+            return False
+        return True
+
+    def index_info(self):
+        """Describe the indexes on the library's tables. Returns a list
+        of (index name, table name, column names, rows per key) tuples.
+        The last value is the average number of rows sharing a value of
+        the index's leading column, as measured by SQLite's ``ANALYZE``
+        command; smaller numbers mean a more selective index. It is
+        None when the table is empty.
+        """
+        with self.transaction() as tx:
+            tx.script('ANALYZE;')
+            indexes = tx.query("SELECT name, tbl_name FROM sqlite_master "
+                               "WHERE type='index' AND sql NOT NULL "
+                               "ORDER BY tbl_name, name")
+            stats = dict((row[0], row[1]) for row in
+                         tx.query('SELECT idx, stat FROM sqlite_stat1'))
+            out = []
+            for name, table in indexes:
+                columns = [row[2] for row in
+                           tx.query('PRAGMA index_info({0})'.format(name))]
+                stat = stats.get(name)
+                per_key = int(stat.split()[1]) if stat else None
+                out.append((name, table, columns, per_key))
+        return out
+
+    def explain(self, model_cls, query):
+        """Get SQLite's plan for fetching the objects of type
+        `model_cls` that match `query`. Returns a list of strings
+        describing the steps of the plan (including which indexes are
+        used) and a flag indicating whether part of the query must be
+        evaluated in Python after the rows are fetched.
+        """
+        query = get_query(query, model_cls, self.fts)
+        where, subvals, slow_query = query.split_clause(model_cls)
+        sql, subvals = Results(model_cls, self, where, subvals)._statement()
+        with self.transaction(read_only=True) as tx:
+            rows = tx.query('EXPLAIN QUERY PLAN ' + sql, subvals)
+        return [row[-1] for row in rows], slow_query is not None
+
     def _connection(self):
         """Get a SQLite connection object to the underlying database.
-        One connection object is created per thread.
+        One connection object is created per thread, except while
+        commits are deferred, when all threads share one connection.
         """
         thread_id = threading.current_thread().ident
         with self._shared_map_lock:
-            if thread_id in self._connections:
-                return self._connections[thread_id]
+            if self._deferred_conn is not None:
+                conn = self._deferred_conn
+            elif thread_id in self._connections:
+                conn = self._connections[thread_id]
             else:
-                # Make a new connection.
-                conn = sqlite3.connect(
-                    self.path,
-                    timeout=beets.config['timeout'].as_number(),
-                )
+                conn = self._connect()
+                self._connections[thread_id] = conn
 
-                # Access SELECT results like dictionaries.
-                conn.row_factory = sqlite3.Row
+            # Plugins loaded since the connection was made may provide
+            # more functions.
+            functions = plugins.sql_functions()
+            if self._conn_functions.get(conn) is not functions:
+                self._register_functions(conn, functions)
+            return conn
 
-                self._connections[thread_id] = conn
-                return conn
+    def _connect(self, check_same_thread=True):
+        """Make a new SQLite connection to the underlying database.
+        """
+        conn = sqlite3.connect(
+            self.path,
+            timeout=beets.config['timeout'].as_number(),
+            check_same_thread=check_same_thread,
+        )
+
+        # Access SELECT results like dictionaries.
+        conn.row_factory = sqlite3.Row
+
+        if self.concurrent:
+            conn.execute('PRAGMA journal_mode=WAL')
+
+        # Register functions used by queries.
+        conn.create_function('regexp', 2, _sqlite_regexp)
+        self._register_functions(conn, plugins.sql_functions())
+
+        return conn
+
+    def _register_functions(self, conn, functions):
+        """Make the plugin SQL functions in the dictionary `functions`
+        (see `plugins.sql_functions`) available on a connection.
+        """
+        for name, func in functions.items():
+            conn.create_function(name, -1, func)
+        self._conn_functions[conn] = functions
+
+    @contextlib.contextmanager
+    def deferred_commits(self):
+        """A context manager that holds back the commits of the
+        transactions made inside it, so that the changes of many
+        transactions reach the disk together when `commit` is called
+        or the block ends. Meanwhile, all threads use the same SQLite
+        connection, so they all see the uncommitted changes, and
+        transactions run one at a time. Enter it while no transactions
+        are active. In-memory databases, which cannot be shared between
+        connections, commit as usual.
+        """
+        if self.path == ':memory:':
+            yield
+            return
+
+        conn = self._connect(check_same_thread=False)
+        with self._shared_map_lock:
+            assert self._deferred_conn is None
+            self._deferred_conn = conn
+        try:
+            yield
+        finally:
+            # Commit and stop sharing the connection in one step, so
+            # that a concurrent `commit` never sees it closed.
+            self._db_lock.acquire_write()
+            try:
+                conn.commit()
+                with self._shared_map_lock:
+                    self._deferred_conn = None
+                    self._conn_functions.pop(conn, None)
+            finally:
+                self._db_lock.release_write()
+            conn.close()
+
+    def commit(self):
+        """Commit the changes held back by `deferred_commits`. Does
+        nothing when commits are not being deferred.
+        """
+        self._db_lock.acquire_write()
+        try:
+            conn = self._deferred_conn
+            if conn is not None:
+                conn.commit()
+        finally:
+            self._db_lock.release_write()
 
     @contextlib.contextmanager
     def _tx_stack(self):
@@ -1703,11 +2409,13 @@ class Library(object):
         with self._shared_map_lock:
             yield self._tx_stacks[thread_id]
 
-    def transaction(self):
+    def transaction(self, read_only=False):
         """Get a :class:`Transaction` object for interacting directly
-        with the underlying SQLite database.
+        with the underlying SQLite database. Use `read_only` for
+        transactions that only query the database so that, in
+        concurrent mode, they can run in parallel.
         """
-        return Transaction(self)
+        return Transaction(self, read_only)
 
 
     # Adding objects to the database.
@@ -1716,41 +2424,75 @@ class Library(object):
         """Add the :class:`Item` object to the library database. The
         item's id field will be updated; the new id is returned.
         """
-        item.added = time.time()
-        if not item._lib:
-            item._lib = self
+        return self.add_many([item])[0]
 
-        # Build essential parts of query.
-        columns = ','.join([key for key in ITEM_KEYS if key != 'id'])
-        values = ','.join(['?'] * (len(ITEM_KEYS) - 1))
-        subvars = []
-        for key in ITEM_KEYS:
-            if key != 'id':
+    def add_many(self, items):
+        """Add a sequence of :class:`Item` objects to the library
+        database in a single transaction. The rows for all the items and
+        their flexible attributes are inserted in bulk. The items' id
+        fields are updated; the list of new ids is returned.
+        """
+        items = list(items)
+        if not items:
+            return []
+
+        # Build the values for every row.
+        columns = [key for key in ITEM_KEYS if key != 'id']
+        added = time.time()
+        rows = []
+        for item in items:
+            item.added = added
+            if not item._lib:
+                item._lib = self
+            subvars = []
+            for key in columns:
                 value = getattr(item, key)
                 if key == 'path' and isinstance(value, str):
                     value = buffer(value)
                 subvars.append(value)
+            rows.append(subvars)
 
-        # Issue query.
         with self.transaction() as tx:
-            # Main table insertion.
-            new_id = tx.mutate(
-                'INSERT INTO items (' + columns + ') VALUES (' + values + ')',
-                subvars
+            tx._tracked = True
+
+            # Insert the first item to find out where the new ids
+            # start. The transaction has now locked the database for
+            # writing, so the following ids are free: insert the rest
+            # of the items with explicit ids.
+            first_id = tx.mutate(
+                'INSERT INTO items ({0}) VALUES ({1})'.format(
+                    ','.join(columns), ','.join(['?'] * len(columns))
+                ),
+                rows[0]
             )
+            ids = range(first_id, first_id + len(items))
+            if len(items) > 1:
+                tx.mutate_many(
+                    'INSERT INTO items (id,{0}) VALUES (?,{1})'.format(
+                        ','.join(columns), ','.join(['?'] * len(columns))
+                    ),
+                    [[new_id] + row for new_id, row in zip(ids[1:], rows[1:])]
+                )
 
             # Flexible attributes.
-            flexins = 'INSERT INTO item_attributes ' \
-                      ' (entity_id, key, value)' \
-                      ' VALUES (?, ?, ?)'
-            for key, value in item._values_flex.items():
-                if value is not None:
-                    tx.mutate(flexins, (new_id, key, value))
-
-        item.clear_dirty()
-        item.id = new_id
-        self._memotable = {}
-        return new_id
+            flex_rows = []
+            for new_id, item in zip(ids, items):
+                for key, value in item._values_flex.items():
+                    if value is not None:
+                        flex_rows.append((new_id, key, value))
+            if flex_rows:
+                tx.mutate_many('INSERT INTO item_attributes '
+                               ' (entity_id, key, value)'
+                               ' VALUES (?, ?, ?)', flex_rows)
+
+            for new_id, item in zip(ids, items):
+                item.clear_dirty()
+                item.id = new_id
+                self._touch(item, True)
+
+        for new_id in ids:
+            self._uncache(Item, new_id)
+        return ids
 
     def add_album(self, items):
         """Create a new album in the database with metadata derived
@@ -1765,6 +2507,7 @@ class Library(object):
         album_values['added'] = time.time()
 
         with self.transaction() as tx:
+            tx._tracked = True
             sql = 'INSERT INTO albums (%s) VALUES (%s)' % \
                 (', '.join(ALBUM_KEYS_ITEM),
                 ', '.join(['?'] * len(ALBUM_KEYS_ITEM)))
@@ -1772,78 +2515,238 @@ class Library(object):
             album_id = tx.mutate(sql, subvals)
 
             # Add the items to the library.
+            new_items = []
             for item in items:
                 item.album_id = album_id
                 if item.id is None:
-                    self.add(item)
+                    new_items.append(item)
                 else:
                     item.store()
+            self.add_many(new_items)
 
-        # Construct the new Album object.
-        album_values['id'] = album_id
-        album = Album(self, **album_values)
+            # Construct the new Album object.
+            album_values['id'] = album_id
+            album = Album(self, **album_values)
+            self._touch(album, True)
+
+        self._uncache(Album, album_id)
+        self._album_changed(album_id)
         return album
 
 
+    # Destinations.
+
+    def _compile_path_formats(self, path_formats):
+        """Parse a list of (query, path format) pairs. Returns a list of
+        (Query, Template) pairs for the formats that have a query, in
+        order, and the Template for the default format (or None). The
+        result is cached for each list of formats.
+        """
+        key = tuple(path_formats)
+        try:
+            return self._path_format_cache[key]
+        except (KeyError, TypeError):
+            pass
+
+        conditional = []
+        default = None
+        for query, path_format in path_formats:
+            if not isinstance(path_format, Template):
+                path_format = Template(path_format)
+            if query != PF_KEY_DEFAULT:
+                conditional.append((AndQuery.from_string(query),
+                                    path_format))
+            elif default is None:
+                default = path_format
+        compiled = conditional, default
+
+        try:
+            if len(self._path_format_cache) >= 20:
+                self._path_format_cache.clear()
+            self._path_format_cache[key] = compiled
+        except TypeError:
+            # Unhashable formats. Don't cache.
+            pass
+        return compiled
+
+    def _max_filename_length(self, basedir):
+        """Get the maximum length of a filename under `basedir`. This
+        is the `max_filename_length` configuration value or, when that
+        is zero, the limit of the filesystem, which is determined once
+        per base directory. If the base directory does not exist yet,
+        the library directory's filesystem is used.
+        """
+        maxlen = beets.config['max_filename_length'].get(int)
+        if maxlen:
+            return maxlen
+        try:
+            return self._maxlen_cache[basedir]
+        except KeyError:
+            pass
+
+        if os.path.isdir(syspath(basedir)):
+            maxlen = util.max_filename_length(basedir)
+        else:
+            maxlen = util.max_filename_length(self.directory)
+        self._maxlen_cache[basedir] = maxlen
+        return maxlen
+
+    def destinations(self, items, pathmod=None, fragment=False,
+                     basedir=None, platform=None, path_formats=None):
+        """Compute the destination paths (see :meth:`Item.destination`)
+        for a sequence of items, which must belong to this library.
+        The items' albums are fetched together, once each. Returns a
+        list of paths in the same order as the items.
+        """
+        items = list(items)
+
+        # Fetch all the albums at once.
+        albums = {}
+        album_ids = list(set(item.album_id for item in items
+                             if item.album_id is not None))
+        for start in range(0, len(album_ids), Results.flex_batch_size):
+            batch = album_ids[start:start + Results.flex_batch_size]
+            where = 'id IN ({0})'.format(','.join(['?'] * len(batch)))
+            for album in Results(Album, self, where, batch):
+                albums[album.id] = album
+
+        return [item.destination(pathmod, fragment, basedir, platform,
+                                 path_formats, albums.get(item.album_id))
+                for item in items]
+
+
     # Querying.
 
-    def _fetch(self, model_cls, query, order_by=None):
+    def _fetch(self, model_cls, query, order_by=None, stream=False):
         """Fetch the objects of type `model_cls` matching the given
         query. The query may be given as a string, string sequence, a
         Query object, or None (to fetch everything). If provided,
-        `order_by` is a SQLite ORDER BY clause for sorting.
+        `order_by` is a SQLite ORDER BY clause for sorting. `stream`
+        requests a :class:`Results` object that reads its rows in
+        batches instead of all at once.
         """
-        query = get_query(query, model_cls)
-        where, subvals = query.clause()
-
-        sql = "SELECT * FROM {0} WHERE {1}".format(
-            model_cls._table,
-            where or '1',
-        )
-        if order_by:
-            sql += " ORDER BY {0}".format(order_by)
-        with self.transaction() as tx:
-            rows = tx.query(sql, subvals)
+        query = get_query(query, model_cls, self.fts)
+        where, subvals, slow_query = query.split_clause(model_cls)
+        return Results(model_cls, self, where, subvals, order_by,
+                       slow_query, stream=stream)
 
-        return Results(model_cls, rows, self, None if where else query)
-
-    def albums(self, query=None):
+    def albums(self, query=None, stream=False):
         """Get a sorted list of :class:`Album` objects matching the
-        given query.
+        given query. If `stream` is set, the albums are read from the
+        database in batches as the result is iterated.
         """
         order = '{0}, album'.format(
             _orelse("albumartist_sort", "albumartist")
         )
-        return self._fetch(Album, query, order)
+        return self._fetch(Album, query, order, stream)
 
-    def items(self, query=None):
+    def items(self, query=None, stream=False):
         """Get a sorted list of :class:`Item` objects matching the given
-        query.
+        query. If `stream` is set, the items are read from the database
+        in batches as the result is iterated.
         """
         order = '{0}, album'.format(
             _orelse("artist_sort", "artist")
         )
-        return self._fetch(Item, query, order)
+        return self._fetch(Item, query, order, stream)
 
 
     # Convenience accessors.
 
-    def _get(self, model_cls, id):
+    def _get(self, model_cls, id, cached=True):
         """Get a LibModel object by its id or None if the id does not
-        exist.
-        """
-        return self._fetch(model_cls, MatchQuery('id', id)).get()
+        exist. If the library has an object cache, the object is shared
+        with other callers unless `cached` is False, in which case it is
+        always fetched from the database.
+        """
+        if cached and self._cache is not None:
+            obj = self._cache.get((model_cls, id))
+            if obj is not None:
+                return obj
+
+        obj = self._fetch(model_cls, MatchQuery('id', id)).get()
+        if cached and self._cache is not None and obj is not None:
+            self._cache[model_cls, id] = obj
+        return obj
+
+    def _uncache(self, model_cls, id):
+        """Drop the object of type `model_cls` with the given id from
+        the object cache (if any), so it is fetched again next time.
+        """
+        if self._cache is not None:
+            self._cache.pop((model_cls, id))
+
+    def _touch(self, obj, synced=False):
+        """Record in the change tracking that the database row of `obj`
+        was just written, or removed, through `obj`. Must be called in
+        the writing transaction. The object matches the row afterward
+        if `synced` is set (it wrote the whole row) or if nothing else
+        changed the row since the object last matched it.
+        """
+        key = (type(obj), obj.id)
+        if synced or self._row_version(*key) <= obj._version:
+            obj._version = self._version
+
+        self._row_versions.pop(key, None)
+        self._row_versions[key] = self._version
+        if len(self._row_versions) > ROW_VERSIONS_SIZE:
+            _, version = self._row_versions.popitem(last=False)
+            self._untracked_version = max(self._untracked_version, version)
+
+    def _row_version(self, model_cls, id):
+        """Get the write count at which the row of the given model
+        class and id may last have changed.
+        """
+        return max(self._untracked_version,
+                   self._row_versions.get((model_cls, id), 0))
+
+    def _album_changed(self, album_id):
+        """Note that the album with the given id was added, changed, or
+        removed so that derived data (the %aunique tables) is updated.
+        """
+        with self._aunique_lock:
+            for table in self._aunique_tables.values():
+                table.invalidate(album_id)
+
+    def _aunique_table(self, keys, disam):
+        """Get the :class:`AlbumDisambiguation` for the given key and
+        disambiguator field lists, building it if necessary.
+        """
+        spec = (tuple(keys), tuple(disam))
+        with self._aunique_lock:
+            table = self._aunique_tables.get(spec)
+            if table is None:
+                table = AlbumDisambiguation(self, keys, disam)
+                self._aunique_tables[spec] = table
+            return table
+
+    def cache_info(self):
+        """Get statistics about the object cache as a dictionary with
+        the keys `hits`, `misses`, `size` (the number of objects
+        currently cached) and `maxsize`. Returns None if the library
+        does not cache objects.
+        """
+        if self._cache is None:
+            return None
+        return {
+            'hits': self._cache.hits,
+            'misses': self._cache.misses,
+            'size': len(self._cache),
+            'maxsize': self._cache.size,
+        }
 
     def get_item(self, id):
         """Fetch an :class:`Item` by its ID. Returns `None` if no match is
-        found.
+        found. If the library caches objects, the returned item may be
+        shared with other callers.
         """
         return self._get(Item, id)
 
     def get_album(self, item_or_id):
         """Given an album ID or an item associated with an album, return
         an :class:`Album` object for the album. If no such album exists,
-        returns `None`.
+        returns `None`. If the library caches objects, the returned album
+        may be shared with other callers.
         """
         if isinstance(item_or_id, int):
             album_id = item_or_id
@@ -1865,6 +2768,359 @@ def _int_arg(s):
     return int(s.strip())
 
 
+class AlbumDisambiguation(object):
+    """Precomputed disambiguation strings for the %aunique template
+    function. Albums are grouped by the values of their `keys` fields;
+    in every group of more than one album, the first of the `disam`
+    fields whose values differ for all albums in the group is chosen to
+    tell them apart. Fields may be flexible attributes, which are joined
+    in from the attribute table; albums without the attribute have a
+    null value.
+
+    The whole table is built with a single grouped query the first time
+    it is used. When albums change, only the groups they belonged to and
+    now belong to are recomputed, the next time the table is used. The
+    table's lock is never held while the database is queried, so
+    albums can be invalidated from inside a transaction.
+    """
+    def __init__(self, lib, keys, disam):
+        self.lib = lib
+        self.keys = [str(k) for k in keys]
+        self.disam = [str(d) for d in disam]
+        self.flex = []  # Fields that are not columns, in join order.
+        for field in self.keys + self.disam:
+            if field not in ALBUM_KEYS and field != 'id' and \
+                    field not in self.flex:
+                self.flex.append(field)
+        self.groups = {}  # Album id -> tuple of key values.
+        self.choices = {}  # Album id -> None or (field, value).
+        self.stale = {}  # Album id -> epoch of its latest change.
+        self._built = False
+        self._epoch = 0  # Counts invalidations.
+        self._merged = 0  # The epoch of the latest merged results.
+        self._lock = threading.Lock()
+
+    def _column(self, field):
+        """Get the SQL expression for a field's value in a query whose
+        FROM clause comes from `_from_clause`.
+        """
+        if field in self.flex:
+            return 'flex{0}.value'.format(self.flex.index(field))
+        return 'albums.{0}'.format(field)
+
+    def _from_clause(self):
+        """Get the FROM clause that joins each flexible attribute field
+        to the albums table, and its substitution values.
+        """
+        clause = 'albums'
+        for i in range(len(self.flex)):
+            clause += ' LEFT JOIN {0} AS flex{1} ON ' \
+                      'flex{1}.entity_id = albums.id AND flex{1}.key = ?' \
+                      .format(Album._flex_table, i)
+        return clause, list(self.flex)
+
+    def _compute_groups(self, tx, group_keys=None):
+        """Compute the entries for the albums in the given groups (a
+        collection of key value tuples) or for all albums. Returns the
+        groups and choices dictionaries for the albums found.
+        """
+        groups = {}
+        choices = {}
+        key_columns = [self._column(k) for k in self.keys]
+        columns = key_columns + ['COUNT(*)', 'group_concat(albums.id)']
+        for field in self.disam:
+            # Count NULL as a distinct value, as Python would.
+            columns.append('COUNT(DISTINCT {0}) + MAX({0} IS NULL)'
+                           .format(self._column(field)))
+        from_clause, subvals = self._from_clause()
+        sql = 'SELECT {0} FROM {1}'.format(', '.join(columns), from_clause)
+        if self.keys:
+            where = ' AND '.join('{0} IS ?'.format(c) for c in key_columns)
+            group_by = ' GROUP BY {0}'.format(', '.join(key_columns))
+        else:
+            # All albums are in a single group.
+            where = '1'
+            group_by = ''
+
+        rows = []
+        if group_keys is None:
+            rows = tx.query(sql + group_by, subvals)
+        else:
+            for group_key in group_keys:
+                rows += tx.query(sql + ' WHERE ' + where + group_by,
+                                 subvals + list(group_key))
+
+        ambiguous = {}  # Album id -> disambiguating field.
+        nkeys = len(self.keys)
+        for row in rows:
+            row = tuple(row)
+            group_key = row[:nkeys]
+            count, ids = row[nkeys], row[nkeys + 1]
+            if not count:
+                continue
+            ids = [int(i) for i in str(ids).split(',')]
+            for album_id in ids:
+                groups[album_id] = group_key
+                choices[album_id] = None
+            if count == 1:
+                continue
+
+            # Find the first disambiguator that distinguishes the
+            # albums. If none does, fall back to the album IDs.
+            distinct = row[nkeys + 2:]
+            for field, num_values in zip(self.disam, distinct):
+                if num_values == count:
+                    break
+            else:
+                field = 'id'
+            for album_id in ids:
+                ambiguous[album_id] = field
+
+        # Fetch the disambiguating values.
+        ids = ambiguous.keys()
+        fields = sorted(set(ambiguous.values()))
+        columns = ', '.join(self._column(f) for f in fields)
+        for start in range(0, len(ids), Results.flex_batch_size):
+            batch = ids[start:start + Results.flex_batch_size]
+            rows = tx.query(
+                'SELECT albums.id, {0} FROM {1} '
+                'WHERE albums.id IN ({2})'.format(
+                    columns, from_clause, ','.join(['?'] * len(batch))
+                ),
+                subvals + batch
+            )
+            for row in rows:
+                album_id = row[0]
+                field = ambiguous[album_id]
+                choices[album_id] = (field, row[fields.index(field) + 1])
+
+        return groups, choices
+
+    def _current_keys(self, tx, album_ids):
+        """Get the key value tuples of the groups that the given albums
+        belong to now.
+        """
+        if not self.keys:
+            return set([()])
+        group_keys = set()
+        columns = ', '.join(self._column(k) for k in self.keys)
+        from_clause, subvals = self._from_clause()
+        for start in range(0, len(album_ids), Results.flex_batch_size):
+            batch = album_ids[start:start + Results.flex_batch_size]
+            rows = tx.query(
+                'SELECT {0} FROM {1} WHERE albums.id IN ({2})'.format(
+                    columns, from_clause, ','.join(['?'] * len(batch))
+                ),
+                subvals + batch
+            )
+            group_keys.update(tuple(row) for row in rows)
+        return group_keys
+
+    def invalidate(self, album_id):
+        """Mark an album as added, changed, or removed.
+        """
+        with self._lock:
+            self._epoch += 1
+            self.stale[album_id] = self._epoch
+
+    def get(self, album_id):
+        """Get the disambiguation for an album: None if the album needs
+        none (or does not exist), or a (field, value) pair. The field is
+        "id" when no disambiguator field is sufficient.
+        """
+        # Find out what needs to be computed.
+        with self._lock:
+            if self._built and not self.stale:
+                return self.choices.get(album_id)
+            full = not self._built
+            epoch = self._epoch
+            stale = dict(self.stale)
+            group_keys = set(self.groups[i] for i in stale
+                             if i in self.groups)
+
+        # Query the database without the lock.
+        with self.lib.transaction(read_only=True) as tx:
+            if full:
+                groups, choices = self._compute_groups(tx)
+            else:
+                group_keys.update(self._current_keys(tx, list(stale)))
+                groups, choices = self._compute_groups(tx, group_keys)
+
+        # Merge the results, unless another thread has already merged
+        # newer ones (which include all of these changes).
+        with self._lock:
+            if epoch >= self._merged:
+                self._merged = epoch
+                if full:
+                    self.groups, self.choices = groups, choices
+                    self._built = True
+                else:
+                    for other_id, group_key in self.groups.items():
+                        if group_key in group_keys:
+                            del self.groups[other_id]
+                            del self.choices[other_id]
+                    for other_id in stale:
+                        self.groups.pop(other_id, None)
+                        self.choices.pop(other_id, None)
+                    self.groups.update(groups)
+                    self.choices.update(choices)
+                # Albums that changed again meanwhile stay stale.
+                for other_id, changed in stale.items():
+                    if self.stale.get(other_id) == changed:
+                        del self.stale[other_id]
+
+        if full or album_id in stale or album_id in groups:
+            return choices.get(album_id)
+        with self._lock:
+            return self.choices.get(album_id)
+
+
+class TemplateFormatter(object):
+    """Evaluates a Template object for any number of items or albums.
+    The variables the template refers to are determined once, so only
+    those fields (and plugin-computed fields) are computed for each
+    object, and an item's album is reused for the following tracks from
+    the same album. If `sanitize`, item values are sanitized for
+    inclusion in a file path.
+    """
+    def __init__(self, template, sanitize=False, pathmod=None):
+        self.template = template
+        self.sanitize = sanitize
+        self.pathmod = pathmod or os.path
+        self.varnames = template.varnames
+
+        # The artist and album artist fall back to each other, so each
+        # needs the other's value.
+        keys = set(self.varnames)
+        if 'artist' in keys or 'albumartist' in keys:
+            keys.update(('artist', 'albumartist'))
+        self.item_keys = [key for key in ITEM_KEYS
+                          if key in keys and key != 'path']
+
+        # Plugin-defined fields that appear in the template.
+        self.item_getters = {}
+        for name, func in plugins.template_field_getters().items():
+            if name in self.varnames:
+                self.item_getters[name] = func
+        self.album_getters = {}
+        for name, func in plugins.album_template_field_getters().items():
+            if name in self.varnames:
+                self.album_getters[name] = func
+
+        # Items only need to look up their album for album-level fields.
+        self.needs_album = bool(self.album_getters) or \
+            any(key in ALBUM_KEYS_ITEM for key in self.item_keys)
+        self._album = None
+
+        # Template functions that do not depend on the object.
+        if template.funcnames:
+            self.plugin_funcs = plugins.template_funcs()
+            self.album_funcs = DefaultTemplateFunctions().functions()
+            self.album_funcs.update(self.plugin_funcs)
+        else:
+            self.plugin_funcs = self.album_funcs = {}
+
+    def format(self, obj, album=None):
+        """Evaluate the template for an Item or an Album, returning a
+        Unicode string. For an item, `album` may be given to supply its
+        album when it is already known; otherwise, it is looked up if
+        the template needs it.
+        """
+        if isinstance(obj, Album):
+            mapping = self._album_mapping(obj)
+            funcs = self.album_funcs
+        else:
+            mapping = self._item_mapping(obj, album)
+            if self.template.funcnames:
+                funcs = DefaultTemplateFunctions(obj, obj._lib,
+                                                 self.pathmod).functions()
+                funcs.update(self.plugin_funcs)
+            else:
+                funcs = {}
+        return self.template.substitute(mapping, funcs)
+
+    def _get_album(self, item):
+        """Get the item's Album, reusing the previous item's album when
+        the two tracks belong to the same one.
+        """
+        if item.album_id is None or not item._lib:
+            return None
+        if self._album is None or self._album.id != item.album_id or \
+                self._album._lib is not item._lib:
+            self._album = item._lib.get_album(item)
+        return self._album
+
+    def _item_mapping(self, item, album):
+        sanitize = self.sanitize
+        pathmod = self.pathmod
+        if album is None and self.needs_album:
+            album = self._get_album(item)
+
+        # Values from the database.
+        mapping = {}
+        for key in self.item_keys:
+            # Get the values from either the item or its album.
+            if key in ALBUM_KEYS_ITEM and album is not None:
+                value = album[key]
+            else:
+                value = item[key]
+            if sanitize:
+                value = format_for_path(value, key, pathmod)
+            mapping[key] = value
+
+        # Include the path if we're not sanitizing to construct a path.
+        if not sanitize and 'path' in self.varnames:
+            mapping['path'] = displayable_path(item.path)
+
+        # Use the album artist if the track artist is not set and
+        # vice-versa.
+        if 'artist' in mapping:
+            if not mapping['artist']:
+                mapping['artist'] = mapping['albumartist']
+            if not mapping['albumartist']:
+                mapping['albumartist'] = mapping['artist']
+
+        # Flexible attributes.
+        for key in self.varnames:
+            if key in item._values_flex:
+                value = item._values_flex[key]
+                if sanitize:
+                    value = format_for_path(value, None, pathmod)
+                mapping[key] = value
+
+        # Values from plugins.
+        for key, func in self.item_getters.items():
+            value = unicode(func(item))
+            if sanitize:
+                value = format_for_path(value, key, pathmod)
+            mapping[key] = value
+        if album:
+            for key, func in self.album_getters.items():
+                value = unicode(func(album))
+                if sanitize:
+                    value = format_for_path(value, key, pathmod)
+                mapping[key] = value
+
+        return mapping
+
+    def _album_mapping(self, album):
+        mapping = {}
+        for key in self.varnames:
+            if key == 'path':
+                mapping[key] = displayable_path(album.item_dir())
+            elif key in album:
+                value = format_for_path(album[key], key)
+                if key == 'artpath':
+                    value = displayable_path(value)
+                mapping[key] = value
+
+        # Values from plugins.
+        for key, func in self.album_getters.items():
+            mapping[key] = unicode(func(album))
+
+        return mapping
+
+
 class DefaultTemplateFunctions(object):
     """A container class for the default functions provided to path
     templates. These functions are contained in an object to provide
@@ -1952,63 +3208,28 @@ class DefaultTemplateFunctions(object):
         used. Both "keys" and "disam" should be given as
         whitespace-separated lists of field names.
         """
-        # Fast paths: no album, no item or library, or memoized value.
+        # Fast paths: no album, no item or library.
         if not self.item or not self.lib:
             return u''
         if self.item.album_id is None:
             return u''
-        memokey = ('aunique', keys, disam, self.item.album_id)
-        memoval = self.lib._memotable.get(memokey)
-        if memoval is not None:
-            return memoval
 
         keys = keys or 'albumartist album'
         disam = disam or 'albumtype year label catalognum albumdisambig'
-        keys = keys.split()
-        disam = disam.split()
+        table = self.lib._aunique_table(keys.split(), disam.split())
 
-        album = self.lib.get_album(self.item)
-        if not album:
-            # Do nothing for singletons.
-            self.lib._memotable[memokey] = u''
+        choice = table.get(self.item.album_id)
+        if choice is None:
+            # The album is unique (or it is a singleton).
             return u''
-
-        # Find matching albums to disambiguate with.
-        subqueries = []
-        for key in keys:
-            value = getattr(album, key)
-            subqueries.append(MatchQuery(key, value))
-        albums = self.lib.albums(AndQuery(subqueries))
-
-        # If there's only one album to matching these details, then do
-        # nothing.
-        if len(albums) == 1:
-            self.lib._memotable[memokey] = u''
-            return u''
-
-        # Find the first disambiguator that distinguishes the albums.
-        for disambiguator in disam:
-            # Get the value for each album for the current field.
-            disam_values = set([getattr(a, disambiguator) for a in albums])
-
-            # If the set of unique values is equal to the number of
-            # albums in the disambiguation set, we're done -- this is
-            # sufficient disambiguation.
-            if len(disam_values) == len(albums):
-                break
-
-        else:
+        disambiguator, value = choice
+        if disambiguator == 'id':
             # No disambiguator distinguished all fields.
-            res = u' {0}'.format(album.id)
-            self.lib._memotable[memokey] = res
-            return res
+            return u' {0}'.format(value)
 
         # Flatten disambiguation value into a string.
-        disam_value = format_for_path(getattr(album, disambiguator),
-                                      disambiguator, self.pathmod)
-        res = u' [{0}]'.format(disam_value)
-        self.lib._memotable[memokey] = res
-        return res
+        disam_value = format_for_path(value, disambiguator, self.pathmod)
+        return u' [{0}]'.format(disam_value)
 
 
 # Get the name of tmpl_* functions in the above class.
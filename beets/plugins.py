@@ -16,6 +16,8 @@
 
 import logging
 import traceback
+import threading
+import time
 from collections import defaultdict
 
 import beets
@@ -63,6 +65,13 @@ class BeetsPlugin(object):
         """
         return {}
 
+    def sql_functions(self):
+        """Should return a dict mapping names to Python functions that
+        are made available to SQLite. Queries can use these functions
+        in the clauses they generate.
+        """
+        return {}
+
     def track_distance(self, item, info):
         """Should return a Distance object to be added to the
         distance for every track comparison.
@@ -124,6 +133,7 @@ class BeetsPlugin(object):
         if cls.listeners is None:
             cls.listeners = defaultdict(list)
         cls.listeners[event].append(func)
+        _invalidate_tables()
 
     @classmethod
     def listen(cls, event):
@@ -143,6 +153,7 @@ class BeetsPlugin(object):
             if cls.listeners is None:
                 cls.listeners = defaultdict(list)
             cls.listeners[event].append(func)
+            _invalidate_tables()
             return func
         return helper
 
@@ -160,6 +171,7 @@ class BeetsPlugin(object):
             if cls.template_funcs is None:
                 cls.template_funcs = {}
             cls.template_funcs[name] = func
+            _invalidate_tables()
             return func
         return helper
 
@@ -174,6 +186,7 @@ class BeetsPlugin(object):
             if cls.template_fields is None:
                 cls.template_fields = {}
             cls.template_fields[name] = func
+            _invalidate_tables()
             return func
         return helper
 
@@ -200,6 +213,7 @@ def load_plugins(names=()):
                     if isinstance(obj, type) and issubclass(obj, BeetsPlugin) \
                             and obj != BeetsPlugin:
                         _classes.append(obj)
+                        _invalidate_tables()
 
         except:
             log.warn('** error loading plugin %s' % name)
@@ -217,10 +231,65 @@ def find_plugins():
         # Only instantiate each plugin class once.
         if cls not in _instances:
             _instances[cls] = cls()
+            _invalidate_tables()
         plugins.append(_instances[cls])
     return plugins
 
 
+# Dispatch tables. Events, template functions, and template fields are
+# looked up very often, so the contributions of all plugins are merged
+# once and the merged tables are reused until a plugin, listener, or
+# template function is registered.
+
+_tables = None
+
+def _invalidate_tables():
+    """Discard the dispatch tables so they are rebuilt on next use.
+    """
+    global _tables
+    _tables = None
+
+def _dispatch_tables():
+    """Get the merged dispatch tables for all loaded plugins, building
+    them if necessary. The result is a dictionary with the keys
+    "handlers" (event names to tuples of callables), "template_funcs",
+    "template_fields", "album_template_fields", and "sql_functions".
+    The tables are shared and must not be modified; a new set is built
+    whenever plugins change.
+    """
+    global _tables
+    tables = _tables
+    if tables is None:
+        handlers = defaultdict(list)
+        funcs = {}
+        fields = {}
+        album_fields = {}
+        sql_funcs = {}
+        for plugin in find_plugins():
+            if plugin.listeners:
+                for event, funcs_for_event in plugin.listeners.items():
+                    handlers[event] += funcs_for_event
+            if plugin.template_funcs:
+                funcs.update(plugin.template_funcs)
+            if plugin.template_fields:
+                fields.update(plugin.template_fields)
+            if plugin.album_template_fields:
+                album_fields.update(plugin.album_template_fields)
+            sql_funcs.update(plugin.sql_functions())
+
+        tables = {
+            'handlers': defaultdict(tuple, ((event, tuple(funcs_for_event))
+                                            for event, funcs_for_event
+                                            in handlers.items())),
+            'template_funcs': funcs,
+            'template_fields': fields,
+            'album_template_fields': album_fields,
+            'sql_functions': sql_funcs,
+        }
+        _tables = tables
+    return tables
+
+
 # Communication with plugins.
 
 def commands():
@@ -240,6 +309,14 @@ def queries():
         out.update(plugin.queries())
     return out
 
+def sql_functions():
+    """Returns a dict mapping names to functions that should be
+    registered with SQLite, gathered from all loaded plugins. The same
+    dict is returned until the loaded plugins change; it must not be
+    modified.
+    """
+    return _dispatch_tables()['sql_functions']
+
 def track_distance(item, info):
     """Gets the track distance calculated by all loaded plugins.
     Returns a Distance object.
@@ -301,33 +378,40 @@ def configure(config):
 
 def template_funcs():
     """Get all the template functions declared by plugins as a
-    dictionary.
+    dictionary. The dictionary is shared and must not be modified.
     """
-    funcs = {}
-    for plugin in find_plugins():
-        if plugin.template_funcs:
-            funcs.update(plugin.template_funcs)
-    return funcs
+    return _dispatch_tables()['template_funcs']
+
+def template_field_getters():
+    """Get a dictionary mapping the names of plugin-defined item
+    template fields to the functions that compute them. When several
+    plugins define the same field, the last one wins. The dictionary is
+    shared and must not be modified.
+    """
+    return _dispatch_tables()['template_fields']
+
+def album_template_field_getters():
+    """Get a dictionary mapping the names of plugin-defined album
+    template fields to the functions that compute them. The dictionary
+    is shared and must not be modified.
+    """
+    return _dispatch_tables()['album_template_fields']
 
 def template_values(item):
     """Get all the template values computed for a given Item by
     registered field computations.
     """
     values = {}
-    for plugin in find_plugins():
-        if plugin.template_fields:
-            for name, func in plugin.template_fields.iteritems():
-                values[name] = unicode(func(item))
+    for name, func in template_field_getters().iteritems():
+        values[name] = unicode(func(item))
     return values
 
 def album_template_values(album):
     """Get the plugin-defined template values for an Album.
     """
     values = {}
-    for plugin in find_plugins():
-        if plugin.album_template_fields:
-            for name, func in plugin.album_template_fields.iteritems():
-                values[name] = unicode(func(album))
+    for name, func in album_template_field_getters().iteritems():
+        values[name] = unicode(func(album))
     return values
 
 def _add_media_fields(fields):
@@ -350,14 +434,28 @@ def import_stages():
 
 def event_handlers():
     """Find all event handlers from plugins as a dictionary mapping
-    event names to sequences of callables.
+    event names to sequences of callables. The dictionary is shared and
+    must not be modified.
     """
-    all_handlers = defaultdict(list)
-    for plugin in find_plugins():
-        if plugin.listeners:
-            for event, handlers in plugin.listeners.items():
-                all_handlers[event] += handlers
-    return all_handlers
+    return _dispatch_tables()['handlers']
+
+# Timing counters for events and their handlers: map event names and
+# (event name, handler name) pairs to [calls, total seconds] lists.
+_event_timings = defaultdict(lambda: [0, 0.0])
+_handler_timings = defaultdict(lambda: [0, 0.0])
+_timings_lock = threading.Lock()
+
+def _handler_name(handler):
+    """Get a readable name for an event handler function or method.
+    """
+    name = getattr(handler, '__name__', None) or repr(handler)
+    cls = getattr(handler, 'im_class', None)
+    if cls is not None:
+        name = '{0}.{1}'.format(cls.__name__, name)
+    module = getattr(handler, '__module__', None)
+    if module:
+        name = '{0}.{1}'.format(module, name)
+    return name
 
 def send(event, **arguments):
     """Sends an event to all assigned event listeners. Event is the
@@ -367,7 +465,62 @@ def send(event, **arguments):
     Returns the number of handlers called.
     """
     log.debug('Sending event: %s' % event)
-    handlers = event_handlers()[event]
+    handlers = _dispatch_tables()['handlers'].get(event, ())
+    if not handlers:
+        return 0
+
+    durations = []
     for handler in handlers:
+        start = time.time()
         handler(**arguments)
+        durations.append((handler, time.time() - start))
+
+    with _timings_lock:
+        event_timing = _event_timings[event]
+        event_timing[0] += 1
+        for handler, duration in durations:
+            event_timing[1] += duration
+            handler_timing = _handler_timings[event, _handler_name(handler)]
+            handler_timing[0] += 1
+            handler_timing[1] += duration
     return len(handlers)
+
+def event_timings():
+    """Get the timing counters for events sent so far. Returns a pair
+    of lists, sorted by decreasing total time: (event, calls, seconds)
+    triples for each event and (event, handler, calls, seconds) tuples
+    for each handler.
+    """
+    with _timings_lock:
+        events = [(event, calls, secs) for event, (calls, secs)
+                  in _event_timings.items()]
+        handlers = [(event, name, calls, secs)
+                    for (event, name), (calls, secs)
+                    in _handler_timings.items()]
+    events.sort(key=lambda t: t[-1], reverse=True)
+    handlers.sort(key=lambda t: t[-1], reverse=True)
+    return events, handlers
+
+def reset_timings():
+    """Clear the event timing counters.
+    """
+    with _timings_lock:
+        _event_timings.clear()
+        _handler_timings.clear()
+
+def timing_report():
+    """Describe the event timing counters as a list of lines of text,
+    slowest first.
+    """
+    events, handlers = event_timings()
+    lines = []
+    for event, calls, secs in events:
+        lines.append(u'event {0}: {1} calls, {2:.3f}s'.format(
+            event, calls, secs
+        ))
+        for h_event, name, h_calls, h_secs in handlers:
+            if h_event == event:
+                lines.append(u'  {0}: {1} calls, {2:.3f}s'.format(
+                    name, h_calls, h_secs
+                ))
+    return lines
@@ -472,6 +472,20 @@ def get_replacements():
             ))
     return replacements
 
+def get_indexes():
+    """Get the user-declared database indexes from the configuration as
+    a list of (table, columns) pairs. Each index is given as a field
+    name, a whitespace-separated list of field names, or a list of
+    field names.
+    """
+    indexes = []
+    for table in ('items', 'albums'):
+        for index in config['indexes'][table].get(list):
+            if isinstance(index, basestring):
+                index = index.split()
+            indexes.append((table, tuple(index)))
+    return indexes
+
 def get_plugin_paths():
     """Get the list of search paths for plugins from the config file.
     The value for "pluginpath" may be a single string or a list of
@@ -509,6 +523,39 @@ def print_obj(obj, lib, fmt=None):
         template = Template(fmt)
     print_(obj.evaluate_template(template))
 
+# The number of bytes of output collected by `print_objs` before it is
+# written to stdout.
+PRINT_BUFFER_SIZE = 64 * 1024
+
+def print_objs(objs, lib, fmt=None, album=False):
+    """Print a sequence of Album objects (if `album`) or Item objects
+    using the format string `fmt` or the configured template. This is
+    much faster than calling `print_obj` on each object: only the
+    fields that the template uses are computed, album-level values are
+    shared by the tracks of an album, and output is written in large
+    chunks.
+    """
+    fmt = _pick_format(album, fmt)
+    if isinstance(fmt, Template):
+        template = fmt
+    else:
+        template = Template(fmt)
+    formatter = library.TemplateFormatter(template)
+    encoding = _encoding()
+
+    buf = []
+    size = 0
+    for obj in objs:
+        line = formatter.format(obj).encode(encoding, 'replace') + '\n'
+        buf.append(line)
+        size += len(line)
+        if size >= PRINT_BUFFER_SIZE:
+            sys.stdout.write(''.join(buf))
+            buf = []
+            size = 0
+    if buf:
+        sys.stdout.write(''.join(buf))
+
 def term_width():
     """Get the width (columns) of the terminal."""
     fallback = config['ui']['terminal_width'].get(int)
@@ -738,6 +785,10 @@ def _raw_main(args):
             config['directory'].as_filename(),
             get_path_formats(),
             get_replacements(),
+            indexes=get_indexes(),
+            fts=config['fts'].get(bool),
+            concurrent=config['concurrent_reads'].get(bool),
+            cache_size=config['object_cache'].get(int),
         )
     except sqlite3.OperationalError:
         raise UserError(u"database file {0} could not be opened".format(
@@ -765,6 +816,13 @@ def _raw_main(args):
     subcommand.func(lib, suboptions, subargs)
     plugins.send('cli_exit', lib=lib)
 
+    cache_info = lib.cache_info()
+    if cache_info:
+        log.debug(u'object cache: {0[hits]} hits, {0[misses]} misses'
+                  .format(cache_info))
+    for line in plugins.timing_report():
+        log.debug(u'plugin timing: ' + line)
+
 def main(args=None):
     """Run the main command-line interface for beets. Includes top-level
     exception handlers that print friendly error messages.
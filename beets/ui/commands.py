@@ -22,6 +22,7 @@ import os
 import time
 import itertools
 import codecs
+import json
 from datetime import datetime
 
 import beets
@@ -34,7 +35,7 @@ from beets import plugins
 from beets import importer
 from beets import util
 from beets.util import syspath, normpath, ancestry, displayable_path
-from beets.util.functemplate import Template
+from beets.util import pipeline
 from beets import library
 from beets import config
 
@@ -779,6 +780,9 @@ def import_files(lib, paths, query):
         config['import']['resume'] = False
 
     session = TerminalImportSession(lib, logfile, paths, query)
+    stats_file = config['import']['stats_file'].get()
+    if config['import']['stats'] or stats_file is not None:
+        session.stats = pipeline.PipelineStats()
     try:
         session.run()
     finally:
@@ -787,6 +791,19 @@ def import_files(lib, paths, query):
             print(u'', file=logfile)
             logfile.close()
 
+    # Report the time spent in each pipeline stage.
+    if config['import']['stats']:
+        for line in session.stats.report():
+            print_(line)
+    if stats_file is not None:
+        stats_path = config['import']['stats_file'].as_filename()
+        try:
+            with open(syspath(stats_path), 'w') as f:
+                json.dump(session.stats.summary(), f, indent=2)
+        except IOError:
+            raise ui.UserError(u"could not write statistics file: %s" %
+                               displayable_path(stats_path))
+
     # Emit event.
     plugins.send('import', lib=lib, paths=paths)
 
@@ -796,6 +813,8 @@ import_cmd.parser.add_option('-c', '--copy', action='store_true',
     default=None, help="copy tracks into library directory (default)")
 import_cmd.parser.add_option('-C', '--nocopy', action='store_false',
     dest='copy', help="don't copy tracks (opposite of -c)")
+import_cmd.parser.add_option('--link', action='store_true', default=None,
+    help="hard link tracks into library directory instead of copying")
 import_cmd.parser.add_option('-w', '--write', action='store_true',
     default=None, help="write new metadata to files' tags (default)")
 import_cmd.parser.add_option('-W', '--nowrite', action='store_false',
@@ -825,13 +844,20 @@ import_cmd.parser.add_option('-I', '--noincremental', dest='incremental',
     action='store_false', help='do not skip already-imported directories')
 import_cmd.parser.add_option('--flat', dest='flat',
     action='store_true', help='import an entire tree as a single album')
+import_cmd.parser.add_option('--stats', dest='stats', action='store_true',
+    help='show the time spent in each importer stage')
+import_cmd.parser.add_option('--stats-file', dest='stats_file',
+    help='write importer stage statistics to a JSON file')
 def import_func(lib, opts, args):
     config['import'].set_args(opts)
 
-    # Special case: --copy flag suppresses import_move (which would
-    # otherwise take precedence).
+    # Special case: --copy and --link flags suppress import_move (which
+    # would otherwise take precedence).
     if opts.copy:
         config['import']['move'] = False
+        config['import']['link'] = False
+    if opts.link:
+        config['import']['move'] = False
 
     if opts.library:
         query = decargs(args)
@@ -853,13 +879,11 @@ def list_items(lib, query, album, fmt):
     """Print out items in lib matching query. If album, then search for
     albums instead of single items.
     """
-    tmpl = Template(ui._pick_format(album, fmt))
     if album:
-        for album in lib.albums(query):
-            ui.print_obj(album, lib, tmpl)
+        objs = lib.albums(query, stream=True)
     else:
-        for item in lib.items(query):
-            ui.print_obj(item, lib, tmpl)
+        objs = lib.items(query, stream=True)
+    ui.print_objs(objs, lib, fmt, album)
 
 list_cmd = ui.Subcommand('list', help='query the library', aliases=('ls',))
 list_cmd.parser.add_option('-a', '--album', action='store_true',
@@ -1073,6 +1097,39 @@ stats_cmd.func = stats_func
 default_commands.append(stats_cmd)
 
 
+# index: Show database index usage.
+
+def show_indexes(lib, query, album):
+    """Show the database's indexes and how selective they are. If a
+    query is given, show how the database will evaluate it instead.
+    """
+    if query:
+        model_cls = library.Album if album else library.Item
+        plan, slow = lib.explain(model_cls, query)
+        for step in plan:
+            print_(step)
+        if slow:
+            print_('(part of the query is evaluated outside the database)')
+        return
+
+    for name, table, columns, per_key in lib.index_info():
+        if per_key is None:
+            usage = 'no statistics'
+        else:
+            usage = '{0} rows per key'.format(per_key)
+        print_(u'{0}: {1} ({2}) -- {3}'.format(name, table,
+                                               ', '.join(columns), usage))
+
+index_cmd = ui.Subcommand('index',
+    help='show database indexes or how a query uses them')
+index_cmd.parser.add_option('-a', '--album', action='store_true',
+    help='explain an album query instead of an item query')
+def index_func(lib, opts, args):
+    show_indexes(lib, decargs(args), opts.album)
+index_cmd.func = index_func
+default_commands.append(index_cmd)
+
+
 # version: Show current beets version.
 
 def show_version(lib, opts, args):
@@ -19,10 +19,34 @@ import os
 import sys
 import re
 import shutil
+import errno
 import fnmatch
 from collections import defaultdict
 import traceback
 import subprocess
+import threading
+from multiprocessing.pool import ThreadPool
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+if sys.platform.startswith('linux'):
+    import ctypes
+    import ctypes.util
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        _libc = None
+else:
+    _libc = None
 
 MAX_FILENAME_LENGTH = 200
 WINDOWS_MAGIC_PREFIX = u'\\\\?\\'
@@ -93,7 +117,7 @@ class FilesystemError(HumanReadableException):
 
     def get_message(self):
         # Use a nicer English phrasing for some specific verbs.
-        if self.verb in ('move', 'copy', 'rename'):
+        if self.verb in ('move', 'copy', 'rename', 'link'):
             clause = 'while {0} {1} to {2}'.format(
                 self._gerund(), repr(self.paths[0]), repr(self.paths[1])
             )
@@ -139,56 +163,148 @@ def ancestry(path, pathmod=None):
             out.insert(0, path)
     return out
 
-def sorted_walk(path, ignore=(), logger=None):
+def ignore_regex(ignore):
+    """Compile a sequence of glob patterns into one regular expression
+    object that matches the names matched by any of them (as
+    `fnmatch.fnmatch` would). Returns None if there are no patterns.
+    The result is cached.
+    """
+    ignore = tuple(ignore)
+    try:
+        return _ignore_regexes[ignore]
+    except KeyError:
+        pass
+    if ignore:
+        regex = re.compile('|'.join(
+            '(?:{0})'.format(fnmatch.translate(os.path.normcase(pat)))
+            for pat in ignore
+        ))
+    else:
+        regex = None
+    if len(_ignore_regexes) >= 20:
+        _ignore_regexes.clear()
+    _ignore_regexes[ignore] = regex
+    return regex
+_ignore_regexes = {}
+
+def _list_dir(path, ignore_re):
+    """Get the subdirectories and files in the directory `path` as two
+    lists of names sorted case-insensitively, skipping names matched by
+    the regular expression `ignore_re`. Uses the `scandir` module, when
+    available, to learn which entries are directories without a `stat`
+    call for each.
+    """
+    dirs = []
+    files = []
+    if scandir is not None:
+        for entry in scandir(syspath(path)):
+            base = bytestring_path(entry.name)
+            if ignore_re and ignore_re.match(os.path.normcase(base)):
+                continue
+            if entry.is_dir():
+                dirs.append(base)
+            else:
+                files.append(base)
+    else:
+        for base in os.listdir(syspath(path)):
+            base = bytestring_path(base)
+            if ignore_re and ignore_re.match(os.path.normcase(base)):
+                continue
+            if os.path.isdir(syspath(os.path.join(path, base))):
+                dirs.append(base)
+            else:
+                files.append(base)
+    dirs.sort(key=bytes.lower)
+    files.sort(key=bytes.lower)
+    return dirs, files
+
+def _list_dir_cached(path, ignore_re, mtimes):
+    """Like `_list_dir`, but consults and updates the `mtimes`
+    dictionary, which maps directory paths to (mtime, dirs) pairs from
+    a previous walk. Returns (dirs, files, unchanged); if the directory
+    has not been modified since it was recorded, the recorded
+    subdirectories are returned without listing it again and `files`
+    is None.
+    """
+    mtime = os.stat(syspath(path)).st_mtime
+    recorded = mtimes.get(path)
+    if recorded and recorded[0] == mtime:
+        return recorded[1], None, True
+    dirs, files = _list_dir(path, ignore_re)
+    mtimes[path] = (mtime, dirs)
+    return dirs, files, False
+
+def sorted_walk(path, ignore=(), logger=None, workers=1, mtimes=None):
     """Like `os.walk`, but yields things in case-insensitive sorted,
-    breadth-first order.  Directory and file names matching any glob
+    depth-first order.  Directory and file names matching any glob
     pattern in `ignore` are skipped. If `logger` is provided, then
     warning messages are logged there when a directory cannot be listed.
+
+    With more than one worker, the listings of upcoming directories are
+    read ahead by a pool of `workers` threads; the output order is the
+    same. If `mtimes` is a dictionary, the walk records each
+    directory's modification time (and subdirectories) in it. On a
+    later walk with the same dictionary, directories whose
+    modification time has not changed are not yielded and not listed
+    again, but their recorded subdirectories are still walked.
     """
     # Make sure the path isn't a Unicode string.
     path = bytestring_path(path)
+    ignore_re = ignore_regex(ignore)
 
-    # Get all the directories and files at this level.
-    try:
-        contents = os.listdir(syspath(path))
-    except OSError as exc:
-        if logger:
-            logger.warn(u'could not list directory {0}: {1}'.format(
-                displayable_path(path), exc.strerror
-            ))
-        return
-    dirs = []
-    files = []
-    for base in contents:
-        base = bytestring_path(base)
-
-        # Skip ignored filenames.
-        skip = False
-        for pat in ignore:
-            if fnmatch.fnmatch(base, pat):
-                skip = True
-                break
-        if skip:
-            continue
+    def list_dir(path):
+        if mtimes is None:
+            dirs, files = _list_dir(path, ignore_re)
+            return dirs, files, False
+        return _list_dir_cached(path, ignore_re, mtimes)
 
-        # Add to output as either a file or a directory.
-        cur = os.path.join(path, base)
-        if os.path.isdir(syspath(cur)):
-            dirs.append(base)
-        else:
-            files.append(base)
+    if workers > 1:
+        pool = ThreadPool(workers)
+        limit = workers * 16
+    else:
+        pool = None
 
-    # Sort lists (case-insensitive) and yield the current level.
-    dirs.sort(key=bytes.lower)
-    files.sort(key=bytes.lower)
-    yield (path, dirs, files)
+    # The directories still to be visited; the last is visited first.
+    # Each is a [path, listing] pair, where listing is None or a pending
+    # result from the pool.
+    stack = [[path, None]]
+    outstanding = 0
+    try:
+        while stack:
+            cur, pending = stack.pop()
 
-    # Recurse into directories.
-    for base in dirs:
-        cur = os.path.join(path, base)
-        # yield from sorted_walk(...)
-        for res in sorted_walk(cur, ignore, logger):
-            yield res
+            # Get all the directories and files at this level.
+            try:
+                if pending is not None:
+                    outstanding -= 1
+                    dirs, files, unchanged = pending.get()
+                else:
+                    dirs, files, unchanged = list_dir(cur)
+            except OSError as exc:
+                if logger:
+                    logger.warn(u'could not list directory {0}: {1}'.format(
+                        displayable_path(cur), exc.strerror
+                    ))
+                continue
+
+            if not unchanged:
+                yield (cur, dirs, files)
+
+            # Visit the subdirectories next, in order.
+            for base in reversed(dirs):
+                stack.append([os.path.join(cur, base), None])
+
+            # Start listing the directories that will be visited soonest.
+            if pool:
+                for entry in reversed(stack):
+                    if outstanding >= limit:
+                        break
+                    if entry[1] is None:
+                        entry[1] = pool.apply_async(list_dir, (entry[0],))
+                        outstanding += 1
+    finally:
+        if pool:
+            pool.terminate()
 
 def mkdirall(path):
     """Make all the enclosing directories of path (like mkdir -p on the
@@ -199,8 +315,10 @@ def mkdirall(path):
             try:
                 os.mkdir(syspath(ancestor))
             except (OSError, IOError) as exc:
-                raise FilesystemError(exc, 'create', (ancestor,),
-                                      traceback.format_exc())
+                # Another thread may have just created it.
+                if not os.path.isdir(syspath(ancestor)):
+                    raise FilesystemError(exc, 'create', (ancestor,),
+                                          traceback.format_exc())
 
 def fnmatch_all(names, patterns):
     """Determine whether all strings in `names` match at least one of
@@ -383,11 +501,131 @@ def remove(path, soft=True):
     except (OSError, IOError) as exc:
         raise FilesystemError(exc, 'delete', (path,), traceback.format_exc())
 
+# Copying file contents. Each method copies everything from one open
+# file descriptor to another and raises an OSError or IOError when it
+# fails; errors in UNSUPPORTED_ERRNOS mean the method does not work for
+# these files, so the next one is tried.
+
+COPY_BUFSIZE = 1024 * 1024
+COPY_CHUNK = 1024 * 1024 * 1024
+FICLONE = 0x40049409  # Linux ioctl: share the source's data blocks.
+UNSUPPORTED_ERRNOS = frozenset(
+    getattr(errno, name) for name in
+    ('EOPNOTSUPP', 'ENOTSUP', 'ENOTTY', 'EXDEV', 'EINVAL', 'ENOSYS')
+    if hasattr(errno, name)
+)
+
+def _copy_reflink(infd, outfd):
+    """Clone the file on a copy-on-write filesystem (e.g., Btrfs or
+    XFS): the copy shares the original's storage until either changes.
+    """
+    fcntl.ioctl(outfd, FICLONE, infd)
+
+def _libc_error():
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+def _copy_file_range(infd, outfd):
+    """Copy the data inside the kernel, which lets some filesystems
+    (including network filesystems) copy it without transferring it.
+    """
+    while True:
+        count = _libc.copy_file_range(infd, None, outfd, None,
+                                      COPY_CHUNK, 0)
+        if count < 0:
+            raise _libc_error()
+        elif not count:
+            break
+
+def _copy_sendfile(infd, outfd):
+    """Copy the data inside the kernel, without reading it into Python.
+    """
+    while True:
+        count = _libc.sendfile(outfd, infd, None, COPY_CHUNK)
+        if count < 0:
+            raise _libc_error()
+        elif not count:
+            break
+
+def _copy_buffered(infd, outfd):
+    """Read the data and write it out again in large blocks.
+    """
+    while True:
+        buf = os.read(infd, COPY_BUFSIZE)
+        if not buf:
+            break
+        while buf:
+            buf = buf[os.write(outfd, buf):]
+
+def _copy_methods():
+    """Get the (name, function) pairs of the copy methods available on
+    this system, fastest first.
+    """
+    methods = []
+    if fcntl and sys.platform.startswith('linux'):
+        methods.append(('reflink', _copy_reflink))
+    if _libc is not None:
+        # Python 2.6 lacks c_ssize_t; on Linux, it is the size of a long.
+        ssize_t = getattr(ctypes, 'c_ssize_t', ctypes.c_long)
+        if hasattr(_libc, 'copy_file_range'):
+            _libc.copy_file_range.restype = ssize_t
+            _libc.copy_file_range.argtypes = [
+                ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint,
+            ]
+            methods.append(('copy_file_range', _copy_file_range))
+        if hasattr(_libc, 'sendfile'):
+            _libc.sendfile.restype = ssize_t
+            _libc.sendfile.argtypes = [
+                ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+            ]
+            methods.append(('sendfile', _copy_sendfile))
+    methods.append(('buffered', _copy_buffered))
+    return methods
+
+COPY_METHODS = _copy_methods()
+
+def copy_contents(path, dest, methods=None):
+    """Copy the contents of the file at `path` to a new or truncated
+    file at `dest` with the first of `methods` (by default,
+    `COPY_METHODS`) that works for them. Returns the name of the method
+    used. Paths must be system paths. Raises an OSError or IOError if
+    the copy fails.
+    """
+    methods = methods or COPY_METHODS
+    binary = getattr(os, 'O_BINARY', 0)
+    infd = os.open(path, os.O_RDONLY | binary)
+    try:
+        outfd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | binary,
+                        0666)
+        try:
+            for index, (name, func) in enumerate(methods):
+                try:
+                    func(infd, outfd)
+                    return name
+                except (OSError, IOError) as exc:
+                    if exc.errno not in UNSUPPORTED_ERRNOS or \
+                            index == len(methods) - 1:
+                        raise
+                # Start over with the next method.
+                os.lseek(infd, 0, os.SEEK_SET)
+                os.lseek(outfd, 0, os.SEEK_SET)
+                os.ftruncate(outfd, 0)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+
 def copy(path, dest, replace=False, pathmod=os.path):
     """Copy a plain file. Permissions are not copied. If `dest` already
     exists, raises a FilesystemError unless `replace` is True. Has no
     effect if `path` is the same as `dest`. Paths are translated to
     system paths before the syscall.
+
+    The fastest method that works for the files is used: a
+    copy-on-write clone, a copy inside the kernel, or a buffered copy
+    (see `COPY_METHODS`). Returns the name of the method, or None if
+    nothing needed to be copied.
     """
     if samefile(path, dest):
         return
@@ -396,7 +634,7 @@ def copy(path, dest, replace=False, pathmod=os.path):
     if not replace and pathmod.exists(dest):
         raise FilesystemError('file exists', 'copy', (path, dest))
     try:
-        shutil.copyfile(path, dest)
+        return copy_contents(path, dest)
     except (OSError, IOError) as exc:
         raise FilesystemError(exc, 'copy', (path, dest),
                               traceback.format_exc())
@@ -407,7 +645,8 @@ def move(path, dest, replace=False, pathmod=os.path):
     `path` is the same as `dest`. If the paths are on different
     filesystems (or the rename otherwise fails), a copy is attempted
     instead, in which case metadata will *not* be preserved. Paths are
-    translated to system paths.
+    translated to system paths. Returns 'rename' or, if the file was
+    copied, the copy method used (see `copy`).
     """
     if samefile(path, dest):
         return
@@ -420,15 +659,42 @@ def move(path, dest, replace=False, pathmod=os.path):
     # First, try renaming the file.
     try:
         os.rename(path, dest)
+        return 'rename'
     except OSError:
         # Otherwise, copy and delete the original.
         try:
-            shutil.copyfile(path, dest)
+            method = copy_contents(path, dest)
             os.remove(path)
+            return method
         except (OSError, IOError) as exc:
             raise FilesystemError(exc, 'move', (path, dest),
                                   traceback.format_exc())
 
+def link(path, dest, replace=False, pathmod=os.path):
+    """Create a hard link to a file, so that the same file can also be
+    found at `dest`. Behaves like `copy` otherwise, and falls back to
+    copying when the file cannot be linked (e.g., when the paths are
+    on different filesystems). Returns 'link' or the copy method used.
+    """
+    if samefile(path, dest):
+        return
+    path = syspath(path)
+    dest = syspath(dest)
+    if not replace and pathmod.exists(dest):
+        raise FilesystemError('file exists', 'link', (path, dest))
+    if not hasattr(os, 'link'):
+        return copy(path, dest, replace, pathmod)
+    if replace and pathmod.exists(dest):
+        remove(dest)
+    try:
+        os.link(path, dest)
+        return 'link'
+    except OSError as exc:
+        if exc.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise FilesystemError(exc, 'link', (path, dest),
+                                  traceback.format_exc())
+    return copy(path, dest, replace, pathmod)
+
 def unique_path(path):
     """Returns a version of ``path`` that does not exist on the
     filesystem. Specifically, if ``path` itself already exists, then
@@ -623,3 +889,87 @@ def max_filename_length(path, limit=MAX_FILENAME_LENGTH):
         return min(res[9], limit)
     else:
         return limit
+
+class ReadWriteLock(object):
+    """A lock that may be held either by any number of readers at once
+    or by a single writer. Waiting writers take precedence over new
+    readers so that a steady stream of readers cannot starve them.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+class LRUCache(object):
+    """A thread-safe mapping that holds at most `size` entries. When it
+    is full, adding an entry evicts the least recently used one. The
+    `hits` and `misses` attributes count the lookups that found a value
+    and those that did not.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get the value for `key`, marking it as recently used, or
+        `default` if the key is not present.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove the entry for `key` and return its value (or
+        `default` if the key is not present).
+        """
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
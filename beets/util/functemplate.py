@@ -489,7 +489,9 @@ def _parse(template):
 # External interface.
 
 class Template(object):
-    """A string template, including text, Symbols, and Calls.
+    """A string template, including text, Symbols, and Calls. The
+    names of the variables and functions the template refers to are
+    available as the `varnames` and `funcnames` sets.
     """
     def __init__(self, template):
         self.expr = _parse(template)
@@ -519,6 +521,8 @@ class Template(object):
     def translate(self):
         """Compile the template to a Python function."""
         expressions, varnames, funcnames = self.expr.translate()
+        self.varnames = varnames
+        self.funcnames = funcnames
 
         argnames = []
         for varname in varnames:
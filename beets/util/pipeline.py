@@ -28,13 +28,22 @@ When running a parallel pipeline, it is also possible to use
 multiple coroutines for the same pipeline stage; this lets you speed
 up a bottleneck stage by dividing its work among multiple threads.
 To do so, pass an iterable of coroutines to the Pipeline constructor
-in place of any single coroutine.
+in place of any single coroutine. The messages from such a stage may
+come out in any order; wrap the coroutines in an OrderedStage to keep
+the order in which the stage received them.
+
+To find out which stage is the bottleneck, pass a PipelineStats object
+to run_parallel or run_sequential. It records the time each stage
+spends working and blocked on its queues, how full each queue gets
+and how many messages each stage handles. Without one, the pipeline
+runs without any bookkeeping.
 """
 from __future__ import print_function
 
 import Queue
-from threading import Thread, Lock
+from threading import Thread, Lock, Condition, currentThread
 import sys
+import time
 import types
 
 BUBBLE = '__PIPELINE_BUBBLE__'
@@ -141,6 +150,247 @@ def _allmsgs(obj):
     else:
         return [obj]
 
+class OrderedStage(tuple):
+    """A pipeline stage run by several coroutines in parallel whose
+    output messages keep the order of the messages the stage received.
+    Results that finish early wait in a reorder buffer; a coroutine
+    that gets more than `buffer_size` messages ahead of the oldest
+    unfinished message waits before passing on its result. Only middle
+    stages can be ordered; a sequential pipeline uses just the first
+    coroutine, as for other stages.
+    """
+    def __new__(cls, coros, buffer_size=None):
+        stage = super(OrderedStage, cls).__new__(cls, coros)
+        stage.buffer_size = buffer_size or 4 * len(stage)
+        return stage
+
+class _Sequencer(object):
+    """Numbers the messages taken by the threads of an OrderedStage and
+    sends their results to the next stage in order.
+    """
+    def __init__(self, out_queue, buffer_size):
+        self.out_queue = out_queue
+        self.buffer_size = buffer_size
+        self.get_lock = Lock()
+        self.cond = Condition()
+        self.next_in = 0
+        self.next_out = 0
+        self.buffer = {}
+        self.aborted = False
+
+    def get(self, in_queue):
+        """Get the next message from `in_queue` along with its sequence
+        number.
+        """
+        with self.get_lock:
+            msg = in_queue.get()
+            seq = self.next_in
+            if msg is not POISON:
+                self.next_in += 1
+        return seq, msg
+
+    def put(self, seq, msgs):
+        """Pass on the output messages for the message numbered `seq`
+        once all the earlier messages' outputs have been sent.
+        """
+        with self.cond:
+            # Keep the reorder buffer bounded.
+            while seq - self.next_out >= self.buffer_size and \
+                    not self.aborted:
+                self.cond.wait()
+            if self.aborted:
+                return
+
+            self.buffer[seq] = msgs
+            while self.next_out in self.buffer:
+                for msg in self.buffer.pop(self.next_out):
+                    self.out_queue.put(msg)
+                self.next_out += 1
+            self.cond.notifyAll()
+
+    def abort(self):
+        """Wake up any threads waiting to pass on their results.
+        """
+        with self.cond:
+            self.aborted = True
+            self.cond.notifyAll()
+
+def _stage_name(coro):
+    """Get a readable name for a stage coroutine: the name of the
+    generator function that made it.
+    """
+    return getattr(coro, '__name__', None) or type(coro).__name__
+
+class StageStats(object):
+    """Counters for one thread of a pipeline stage. Times are in
+    seconds.
+    """
+    def __init__(self):
+        self.work = 0.0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+        self.messages_in = 0
+        self.messages_out = 0
+
+class PipelineStats(object):
+    """Collects the time each stage of a pipeline spends working and
+    blocked on its queues, the most messages each queue held at once
+    and the number of messages that pass through each stage. Pass an
+    instance to Pipeline.run_parallel or Pipeline.run_sequential.
+    """
+    def __init__(self):
+        self.names = []
+        self.stages = []
+        self.queue_sizes = []
+        self.high_water = []
+        self.start = None
+        self.end = None
+        self._thread_stats = {}
+
+    def _setup(self, names, nqueues=0, queue_size=0):
+        """Prepare to record a pipeline run with stages called `names`
+        and `nqueues` queues between them.
+        """
+        self.names = list(names)
+        self.stages = [[] for _ in names]
+        self.queue_sizes = [queue_size] * nqueues
+        self.high_water = [0] * nqueues
+        self._thread_stats = {}
+
+    def _add_thread(self, index, thread=None):
+        """Make the counters for a new thread in stage `index`. The
+        counters record the queue waits of `thread`, if given.
+        """
+        stage_stats = StageStats()
+        self.stages[index].append(stage_stats)
+        if thread is not None:
+            self._thread_stats[thread] = stage_stats
+        return stage_stats
+
+    def _current(self):
+        """Get the counters for the running thread.
+        """
+        return self._thread_stats.get(currentThread())
+
+    def elapsed(self):
+        """The wall-clock duration of the run in seconds.
+        """
+        if self.start is None:
+            return 0.0
+        return (self.end or time.time()) - self.start
+
+    def summary(self):
+        """Get a dictionary describing the run that can be serialized
+        as JSON. Each stage's entry has the sums of its threads'
+        counters and its throughput in messages per second; each queue
+        has its capacity and the most messages it held at once.
+        """
+        elapsed = self.elapsed()
+        stages = []
+        for index, (name, threads) in enumerate(zip(self.names,
+                                                    self.stages)):
+            stage = {
+                'name': name,
+                'threads': len(threads),
+                'work': sum(t.work for t in threads),
+                'wait_in': sum(t.wait_in for t in threads),
+                'wait_out': sum(t.wait_out for t in threads),
+                'messages_in': sum(t.messages_in for t in threads),
+                'messages_out': sum(t.messages_out for t in threads),
+            }
+            # The first stage has no input; count what it produced.
+            handled = stage['messages_out'] if index == 0 \
+                else stage['messages_in']
+            stage['rate'] = handled / elapsed if elapsed else 0.0
+            stages.append(stage)
+        queues = [{'size': size, 'high_water': high}
+                  for size, high in zip(self.queue_sizes, self.high_water)]
+        return {'elapsed': elapsed, 'stages': stages, 'queues': queues}
+
+    def report(self):
+        """Describe the run as a list of lines of text, one for each
+        stage followed by the queue it feeds.
+        """
+        summary = self.summary()
+        lines = [u'pipeline: {0:.3f}s'.format(summary['elapsed'])]
+        for index, stage in enumerate(summary['stages']):
+            lines.append(
+                u'{0} (threads: {1}): {2} in, {3} out, {4:.1f}/s; '
+                u'work {5:.3f}s, wait in {6:.3f}s, wait out {7:.3f}s'.format(
+                    stage['name'], stage['threads'], stage['messages_in'],
+                    stage['messages_out'], stage['rate'], stage['work'],
+                    stage['wait_in'], stage['wait_out'],
+                )
+            )
+            if index < len(summary['queues']):
+                queue = summary['queues'][index]
+                lines.append(u'  queue: at most {0} of {1}'.format(
+                    queue['high_water'], queue['size'] or u'unlimited'
+                ))
+        return lines
+
+class _TimedCoroutine(object):
+    """Wraps a stage coroutine to add the time spent in it and the
+    messages it receives and yields to a StageStats.
+    """
+    def __init__(self, coro, stage_stats):
+        self.coro = coro
+        self.stats = stage_stats
+
+    def __iter__(self):
+        return self
+
+    def _run(self, func, *args):
+        start = time.time()
+        try:
+            out = func(*args)
+        finally:
+            self.stats.work += time.time() - start
+        # Priming a coroutine, or sending to the last stage, yields
+        # nothing.
+        if out is not None:
+            self.stats.messages_out += len(_allmsgs(out))
+        return out
+
+    def next(self):
+        return self._run(self.coro.next)
+
+    def send(self, msg):
+        self.stats.messages_in += 1
+        return self._run(self.coro.send, msg)
+
+class _StatsQueue(CountedQueue):
+    """A CountedQueue that adds the time threads spend blocked on it to
+    their counters and remembers the most messages it held.
+    """
+    def __init__(self, maxsize, stats, index):
+        CountedQueue.__init__(self, maxsize)
+        self.stats = stats
+        self.index = index
+
+    def _put(self, item):
+        CountedQueue._put(self, item)
+        if len(self.queue) > self.stats.high_water[self.index]:
+            self.stats.high_water[self.index] = len(self.queue)
+
+    def get(self, block=True, timeout=None):
+        start = time.time()
+        try:
+            return CountedQueue.get(self, block, timeout)
+        finally:
+            stage_stats = self.stats._current()
+            if stage_stats:
+                stage_stats.wait_in += time.time() - start
+
+    def put(self, item, block=True, timeout=None):
+        start = time.time()
+        try:
+            CountedQueue.put(self, item, block, timeout)
+        finally:
+            stage_stats = self.stats._current()
+            if stage_stats:
+                stage_stats.wait_out += time.time() - start
+
 class PipelineThread(Thread):
     """Abstract base class for pipeline-stage threads."""
     def __init__(self, all_threads):
@@ -161,6 +411,8 @@ class PipelineThread(Thread):
                 _invalidate_queue(self.in_queue, POISON)
             if hasattr(self, 'out_queue'):
                 _invalidate_queue(self.out_queue, POISON)
+            if getattr(self, 'sequencer', None):
+                self.sequencer.abort()
 
     def abort_all(self, exc_info):
         """Abort all other threads in the system for an exception.
@@ -213,12 +465,14 @@ class MiddlePipelineThread(PipelineThread):
     """A thread running any stage in the pipeline except the first or
     last.
     """
-    def __init__(self, coro, in_queue, out_queue, all_threads):
+    def __init__(self, coro, in_queue, out_queue, all_threads,
+                 sequencer=None):
         super(MiddlePipelineThread, self).__init__(all_threads)
         self.coro = coro
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.out_queue.acquire()
+        self.sequencer = sequencer
 
     def run(self):
         try:
@@ -231,7 +485,10 @@ class MiddlePipelineThread(PipelineThread):
                         return
 
                 # Get the message from the previous stage.
-                msg = self.in_queue.get()
+                if self.sequencer:
+                    seq, msg = self.sequencer.get(self.in_queue)
+                else:
+                    msg = self.in_queue.get()
                 if msg is POISON:
                     break
 
@@ -242,6 +499,12 @@ class MiddlePipelineThread(PipelineThread):
                 # Invoke the current stage.
                 out = self.coro.send(msg)
 
+                # In an ordered stage, the sequencer sends the messages
+                # when their turn comes.
+                if self.sequencer:
+                    self.sequencer.put(seq, _allmsgs(out))
+                    continue
+
                 # Send messages to next stage.
                 for msg in _allmsgs(out):
                     with self.abort_lock:
@@ -296,9 +559,11 @@ class Pipeline(object):
     is a coroutine that receives messages from the previous stage and
     yields messages to be sent to the next stage.
     """
-    def __init__(self, stages):
+    def __init__(self, stages, names=None):
         """Makes a new pipeline from a list of coroutines. There must
-        be at least two stages.
+        be at least two stages. `names` optionally labels the stages in
+        statistics; missing or None names default to the name of the
+        stage's generator function.
         """
         if len(stages) < 2:
             raise ValueError('pipeline must have at least two stages')
@@ -310,13 +575,33 @@ class Pipeline(object):
                 # Default to one thread per stage.
                 self.stages.append((stage,))
 
-    def run_sequential(self):
+        names = list(names or ())
+        names += [None] * (len(self.stages) - len(names))
+        self.names = [name or _stage_name(stage[0])
+                      for name, stage in zip(names, self.stages)]
+
+    def run_sequential(self, stats=None):
         """Run the pipeline sequentially in the current thread. The
         stages are run one after the other. Only the first coroutine
-        in each stage is used.
+        in each stage is used. If `stats` is a PipelineStats, the time
+        spent in each stage is recorded there.
         """
         coros = [stage[0] for stage in self.stages]
+        if stats is not None:
+            stats._setup(self.names)
+            coros = [_TimedCoroutine(coro, stats._add_thread(i))
+                     for i, coro in enumerate(coros)]
+            stats.start = time.time()
+        try:
+            self._run_sequential(coros)
+        finally:
+            if stats is not None:
+                stats.end = time.time()
 
+    def _run_sequential(self, coros):
+        """Push the messages from the first coroutine through the
+        others.
+        """
         # "Prime" the coroutines.
         for coro in coros[1:]:
             coro.next()
@@ -331,12 +616,19 @@ class Pipeline(object):
                     next_msgs.extend(_allmsgs(out))
                 msgs = next_msgs
 
-    def run_parallel(self, queue_size=DEFAULT_QUEUE_SIZE):
+    def run_parallel(self, queue_size=DEFAULT_QUEUE_SIZE, stats=None):
         """Run the pipeline in parallel using one thread per stage. The
         messages between the stages are stored in queues of the given
-        size.
+        size. If `stats` is a PipelineStats, each stage's working and
+        waiting times and each queue's fill level are recorded there.
         """
-        queues = [CountedQueue(queue_size) for i in range(len(self.stages)-1)]
+        nqueues = len(self.stages) - 1
+        if stats is None:
+            queues = [CountedQueue(queue_size) for i in range(nqueues)]
+        else:
+            stats._setup(self.names, nqueues, queue_size)
+            queues = [_StatsQueue(queue_size, stats, i)
+                      for i in range(nqueues)]
         threads = []
 
         # Set up first stage.
@@ -345,9 +637,14 @@ class Pipeline(object):
 
         # Middle stages.
         for i in range(1, len(self.stages)-1):
-            for coro in self.stages[i]:
+            stage = self.stages[i]
+            if isinstance(stage, OrderedStage):
+                sequencer = _Sequencer(queues[i], stage.buffer_size)
+            else:
+                sequencer = None
+            for coro in stage:
                 threads.append(MiddlePipelineThread(
-                    coro, queues[i-1], queues[i], threads
+                    coro, queues[i-1], queues[i], threads, sequencer
                 ))
 
         # Last stage.
@@ -356,6 +653,10 @@ class Pipeline(object):
                 LastPipelineThread(coro, queues[-1], threads)
             )
 
+        if stats is not None:
+            self._instrument(threads, stats)
+            stats.start = time.time()
+
         # Start threads.
         for thread in threads:
             thread.start()
@@ -379,6 +680,8 @@ class Pipeline(object):
             # in normal operation, or aborted, in case of an exception.
             for thread in threads[:-1]:
                 thread.join()
+            if stats is not None:
+                stats.end = time.time()
 
         for thread in threads:
             exc_info = thread.exc_info
@@ -386,10 +689,20 @@ class Pipeline(object):
                 # Make the exception appear as it was raised originally.
                 raise exc_info[0], exc_info[1], exc_info[2]
 
+    def _instrument(self, threads, stats):
+        """Give each of the threads made by run_parallel its own
+        counters, in the order the threads were made.
+        """
+        threads = iter(threads)
+        for index, stage in enumerate(self.stages):
+            for coro in stage:
+                thread = threads.next()
+                thread.coro = _TimedCoroutine(
+                    thread.coro, stats._add_thread(index, thread)
+                )
+
 # Smoke test.
 if __name__ == '__main__':
-    import time
-
     # Test a normally-terminating pipeline both in sequence and
     # in parallel.
     def produce():
@@ -41,8 +41,8 @@ def libtree(lib):
     child node tuples.
     """
     root = Node({}, {})
-    for item in lib.items():
-        dest = item.destination(fragment=True)
+    items = list(lib.items())
+    for item, dest in zip(items, lib.destinations(items, fragment=True)):
         parts = util.components(dest)
         _insert(root, parts, item.id)
     return root
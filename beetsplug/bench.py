@@ -20,9 +20,26 @@ from beets.plugins import BeetsPlugin
 from beets import ui
 from beets import vfs
 from beets import library
+from beets import util
+from beets import autotag
+from beets import mediafile
 from beets.util.functemplate import Template
 import cProfile
 import timeit
+import os
+import shutil
+import tempfile
+
+def _run(func, prof, label, prof_filename):
+    """Either time a single call to `func`, printing and returning the
+    interval with `label`, or profile it into the file `prof_filename`.
+    """
+    if prof:
+        cProfile.runctx('func()', {}, {'func': func}, prof_filename)
+    else:
+        interval = timeit.timeit(func, number=1)
+        print('{0}:'.format(label), interval)
+        return interval
 
 def benchmark(lib, prof):
     def _build_tree():
@@ -33,34 +50,284 @@ def benchmark(lib, prof):
         (library.PF_KEY_DEFAULT,
          Template('$albumartist/$album%aunique{}/$track $title')),
     ]
-    if prof:
-        cProfile.runctx('_build_tree()', {}, {'_build_tree': _build_tree},
-                        'paths.withaunique.prof')
-    else:
-        interval = timeit.timeit(_build_tree, number=1)
-        print('With %aunique:', interval)
+    _run(_build_tree, prof, 'With %aunique', 'paths.withaunique.prof')
 
     # And with %aunique replaceed with a "cheap" no-op function.
     lib.path_formats = [
         (library.PF_KEY_DEFAULT,
          Template('$albumartist/$album%lower{}/$track $title')),
     ]
-    if prof:
-        cProfile.runctx('_build_tree()', {}, {'_build_tree': _build_tree},
-                        'paths.withoutaunique.prof')
-    else:
-        interval = timeit.timeit(_build_tree, number=1)
-        print('Without %aunique:', interval)
+    _run(_build_tree, prof, 'Without %aunique', 'paths.withoutaunique.prof')
+
+def iter_benchmark(lib, prof):
+    def _iterate():
+        for item in lib.items():
+            pass
+
+    # Iterate over the whole library, fetching flexible attributes in
+    # batches (the default).
+    _run(_iterate, prof, 'Batched flexattr loading', 'iter.batched.prof')
+
+    # And with one flexible attribute query per item.
+    old_size = library.Results.flex_batch_size
+    library.Results.flex_batch_size = 1
+    try:
+        _run(_iterate, prof, 'Per-item flexattr loading',
+             'iter.peritem.prof')
+    finally:
+        library.Results.flex_batch_size = old_size
+
+def index_benchmark(lib, prof):
+    albums = list(lib.albums())
+    albums = albums[::max(1, len(albums) // 200)]
+    items = [album.items().get() for album in albums]
+    items = [item for item in items if item]
+
+    def _lookups():
+        for album in albums:
+            list(album.items())
+            list(lib.albums(library.AndQuery([
+                library.MatchQuery('albumartist', album.albumartist),
+                library.MatchQuery('album', album.album),
+            ])))
+        for item in items:
+            list(lib.items(library.MatchQuery('mb_trackid',
+                                              item.mb_trackid)))
+            list(lib.items(library.MatchQuery('path', item.path)))
+
+    # Look up albums' items, albums by name, and items by MusicBrainz
+    # ID and path with the default indexes in place.
+    _run(_lookups, prof, 'With indexes', 'index.with.prof')
+
+    # And without any secondary indexes. Afterward, restore exactly the
+    # indexes the library was opened with, including configured ones.
+    lib._make_indexes(())
+    try:
+        _run(_lookups, prof, 'Without indexes', 'index.without.prof')
+    finally:
+        lib._make_indexes(lib.indexes)
+
+def fts_benchmark(lib, prof):
+    words = set()
+    for album in lib.albums():
+        words.update(library.fts_words(album.album))
+    words = sorted(words)
+    words = words[::max(1, len(words) // 100)]
+
+    def _search():
+        for word in words:
+            list(lib.items(word))
+
+    # Search for words in the default fields with substring matching,
+    # as done when there is no full-text index.
+    old_fts = lib.fts
+    lib.fts = False
+    _run(_search, prof, 'Substring search', 'fts.substring.prof')
+
+    # And with the full-text index.
+    lib.fts = all([lib._make_fts(model_cls, True)
+                   for model_cls in (library.Item, library.Album)])
+    try:
+        _run(_search, prof, 'Full-text search', 'fts.fulltext.prof')
+    finally:
+        if not old_fts:
+            for model_cls in (library.Item, library.Album):
+                lib._make_fts(model_cls, False)
+        lib.fts = old_fts
+
+def cache_benchmark(lib, prof):
+    def _build_tree():
+        vfs.libtree(lib)
+
+    # Build the path tree, which looks up every item's album, without
+    # an object cache.
+    old_cache = lib._cache
+    lib._cache = None
+    try:
+        _run(_build_tree, prof, 'Without object cache', 'cache.without.prof')
+
+        # And with one.
+        lib._cache = util.LRUCache(1000)
+        _run(_build_tree, prof, 'With object cache', 'cache.with.prof')
+        print('Cache hits: {0[hits]}, misses: {0[misses]}'.format(
+            lib.cache_info()
+        ))
+    finally:
+        lib._cache = old_cache
+
+def read_benchmark(lib, prof):
+    base = tempfile.mkdtemp()
+    try:
+        synthetic_tree(base, 1000)
+
+        def _read(workers):
+            def func():
+                for _ in autotag.albums_in_dir(base, workers):
+                    pass
+            return func
+
+        # Read the metadata from every file in the tree, one file at a
+        # time and with thread pools of different sizes.
+        for workers in (1, 2, 4, 8):
+            _run(_read(workers), prof,
+                 'Reading with {0} workers'.format(workers),
+                 'read.{0}.prof'.format(workers))
+    finally:
+        shutil.rmtree(base)
+
+def walk_benchmark(lib, prof):
+    base = tempfile.mkdtemp()
+    try:
+        synthetic_tree(base, 5000)
+        ignore = ui.config['ignore'].as_str_seq()
+
+        def _walk(workers, mtimes=None):
+            def func():
+                for _ in util.sorted_walk(base, ignore, workers=workers,
+                                          mtimes=mtimes):
+                    pass
+            return func
+
+        # List every directory in the tree, one at a time and with
+        # listings read ahead by a thread pool.
+        for workers in (1, 4):
+            _run(_walk(workers), prof,
+                 'Walking with {0} workers'.format(workers),
+                 'walk.{0}.prof'.format(workers))
+
+        # Walk again after recording the directories' modification
+        # times, so the unchanged directories are skipped.
+        mtimes = {}
+        _walk(1, mtimes)()
+        _run(_walk(1, mtimes), prof, 'Walking unchanged tree',
+             'walk.unchanged.prof')
+    finally:
+        shutil.rmtree(base)
+
+def copy_benchmark(lib, prof):
+    base = tempfile.mkdtemp()
+    try:
+        size = 64  # Megabytes.
+        src = os.path.join(base, 'src')
+        with open(src, 'wb') as f:
+            for _ in range(size):
+                f.write(os.urandom(1024 * 1024))
+        dests = [os.path.join(base, 'dest{0}'.format(num))
+                 for num in range(10)]
+
+        def _copy(copy_func, label, prof_filename):
+            # Copy the file ten times to new files and print the
+            # throughput.
+            for dest in dests:
+                if os.path.exists(dest):
+                    os.remove(dest)
+            def func():
+                for dest in dests:
+                    copy_func(src, dest)
+            interval = _run(func, prof, label, prof_filename)
+            if interval:
+                print('  {0:.1f} MB/s'.format(size * len(dests) / interval))
+
+        # Copy through Python buffers, as shutil.copyfile does...
+        _copy(shutil.copyfile, 'Copying with shutil', 'copy.shutil.prof')
+
+        # ...with each of the copy methods available here...
+        for name, method in util.COPY_METHODS:
+            def copy_func(path, dest, methods=[(name, method)]):
+                util.copy_contents(path, dest, methods)
+            try:
+                copy_func(src, dests[0])
+            except (OSError, IOError) as exc:
+                print('Copying with {0}: unsupported ({1})'.format(
+                    name, exc.strerror
+                ))
+                continue
+            _copy(copy_func, 'Copying with {0}'.format(name),
+                  'copy.{0}.prof'.format(name))
+
+        # ...and by hard linking.
+        _copy(util.link, 'Linking', 'copy.link.prof')
+    finally:
+        shutil.rmtree(base)
+
+def synthetic_tree(base, size):
+    """Create a tree of `size` small tagged MP3 files under the
+    directory `base`, with one directory of ten tracks per album and
+    one directory per artist.
+    """
+    # A file made of silent MPEG frames, tagged once and then copied.
+    seed = os.path.join(base, 'seed.mp3')
+    with open(seed, 'wb') as f:
+        f.write(('\xff\xfb\x90\x64' + '\x00' * 413) * 40)
+    mf = mediafile.MediaFile(seed)
+    mf.title = u'Title'
+    mf.artist = mf.albumartist = u'Artist'
+    mf.album = u'Album'
+    mf.save()
+
+    for num in range(size):
+        album_num = num // 10
+        directory = os.path.join(base, 'artist{0}'.format(album_num // 10),
+                                 'album{0}'.format(album_num))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        shutil.copyfile(seed, os.path.join(directory,
+                                           '{0}.mp3'.format(num % 10)))
+    os.remove(seed)
+
+def synthetic_library(size):
+    """Create an in-memory library containing `size` generated items
+    grouped into albums of ten tracks.
+    """
+    lib = library.Library(':memory:')
+    for album_num in range(0, size, 10):
+        items = []
+        for track in range(1, min(10, size - album_num) + 1):
+            num = album_num + track
+            items.append(library.Item(
+                title=u'Title {0}'.format(num),
+                artist=u'Artist {0}'.format(album_num // 100),
+                albumartist=u'Artist {0}'.format(album_num // 100),
+                album=u'Album {0}'.format(album_num),
+                track=track,
+                mb_trackid=u'track-{0}'.format(num),
+                mb_albumid=u'album-{0}'.format(album_num),
+                path='/music/{0}/{1}.mp3'.format(album_num, track),
+            ))
+        lib.add_album(items)
+    return lib
+
+BENCHMARKS = {
+    'paths': benchmark,
+    'iter': iter_benchmark,
+    'index': index_benchmark,
+    'fts': fts_benchmark,
+    'cache': cache_benchmark,
+    'read': read_benchmark,
+    'walk': walk_benchmark,
+    'copy': copy_benchmark,
+}
 
 class BenchmarkPlugin(BeetsPlugin):
     """A plugin for performing some simple performance benchmarks.
     """
     def commands(self):
         def bench_func(lib, opts, args):
-            benchmark(lib, opts.profile)
+            names = args or sorted(BENCHMARKS)
+            for name in names:
+                if name not in BENCHMARKS:
+                    raise ui.UserError(u'unknown benchmark {0}'.format(name))
+            if opts.synthetic:
+                lib = synthetic_library(opts.synthetic)
+            for name in names:
+                BENCHMARKS[name](lib, opts.profile)
         bench_cmd = ui.Subcommand('bench', help='benchmark')
         bench_cmd.parser.add_option('-p', '--profile',
                                     action='store_true', default=False,
                                     help='performance profiling')
+        bench_cmd.parser.add_option('-s', '--synthetic', type='int',
+                                    metavar='SIZE', default=0,
+                                    help='use a generated in-memory '
+                                         'library with SIZE items')
         bench_cmd.func = bench_func
         return [bench_cmd]
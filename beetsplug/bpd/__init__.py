@@ -929,7 +929,7 @@ class Server(BaseServer):
 
     def cmd_stats(self, conn):
         """Sends some statistics about the library."""
-        with self.lib.transaction() as tx:
+        with self.lib.transaction(read_only=True) as tx:
             statement = 'SELECT COUNT(DISTINCT artist), ' \
                         'COUNT(DISTINCT album), ' \
                         'COUNT(id), ' \
@@ -1007,10 +1007,28 @@ class Server(BaseServer):
         else: # No key-value pairs.
             return beets.library.TrueQuery()
 
+    def _full_text_query(self, value, fields, query_type):
+        """Make a query for an "any" search that uses the library's
+        full-text index: it matches items whose search fields contain
+        the words in `value`, the last of which may be a partial word.
+        Falls back to a substring query on `fields` when `value` has no
+        words.
+        """
+        if not beets.library.fts_words(value):
+            return beets.library.AnyFieldQuery(value, fields, query_type)
+        return beets.library.FullTextQuery(value,
+                                           beets.library.Item._search_fields,
+                                           beets.library.Item._fts_table,
+                                           True)
+
     def cmd_search(self, conn, *kv):
         """Perform a substring match for items."""
+        if self.lib.fts:
+            any_query_type = self._full_text_query
+        else:
+            any_query_type = beets.library.AnyFieldQuery
         query = self._metadata_query(beets.library.SubstringQuery,
-                                     beets.library.AnyFieldQuery,
+                                     any_query_type,
                                      kv)
         for item in self.lib.items(query):
             yield self._item_info(item)
@@ -1034,7 +1052,7 @@ class Server(BaseServer):
         statement = 'SELECT DISTINCT ' + show_key + \
                     ' FROM items WHERE ' + clause + \
                     ' ORDER BY ' + show_key
-        with self.lib.transaction() as tx:
+        with self.lib.transaction(read_only=True) as tx:
             rows = tx.query(statement, subvals)
 
         for row in rows:
@@ -39,11 +39,10 @@ ALIASES = {
 }
 
 
-def _destination(dest_dir, item, keep_new, path_formats):
-    """Return the path under `dest_dir` where the file should be placed
-    (possibly after conversion).
+def _destination(dest, keep_new):
+    """Return the path where the file should be placed (possibly after
+    conversion) given the item's destination `dest`.
     """
-    dest = item.destination(basedir=dest_dir, path_formats=path_formats)
     if keep_new:
         # When we're keeping the converted file, no extension munging
         # occurs.
@@ -127,10 +126,10 @@ def should_transcode(item):
             item.bitrate >= 1000 * maxbr
 
 
-def convert_item(dest_dir, keep_new, path_formats):
+def convert_item(keep_new):
     while True:
-        item = yield
-        dest = _destination(dest_dir, item, keep_new, path_formats)
+        item, dest = yield
+        dest = _destination(dest, keep_new)
 
         if os.path.exists(util.syspath(dest)):
             log.info(u'Skipping {0} (target file exists)'.format(
@@ -226,12 +225,12 @@ def convert_func(lib, opts, args):
         return
 
     if opts.album:
-        items = (i for a in lib.albums(ui.decargs(args)) for i in a.items())
+        items = [i for a in lib.albums(ui.decargs(args)) for i in a.items()]
     else:
-        items = iter(lib.items(ui.decargs(args)))
-    convert = [convert_item(dest, keep_new, path_formats)
-               for i in range(threads)]
-    pipe = util.pipeline.Pipeline([items, convert])
+        items = list(lib.items(ui.decargs(args)))
+    dests = lib.destinations(items, basedir=dest, path_formats=path_formats)
+    convert = [convert_item(keep_new) for i in range(threads)]
+    pipe = util.pipeline.Pipeline([iter(zip(items, dests)), convert])
     pipe.run_parallel()
 
 
@@ -17,7 +17,7 @@
 import logging
 
 from beets.plugins import BeetsPlugin
-from beets.ui import decargs, print_obj, Subcommand
+from beets.ui import decargs, print_objs, Subcommand
 
 PLUGIN = 'duplicates'
 log = logging.getLogger('beets')
@@ -103,8 +103,7 @@ class DuplicatesPlugin(BeetsPlugin):
 
             for obj_id, obj_count, objs in _duplicates(items, full):
                 if obj_id:  # Skip empty IDs.
-                    for o in objs:
-                        print_obj(o, lib, fmt=fmt.format(obj_count))
+                    print_objs(objs, lib, fmt.format(obj_count), album)
 
         self._command.func = _dup
         return [self._command]
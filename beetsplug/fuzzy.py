@@ -17,19 +17,59 @@
 
 from beets.plugins import BeetsPlugin
 from beets.library import FieldQuery
+from beets import util
 import beets
 import difflib
+import threading
+
+
+# Matchers for recently used patterns, one set per thread. A
+# SequenceMatcher caches information about its second sequence, so we
+# keep the pattern there and only swap out the value being tested.
+_matchers = threading.local()
+
+def _matcher(pattern):
+    """Get a SequenceMatcher for `pattern` that is private to the
+    current thread.
+    """
+    cache = getattr(_matchers, 'cache', None)
+    if cache is None:
+        cache = _matchers.cache = {}
+    try:
+        return cache[pattern]
+    except KeyError:
+        if len(cache) >= 16:
+            cache.clear()
+        matcher = cache[pattern] = difflib.SequenceMatcher(None, '', pattern)
+        return matcher
+
+def fuzzy_match(pattern, val, threshold):
+    """Determine whether `val` is similar enough to `pattern`.
+    """
+    # smartcase
+    if pattern.islower():
+        val = val.lower()
+    matcher = _matcher(pattern)
+    matcher.set_seq1(val)
+    return matcher.quick_ratio() >= threshold
+
+def _sqlite_fuzzy(pattern, value, threshold):
+    """The SQLite function used to evaluate fuzzy queries in the
+    database.
+    """
+    return fuzzy_match(pattern, util.as_string(value), threshold)
 
 
 class FuzzyQuery(FieldQuery):
+    def col_clause(self):
+        threshold = beets.config['fuzzy']['threshold'].as_number()
+        clause = 'fuzzy(?, {0}, ?)'.format(self.field)
+        return clause, [self.pattern, threshold]
+
     @classmethod
     def value_match(self, pattern, val):
-        # smartcase
-        if pattern.islower():
-            val = val.lower()
-        queryMatcher = difflib.SequenceMatcher(None, pattern, val)
         threshold = beets.config['fuzzy']['threshold'].as_number()
-        return queryMatcher.quick_ratio() >= threshold
+        return fuzzy_match(pattern, val, threshold)
 
 
 class FuzzyPlugin(BeetsPlugin):
@@ -43,3 +83,6 @@ class FuzzyPlugin(BeetsPlugin):
     def queries(self):
         prefix = beets.config['fuzzy']['prefix'].get(basestring)
         return {prefix: FuzzyQuery}
+
+    def sql_functions(self):
+        return {'fuzzy': _sqlite_fuzzy}
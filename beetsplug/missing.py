@@ -19,7 +19,7 @@ import logging
 from beets.autotag import hooks
 from beets.library import Item, Album
 from beets.plugins import BeetsPlugin
-from beets.ui import decargs, print_obj, Subcommand
+from beets.ui import decargs, print_objs, Subcommand
 
 PLUGIN = 'missing'
 log = logging.getLogger('beets')
@@ -145,15 +145,12 @@ class MissingPlugin(BeetsPlugin):
             if count and not fmt:
                 fmt = '$albumartist - $album: $missing'
 
-            for album in albums:
-                if count:
-                    missing = _missing_count(album)
-                    if missing:
-                        print_obj(album, lib, fmt=fmt)
-
-                else:
-                    for item in _missing(album):
-                        print_obj(item, lib, fmt=fmt)
+            if count:
+                print_objs((a for a in albums if _missing_count(a)),
+                           lib, fmt, True)
+            else:
+                print_objs((i for a in albums for i in _missing(a)),
+                           lib, fmt)
 
         self._command.func = _miss
         return [self._command]
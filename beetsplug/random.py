@@ -16,7 +16,7 @@
 """
 from __future__ import absolute_import
 from beets.plugins import BeetsPlugin
-from beets.ui import Subcommand, decargs, print_obj
+from beets.ui import Subcommand, decargs, print_objs
 from beets.util.functemplate import Template
 import random
 from operator import attrgetter
@@ -65,8 +65,7 @@ def random_item(lib, opts, args):
         number = min(len(objs), opts.number)
         objs = random.sample(objs, number)
 
-    for item in objs:
-        print_obj(item, lib, template)
+    print_objs(objs, lib, template, opts.album)
 
 random_cmd = Subcommand('random',
                         help='chose a random track or album')
@@ -50,6 +50,21 @@ def _rep(obj, expand=False):
         return out
 
 
+def _window(results):
+    """Restrict a query result to the window of objects requested with
+    the `offset` and `limit` URL parameters, if any. Returns the
+    (possibly restricted) result set and a dictionary of extra values
+    for the response.
+    """
+    offset = flask.request.args.get('offset', 0, type=int)
+    limit = flask.request.args.get('limit', None, type=int)
+    if limit is None and not offset:
+        return results, {}
+    extra = {'total': len(results)}
+    stop = None if limit is None else offset + limit
+    return results[offset:stop], extra
+
+
 # Flask setup.
 
 app = flask.Flask(__name__)
@@ -68,7 +83,7 @@ def single_item(item_id):
 
 @app.route('/item/')
 def all_items():
-    with g.lib.transaction() as tx:
+    with g.lib.transaction(read_only=True) as tx:
         rows = tx.query("SELECT id FROM items")
     all_ids = [row[0] for row in rows]
     return flask.jsonify(item_ids=all_ids)
@@ -84,8 +99,8 @@ def item_file(item_id):
 @app.route('/item/query/<path:query>')
 def item_query(query):
     parts = query.split('/')
-    items = g.lib.items(parts)
-    return flask.jsonify(results=[_rep(item) for item in items])
+    items, extra = _window(g.lib.items(parts))
+    return flask.jsonify(results=[_rep(item) for item in items], **extra)
 
 
 # Albums.
@@ -97,7 +112,7 @@ def single_album(album_id):
 
 @app.route('/album/')
 def all_albums():
-    with g.lib.transaction() as tx:
+    with g.lib.transaction(read_only=True) as tx:
         rows = tx.query("SELECT id FROM albums")
     all_ids = [row[0] for row in rows]
     return flask.jsonify(album_ids=all_ids)
@@ -105,8 +120,8 @@ def all_albums():
 @app.route('/album/query/<path:query>')
 def album_query(query):
     parts = query.split('/')
-    albums = g.lib.albums(parts)
-    return flask.jsonify(results=[_rep(album) for album in albums])
+    albums, extra = _window(g.lib.albums(parts))
+    return flask.jsonify(results=[_rep(album) for album in albums], **extra)
 
 @app.route('/album/<int:album_id>/art')
 def album_art(album_id):
@@ -118,7 +133,7 @@ def album_art(album_id):
 
 @app.route('/artist/')
 def all_artists():
-    with g.lib.transaction() as tx:
+    with g.lib.transaction(read_only=True) as tx:
         rows = tx.query("SELECT DISTINCT albumartist FROM albums")
     all_artists = [row[0] for row in rows]
     return flask.jsonify(artist_names=all_artists)
@@ -128,7 +143,7 @@ def all_artists():
 
 @app.route('/stats')
 def stats():
-    with g.lib.transaction() as tx:
+    with g.lib.transaction(read_only=True) as tx:
         item_rows = tx.query("SELECT COUNT(*) FROM items")
         album_rows = tx.query("SELECT COUNT(*) FROM albums")
     return flask.jsonify({
@@ -88,6 +88,7 @@ setup(name='beets',
           'echonest_tempo': ['pyechonest'],
           'lastgenre': ['pylast'],
           'web': ['flask'],
+          'scandir': ['scandir'],
       },
       # Non-Python/non-PyPI plugin dependencies:
       # replaygain: mp3gain || aacgain
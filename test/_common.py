@@ -19,6 +19,7 @@ import os
 import logging
 import tempfile
 import shutil
+import threading
 
 # Use unittest2 on Python < 2.7.
 try:
@@ -101,6 +102,7 @@ class TestCase(unittest.TestCase):
         # temporary directory.
         self.temp_dir = tempfile.mkdtemp()
         beets.config['statefile'] = os.path.join(self.temp_dir, 'state.pickle')
+        beets.config['statedb'] = os.path.join(self.temp_dir, 'state.db')
         beets.config['library'] = os.path.join(self.temp_dir, 'library.db')
         beets.config['directory'] = os.path.join(self.temp_dir, 'libdir')
 
@@ -136,6 +138,49 @@ class LibTestCase(TestCase):
         self.i = item(self.lib)
 
 
+# Counting SQL statements.
+
+class StatementCounter(object):
+    """Wraps a SQLite connection and records the SQL statements
+    executed through it. A statement run with `executemany` is recorded
+    once.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.statements = []
+
+    def execute(self, statement, *args):
+        self.statements.append(statement)
+        return self.conn.execute(statement, *args)
+
+    def executemany(self, statement, *args):
+        self.statements.append(statement)
+        return self.conn.executemany(statement, *args)
+
+    def executescript(self, statements):
+        self.statements.append(statements)
+        return self.conn.executescript(statements)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def reset(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+def count_statements(lib):
+    """Make the current thread's connection to `lib` count the
+    statements it executes. Returns the StatementCounter.
+    """
+    counter = StatementCounter(lib._connection())
+    with lib._shared_map_lock:
+        lib._connections[threading.current_thread().ident] = counter
+    return counter
+
+
 
 
 # Mock timing.
@@ -481,6 +481,13 @@ class AlbumsInDirTest(_common.TestCase):
             else:
                 self.assertEqual(len(album), 1)
 
+    def test_album_paths_do_not_read_files(self):
+        albums = list(autotag.album_paths_in_dir(self.base))
+        self.assertEqual(len(albums), 4)
+        for _, entries in albums:
+            for entry in entries:
+                self.assertTrue(isinstance(entry, str))
+
 class MultiDiscAlbumsInDirTest(_common.TestCase):
     def setUp(self):
         super(MultiDiscAlbumsInDirTest, self).setUp()
@@ -556,6 +563,30 @@ class MultiDiscAlbumsInDirTest(_common.TestCase):
         albums = list(autotag.albums_in_dir(self.base))
         self.assertEquals(len(albums), 0)
 
+    def test_parallel_reading_preserves_albums(self):
+        serial = list(autotag.albums_in_dir(self.base, 1))
+        parallel = list(autotag.albums_in_dir(self.base, 4))
+        self.assertEqual([(paths, [i.path for i in items])
+                          for paths, items in parallel],
+                         [(paths, [i.path for i in items])
+                          for paths, items in serial])
+
+    def test_parallel_reading_with_small_read_ahead(self):
+        old_read_ahead = autotag.READ_AHEAD
+        autotag.READ_AHEAD = 1
+        try:
+            albums = list(autotag.albums_in_dir(self.base, 2))
+        finally:
+            autotag.READ_AHEAD = old_read_ahead
+        self.assertEqual([paths for paths, _ in albums],
+                         [self.dirs[0:3], self.dirs[3:5], self.dirs[6:8],
+                          self.dirs[8:]])
+
+    def test_read_workers_option(self):
+        config['import']['read_workers'] = 3
+        albums = list(autotag.albums_in_dir(self.base))
+        self.assertEquals(len(albums), 4)
+
 class AssignmentTest(unittest.TestCase):
     def item(self, title, track):
         return Item(
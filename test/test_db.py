@@ -22,6 +22,7 @@ import shutil
 import re
 import unicodedata
 import sys
+import threading
 
 import _common
 from _common import unittest
@@ -30,6 +31,7 @@ import beets.library
 from beets import util
 from beets import plugins
 from beets import config
+from beets.util.functemplate import Template
 
 TEMP_LIB = os.path.join(_common.RSRC, 'test_copy.blb')
 
@@ -75,6 +77,70 @@ class StoreTest(_common.LibTestCase):
         self.assertTrue('composer' not in self.i._dirty)
 
 
+class ChangeTrackingTest(_common.LibTestCase):
+    def test_added_item_is_current(self):
+        self.assertFalse(self.i.is_stale())
+
+    def test_own_store_keeps_item_current(self):
+        self.i.year = 1987
+        self.i.store()
+        self.assertFalse(self.i.is_stale())
+
+    def test_store_through_other_object_makes_item_stale(self):
+        other = self.lib.get_item(self.i.id)
+        other.year = 1987
+        other.store()
+        self.assertTrue(self.i.is_stale())
+        self.assertFalse(other.is_stale())
+
+        self.i.load()
+        self.assertFalse(self.i.is_stale())
+        self.assertEqual(self.i.year, 1987)
+
+    def test_own_store_after_other_change_stays_stale(self):
+        other = self.lib.get_item(self.i.id)
+        other.year = 1987
+        other.store()
+        self.i.title = u'new title'
+        self.i.store()
+        self.assertTrue(self.i.is_stale())
+
+    def test_other_rows_do_not_make_item_stale(self):
+        other = item(self.lib)
+        other.year = 1987
+        other.store()
+        other.remove()
+        self.assertFalse(self.i.is_stale())
+
+    def test_raw_sql_makes_item_stale(self):
+        with self.lib.transaction() as tx:
+            tx.mutate('UPDATE items SET year=1987')
+        self.assertTrue(self.i.is_stale())
+
+    def test_album_store_makes_items_stale(self):
+        album = self.lib.add_album([self.i])
+        self.assertFalse(self.i.is_stale())
+        self.assertFalse(album.is_stale())
+        album.genre = u'new genre'
+        album.store()
+        self.assertTrue(self.i.is_stale())
+
+    def test_forgotten_rows_are_stale(self):
+        old_size = beets.library.ROW_VERSIONS_SIZE
+        beets.library.ROW_VERSIONS_SIZE = 2
+        try:
+            other = self.lib.get_item(self.i.id)
+            other.year = 1987
+            other.store()
+            self.lib.add_many([item(), item()])
+        finally:
+            beets.library.ROW_VERSIONS_SIZE = old_size
+        self.assertTrue(self.i.is_stale())
+
+    def test_unstored_item_is_not_stale(self):
+        self.assertFalse(item().is_stale())
+
+
 class AddTest(_common.TestCase):
     def setUp(self):
         super(AddTest, self).setUp()
@@ -96,6 +162,41 @@ class AddTest(_common.TestCase):
             'where composer="the composer"').fetchone()['grouping']
         self.assertEqual(new_grouping, self.i.grouping)
 
+    def test_add_many_assigns_ids(self):
+        items = [item() for _ in range(3)]
+        for i, it in enumerate(items):
+            it.title = u'title {0}'.format(i)
+        ids = self.lib.add_many(items)
+        self.assertEqual(ids, [it.id for it in items])
+        self.assertEqual(len(set(ids)), 3)
+        for it in items:
+            self.assertEqual(self.lib.get_item(it.id).title, it.title)
+
+    def test_add_many_stores_flexattrs(self):
+        items = [item() for _ in range(2)]
+        items[0].flex = u'one'
+        items[1].flex = u'two'
+        self.lib.add_many(items)
+        self.assertEqual(self.lib.get_item(items[0].id).flex, u'one')
+        self.assertEqual(self.lib.get_item(items[1].id).flex, u'two')
+
+    def test_add_many_after_existing_items(self):
+        self.lib.add(self.i)
+        items = [item(), item()]
+        self.lib.add_many(items)
+        self.assertEqual([it.id for it in items],
+                         [self.i.id + 1, self.i.id + 2])
+
+    def test_add_many_empty(self):
+        self.assertEqual(self.lib.add_many([]), [])
+
+    def test_add_album_adds_new_items(self):
+        self.lib.add(self.i)
+        new_item = item()
+        album = self.lib.add_album([self.i, new_item])
+        self.assertNotEqual(new_item.id, None)
+        self.assertEqual(len(album.items()), 2)
+
 
 class RemoveTest(_common.LibTestCase):
     def test_remove_deletes_from_db(self):
@@ -104,6 +205,315 @@ class RemoveTest(_common.LibTestCase):
         self.assertEqual(c.fetchone(), None)
 
 
+class FlexAttrLoadTest(_common.TestCase):
+    def setUp(self):
+        super(FlexAttrLoadTest, self).setUp()
+        self.lib = beets.library.Library(':memory:')
+        for i in range(5):
+            it = item()
+            it.flexnum = u'value {0}'.format(i)
+            self.lib.add(it)
+
+    def test_flex_values_loaded_for_each_item(self):
+        values = [i.flexnum for i in self.lib.items()]
+        self.assertEqual(sorted(values),
+                         [u'value {0}'.format(i) for i in range(5)])
+
+    def test_flex_values_loaded_across_batches(self):
+        results = self.lib.items()
+        results.flex_batch_size = 2
+        values = [i.flexnum for i in results]
+        self.assertEqual(sorted(values),
+                         [u'value {0}'.format(i) for i in range(5)])
+
+    def test_items_without_flex_values(self):
+        self.lib.add(item())
+        items = [i for i in self.lib.items() if 'flexnum' not in i]
+        self.assertEqual(len(items), 1)
+
+
+class IndexTest(_common.TestCase):
+    def _index_names(self, lib):
+        return [info[0] for info in lib.index_info()]
+
+    def test_default_indexes_created(self):
+        lib = beets.library.Library(':memory:')
+        names = self._index_names(lib)
+        self.assertTrue('beets_items_by_album_id' in names)
+        self.assertTrue('beets_albums_by_albumartist_album' in names)
+
+    def test_user_index_created(self):
+        lib = beets.library.Library(':memory:',
+                                    indexes=[('items', ('genre', 'year'))])
+        names = self._index_names(lib)
+        self.assertTrue('beets_items_by_genre_year' in names)
+
+    def test_flexattr_index_created(self):
+        lib = beets.library.Library(':memory:',
+                                    indexes=[('albums', ('mood',))])
+        names = self._index_names(lib)
+        self.assertTrue('beets_album_attributes_by_key' in names)
+        self.assertFalse('beets_item_attributes_by_key' in names)
+
+    def test_unwanted_index_dropped(self):
+        path = os.path.join(self.temp_dir, 'index.db')
+        beets.library.Library(path, indexes=[('items', ('genre',))])
+        lib = beets.library.Library(path)
+        self.assertFalse('beets_items_by_genre' in self._index_names(lib))
+        self.assertTrue('beets_items_by_path' in self._index_names(lib))
+
+    def test_opening_indexes_restored(self):
+        lib = beets.library.Library(':memory:',
+                                    indexes=[('items', ('genre',))])
+        names = self._index_names(lib)
+        lib._make_indexes(())
+        lib._make_indexes(lib.indexes)
+        self.assertEqual(sorted(self._index_names(lib)), sorted(names))
+
+    def test_other_index_kept(self):
+        path = os.path.join(self.temp_dir, 'index.db')
+        lib = beets.library.Library(path)
+        with lib.transaction() as tx:
+            tx.script('CREATE INDEX items_by_genre ON items (genre);')
+        lib._connection().close()
+        lib = beets.library.Library(path)
+        self.assertTrue('items_by_genre' in self._index_names(lib))
+
+    def test_explain_uses_index(self):
+        lib = beets.library.Library(':memory:')
+        plan, slow = lib.explain(beets.library.Item,
+                                 beets.library.MatchQuery('album_id', 1))
+        self.assertTrue(any('beets_items_by_album_id' in step
+                            for step in plan))
+        self.assertFalse(slow)
+
+
+class StoreStatementsTest(_common.LibTestCase):
+    def setUp(self):
+        super(StoreStatementsTest, self).setUp()
+        self.i.flex1 = u'one'
+        self.i.flex2 = u'two'
+        self.i.store()
+        self.counter = _common.count_statements(self.lib)
+
+    def _flex(self):
+        return dict(self.lib._connection().execute(
+            'SELECT key, value FROM item_attributes WHERE entity_id=?',
+            (self.i.id,)
+        ).fetchall())
+
+    def test_clean_store_executes_nothing(self):
+        self.i.store()
+        self.assertEqual(self.counter.count, 0)
+
+    def test_fixed_change_does_not_write_flexattrs(self):
+        self.i.title = u'new title'
+        self.i.store()
+        self.assertEqual(self.counter.count, 1)
+        self.assertTrue(self.counter.statements[0].startswith('UPDATE'))
+
+    def test_flex_change_writes_only_changed_key(self):
+        self.i.flex1 = u'uno'
+        self.i.store()
+        self.assertEqual(self.counter.count, 1)
+        self.assertEqual(self._flex(), {'flex1': u'uno', 'flex2': u'two'})
+
+    def test_deleted_flexattr_removed(self):
+        del self.i.flex2
+        self.i.store()
+        self.assertEqual(self.counter.count, 1)
+        self.assertEqual(self._flex(), {'flex1': u'one'})
+        self.assertFalse('flex2' in self.lib.get_item(self.i.id))
+
+    def test_delete_fixed_field_fails(self):
+        with self.assertRaises(KeyError):
+            del self.i['title']
+
+
+class ConcurrencyTest(_common.TestCase):
+    def setUp(self):
+        super(ConcurrencyTest, self).setUp()
+        self.lib = beets.library.Library(
+            os.path.join(self.temp_dir, 'concurrent.db'), concurrent=True
+        )
+
+    def test_wal_mode_enabled(self):
+        with self.lib.transaction(read_only=True) as tx:
+            mode = tx.query('PRAGMA journal_mode')[0][0]
+        self.assertEqual(mode, 'wal')
+
+    def test_read_only_transaction_cannot_write(self):
+        with self.lib.transaction(read_only=True) as tx:
+            with self.assertRaises(ValueError):
+                tx.mutate('DELETE FROM items')
+
+    def test_write_inside_read_only_transaction_fails(self):
+        with self.lib.transaction(read_only=True):
+            with self.assertRaises(ValueError):
+                with self.lib.transaction():
+                    pass
+
+    def test_readers_run_in_parallel(self):
+        entered = threading.Event()
+        release = threading.Event()
+
+        def hold_read():
+            with self.lib.transaction(read_only=True):
+                entered.set()
+                release.wait(5)
+        thread = threading.Thread(target=hold_read)
+        thread.start()
+        try:
+            entered.wait(5)
+            # Another read does not wait for the first one to finish.
+            self.assertEqual(len(self.lib.items()), 0)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_many_readers_one_writer(self):
+        num_items = 50
+        errors = []
+        done = threading.Event()
+
+        def write():
+            try:
+                for i in range(num_items):
+                    it = item()
+                    it.title = u'title {0}'.format(i)
+                    self.lib.add(it)
+                    it.title = u'stored {0}'.format(i)
+                    it.store()
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                done.set()
+
+        def read():
+            try:
+                last = 0
+                while not done.is_set():
+                    count = len(self.lib.items())
+                    # Writes become visible all at once and are never
+                    # undone.
+                    self.assertTrue(count >= last)
+                    last = count
+                    for it in self.lib.items('title:title'):
+                        self.assertTrue(it.title.startswith(u'title'))
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=read) for _ in range(4)]
+        threads.append(threading.Thread(target=write))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.lib.items()), num_items)
+        self.assertEqual(len(self.lib.items('title:stored')), num_items)
+
+
+class DeferredCommitTest(_common.TestCase):
+    def setUp(self):
+        super(DeferredCommitTest, self).setUp()
+        self.path = os.path.join(self.temp_dir, 'deferred.db')
+        self.lib = beets.library.Library(self.path)
+
+    def _committed_items(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_changes_committed_on_request(self):
+        with self.lib.deferred_commits():
+            self.lib.add(item())
+            self.lib.add(item())
+            self.assertEqual(self._committed_items(), 0)
+            self.lib.commit()
+            self.assertEqual(self._committed_items(), 2)
+
+    def test_changes_committed_at_end(self):
+        with self.lib.deferred_commits():
+            self.lib.add(item())
+        self.assertEqual(self._committed_items(), 1)
+
+    def test_uncommitted_changes_visible_to_other_threads(self):
+        found = []
+        with self.lib.deferred_commits():
+            item_id = self.lib.add(item())
+            thread = threading.Thread(
+                target=lambda: found.append(self.lib.get_item(item_id))
+            )
+            thread.start()
+            thread.join()
+        self.assertEqual(found[0].id, item_id)
+
+    def test_commit_outside_block_does_nothing(self):
+        self.lib.commit()
+        self.lib.add(item())
+        self.assertEqual(self._committed_items(), 1)
+
+
+class ObjectCacheTest(_common.TestCase):
+    def setUp(self):
+        super(ObjectCacheTest, self).setUp()
+        self.lib = beets.library.Library(':memory:', cache_size=2)
+        self.i = item()
+        self.album = self.lib.add_album([self.i])
+
+    def test_get_returns_shared_object(self):
+        item1 = self.lib.get_item(self.i.id)
+        item2 = self.lib.get_item(self.i.id)
+        self.assertTrue(item1 is item2)
+        info = self.lib.cache_info()
+        self.assertEqual((info['hits'], info['misses']), (1, 1))
+
+    def test_item_get_album_uses_cache(self):
+        album = self.i.get_album()
+        self.assertTrue(self.i.get_album() is album)
+        self.assertTrue(self.lib.get_album(self.album.id) is album)
+
+    def test_store_invalidates(self):
+        other = self.lib.get_item(self.i.id)
+        self.i.title = u'new title'
+        self.i.store()
+        fetched = self.lib.get_item(self.i.id)
+        self.assertFalse(fetched is other)
+        self.assertEqual(fetched.title, u'new title')
+
+    def test_remove_invalidates(self):
+        self.lib.get_item(self.i.id)
+        self.i.remove()
+        self.assertEqual(self.lib.get_item(self.i.id), None)
+
+    def test_lru_eviction(self):
+        items = [item() for _ in range(3)]
+        self.lib.add_many(items)
+        first = self.lib.get_item(items[0].id)
+        self.lib.get_item(items[1].id)
+        self.lib.get_item(items[2].id)
+        self.assertFalse(self.lib.get_item(items[0].id) is first)
+        self.assertEqual(self.lib.cache_info()['size'], 2)
+
+    def test_load_bypasses_cache(self):
+        cached = self.lib.get_item(self.i.id)
+        self.lib._connection().execute(
+            'UPDATE items SET title=? WHERE id=?', (u'changed', self.i.id)
+        )
+        cached.load()
+        self.assertEqual(cached.title, u'changed')
+
+    def test_no_cache_by_default(self):
+        lib = beets.library.Library(':memory:')
+        it = item(lib)
+        self.assertFalse(lib.get_item(it.id) is lib.get_item(it.id))
+        self.assertEqual(lib.cache_info(), None)
+
+
 class GetSetTest(_common.TestCase):
     def setUp(self):
         super(GetSetTest, self).setUp()
@@ -426,6 +836,67 @@ class DestinationTest(_common.TestCase):
         dest = self.i.destination(platform='linux2', fragment=True)
         self.assertEqual(dest, u'foo.caf\xe9')
 
+    def test_path_formats_compiled_once(self):
+        self.lib.path_formats = [('title:foo', u'$title'),
+                                 ('default', u'$album')]
+        compiled = self.lib._compile_path_formats(self.lib.path_formats)
+        self.assertTrue(
+            self.lib._compile_path_formats(self.lib.path_formats) is compiled
+        )
+        conditional, default = compiled
+        self.assertEqual(len(conditional), 1)
+        self.assertTrue(isinstance(conditional[0][0],
+                                   beets.library.AndQuery))
+        self.assertEqual(default, Template(u'$album'))
+
+    def test_changed_path_formats_recompiled(self):
+        self.lib.path_formats = [('default', u'one')]
+        self.assertEqual(self.i.destination(fragment=True), u'one')
+        self.lib.path_formats = [('default', u'two')]
+        self.assertEqual(self.i.destination(fragment=True), u'two')
+
+    def test_conditional_path_format_selected(self):
+        self.lib.path_formats = [('title:other', u'other'),
+                                 ('title:title', u'matched'),
+                                 ('default', u'default')]
+        self.assertEqual(self.i.destination(fragment=True), u'matched')
+
+    def test_destinations_match_destination(self):
+        self.lib.path_formats = [('default', u'$album/$title')]
+        items = [self.i, item(self.lib)]
+        self.lib.add_album(items)
+        items.append(item(self.lib))
+        self.assertEqual(self.lib.destinations(items),
+                         [i.destination() for i in items])
+
+    def test_destinations_fetch_each_album_once(self):
+        self.lib.path_formats = [('default', u'$album/$title')]
+        items = [self.i, item(self.lib), item(self.lib)]
+        self.lib.add_album(items)
+        counter = _common.count_statements(self.lib)
+        self.lib.destinations(items)
+        album_queries = [st for st in counter.statements
+                         if st.startswith('SELECT * FROM albums')]
+        self.assertEqual(len(album_queries), 1)
+
+    def test_filesystem_limit_cached_per_directory(self):
+        config['max_filename_length'] = 0
+        old_max = util.max_filename_length
+        calls = []
+
+        def fake_max(path, limit=util.MAX_FILENAME_LENGTH):
+            calls.append(path)
+            return 10
+        util.max_filename_length = fake_max
+        try:
+            self.lib.path_formats = [('default', u'abcdefghijklmnop')]
+            dest1 = self.i.destination(fragment=True)
+            self.i.destination(fragment=True)
+        finally:
+            util.max_filename_length = old_max
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(dest1), 10)
+
 
 class PathFormattingMixin(object):
     """Utilities for testing path formatting."""
@@ -549,6 +1020,90 @@ class DisambiguationTest(_common.TestCase, PathFormattingMixin):
         self._setf(u'foo%aunique{albumartist album,albumtype}/$title')
         self._assert_dest('/base/foo [foo_bar]/the title', self.i1)
 
+    def test_store_updates_disambiguation(self):
+        self._assert_dest('/base/foo [2001]/the title', self.i1)
+        album2 = self.lib.get_album(self.i2)
+        album2.album = 'different album'
+        album2.store()
+        self._assert_dest('/base/foo/the title', self.i1)
+
+    def test_add_updates_disambiguation(self):
+        album2 = self.lib.get_album(self.i2)
+        album2.album = 'different album'
+        album2.store()
+        self._assert_dest('/base/foo/the title', self.i1)
+        i3 = item()
+        i3.year = 2003
+        self.lib.add_album([i3])
+        self._assert_dest('/base/foo [2001]/the title', self.i1)
+
+    def test_remove_updates_disambiguation(self):
+        self._assert_dest('/base/foo [2001]/the title', self.i1)
+        self.lib.get_album(self.i2).remove()
+        self._assert_dest('/base/foo/the title', self.i1)
+
+    def test_table_built_in_one_query(self):
+        counter = _common.count_statements(self.lib)
+        self.i1.destination(pathmod=posixpath)
+        self.i2.destination(pathmod=posixpath)
+        grouped = [st for st in counter.statements if 'GROUP BY' in st]
+        self.assertEqual(len(grouped), 1)
+
+    def test_missing_flexible_attribute_skipped(self):
+        self._setf(u'foo%aunique{albumartist album,foo year}/$title')
+        self._assert_dest('/base/foo [2001]/the title', self.i1)
+
+    def test_flexible_attribute_disambiguates(self):
+        for item, edition in ((self.i1, 'deluxe'), (self.i2, 'remaster')):
+            album = self.lib.get_album(item)
+            album.year = 2000
+            album.edition = edition
+            album.store()
+        self._setf(u'foo%aunique{albumartist album,edition year}/$title')
+        self._assert_dest('/base/foo [deluxe]/the title', self.i1)
+        self._assert_dest('/base/foo [remaster]/the title', self.i2)
+
+    def test_flexible_attribute_as_key(self):
+        album = self.lib.get_album(self.i2)
+        album.edition = 'remaster'
+        album.store()
+        self._setf(u'foo%aunique{albumartist album edition,year}/$title')
+        self._assert_dest('/base/foo/the title', self.i1)
+        self._assert_dest('/base/foo/the title', self.i2)
+
+class DisambiguationThreadTest(_common.TestCase):
+    def setUp(self):
+        super(DisambiguationThreadTest, self).setUp()
+        self.lib = beets.library.Library(
+            os.path.join(self.temp_dir, 'aunique.db')
+        )
+        self.lib.directory = '/base'
+        self.lib.path_formats = [('default', u'foo%aunique{}/$title')]
+        self.i1 = item()
+        self.lib.add_album([self.i1])
+        self.lib.add_album([item()])
+
+    def test_invalidate_while_computing_in_other_thread(self):
+        album = self.lib.get_album(self.i1)
+        done = threading.Event()
+        def compute():
+            self.i1.destination(pathmod=posixpath)
+            done.set()
+        with self.lib.transaction():
+            album.year = 1999
+            album.store()
+            thread = threading.Thread(target=compute)
+            thread.start()
+            # The other thread waits for this transaction while
+            # computing the table; this thread must still be able to
+            # invalidate it.
+            thread.join(0.1)
+            self.lib._album_changed(album.id)
+        thread.join(5)
+        self.assertTrue(done.is_set())
+        self.assertEqual(self.i1.destination(pathmod=posixpath),
+                         '/base/foo [1999]/the title')
+
 
 class PathConversionTest(_common.TestCase):
     def test_syspath_windows_format(self):
@@ -582,14 +1137,15 @@ class PathConversionTest(_common.TestCase):
 
 
 class PluginDestinationTest(_common.TestCase):
-    # Mock the plugins.template_values(item) function.
-    def _template_values(self, item):
-        return self._tv_map
+    # Mock the plugins.template_field_getters() function.
+    def _template_field_getters(self):
+        return dict((key, lambda item, value=value: value)
+                    for key, value in self._tv_map.items())
     def setUp(self):
         super(PluginDestinationTest, self).setUp()
         self._tv_map = {}
-        self.old_template_values = plugins.template_values
-        plugins.template_values = self._template_values
+        self.old_template_field_getters = plugins.template_field_getters
+        plugins.template_field_getters = self._template_field_getters
 
         self.lib = beets.library.Library(':memory:')
         self.lib.directory = '/base'
@@ -597,7 +1153,7 @@ class PluginDestinationTest(_common.TestCase):
         self.i = item(self.lib)
     def tearDown(self):
         super(PluginDestinationTest, self).tearDown()
-        plugins.template_values = self.old_template_values
+        plugins.template_field_getters = self.old_template_field_getters
 
     def _assert_dest(self, dest):
         self.assertEqual(self.i.destination(pathmod=posixpath),
@@ -625,6 +1181,89 @@ class PluginDestinationTest(_common.TestCase):
         self._assert_dest('the artist bar_baz')
 
 
+class TemplateFormatterTest(_common.TestCase):
+    def setUp(self):
+        super(TemplateFormatterTest, self).setUp()
+        self.lib = beets.library.Library(':memory:')
+        self.lib.directory = '/base'
+        self.i = item(self.lib)
+        self.i.foo = u'flexvalue'
+        self.i.store()
+        self.i2 = item(self.lib)
+        self.album = self.lib.add_album([self.i, self.i2])
+
+    def _format(self, fmt, obj):
+        formatter = beets.library.TemplateFormatter(Template(fmt))
+        return formatter.format(obj)
+
+    def test_item_fields(self):
+        self.assertEqual(self._format(u'$artist - $title $path', self.i),
+                         u'the artist - the title ' +
+                         util.displayable_path(self.i.path))
+
+    def test_item_flex_and_missing_fields(self):
+        self.assertEqual(self._format(u'$foo $nonexistent', self.i),
+                         u'flexvalue $nonexistent')
+
+    def test_item_function(self):
+        self.assertEqual(self._format(u'%upper{$title}', self.i),
+                         u'THE TITLE')
+
+    def test_album_fields(self):
+        self.assertEqual(self._format(u'$albumartist - $album', self.album),
+                         u'the album artist - the album')
+
+    def test_artist_falls_back_to_album_artist(self):
+        self.album.albumartist = u'the album artist'
+        self.album.store()
+        self.i.load()
+        self.i.artist = u''
+        tmpl = Template(u'$artist')
+        formatter = beets.library.TemplateFormatter(tmpl)
+        self.assertEqual(formatter.format(self.i), u'the album artist')
+
+    def test_album_values_override_item_values(self):
+        self.album.album = u'changed album'
+        self.album.store()
+        self.i2.album = u'stale album'
+        tmpl = Template(u'$album')
+        formatter = beets.library.TemplateFormatter(tmpl)
+        self.assertEqual(formatter.format(self.i2), u'changed album')
+
+    def test_album_fetched_once_for_its_tracks(self):
+        formatter = beets.library.TemplateFormatter(Template(u'$album'))
+        counter = _common.count_statements(self.lib)
+        formatter.format(self.i)
+        formatter.format(self.i2)
+        album_queries = [st for st in counter.statements
+                         if st.startswith('SELECT * FROM albums')]
+        self.assertEqual(len(album_queries), 1)
+
+    def test_album_not_fetched_for_item_fields(self):
+        formatter = beets.library.TemplateFormatter(Template(u'$title'))
+        counter = _common.count_statements(self.lib)
+        formatter.format(self.i)
+        self.assertEqual(counter.statements, [])
+
+    def test_plugin_field_computed_only_when_used(self):
+        calls = []
+
+        def getter(item):
+            calls.append(item)
+            return u'computed'
+        old_getters = plugins.template_field_getters
+        plugins.template_field_getters = lambda: {'pfield': getter}
+        try:
+            used = beets.library.TemplateFormatter(Template(u'$pfield'))
+            unused = beets.library.TemplateFormatter(Template(u'$title'))
+        finally:
+            plugins.template_field_getters = old_getters
+        unused.format(self.i)
+        self.assertEqual(calls, [])
+        self.assertEqual(used.format(self.i), u'computed')
+        self.assertEqual(len(calls), 1)
+
+
 class MigrationTest(_common.TestCase):
     """Tests the ability to change the database schema between
     versions.
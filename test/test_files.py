@@ -17,6 +17,8 @@
 import shutil
 import os
 import stat
+import errno
+import ctypes
 from os.path import join
 
 import _common
@@ -147,6 +149,20 @@ class HelperTest(_common.TestCase):
         a =  ['a', 'b', 'c']
         self.assertEqual(util.components(p), a)
 
+    def test_mkdirall_tolerates_concurrent_creation(self):
+        path = os.path.join(self.temp_dir, 'a', 'b', 'c.mp3')
+        real_mkdir = os.mkdir
+        def racing_mkdir(path, *args):
+            # Another thread wins the race to create the directory.
+            real_mkdir(path, *args)
+            raise OSError(17, 'File exists')
+        os.mkdir = racing_mkdir
+        try:
+            util.mkdirall(path)
+        finally:
+            os.mkdir = real_mkdir
+        self.assertTrue(os.path.isdir(os.path.dirname(path)))
+
 class AlbumFileTest(_common.TestCase):
     def setUp(self):
         super(AlbumFileTest, self).setUp()
@@ -488,6 +504,80 @@ class SafeMoveCopyTest(_common.TestCase):
         util.copy(self.path, self.path)
         self.assertExists(self.path)
 
+    def test_successful_link(self):
+        self.assertEqual(util.link(self.path, self.dest), 'link')
+        self.assertEqual(os.stat(self.dest).st_ino, os.stat(self.path).st_ino)
+
+    def test_unsuccessful_link(self):
+        with self.assertRaises(util.FilesystemError):
+            util.link(self.path, self.otherpath)
+
+    def test_move_reports_rename(self):
+        self.assertEqual(util.move(self.path, self.dest), 'rename')
+
+class CopyMethodTest(_common.TestCase):
+    def setUp(self):
+        super(CopyMethodTest, self).setUp()
+        self.path = os.path.join(self.temp_dir, 'testfile')
+        self.data = ''.join(chr(i % 256) for i in range(300000))
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.dest = self.path + '.dest'
+
+    def _unsupported(self, infd, outfd):
+        os.write(outfd, 'partial')
+        raise OSError(errno.EXDEV, 'unsupported')
+
+    def _failing(self, infd, outfd):
+        raise OSError(errno.EIO, 'failed')
+
+    def _copied(self):
+        with open(self.dest, 'rb') as f:
+            return f.read() == self.data
+
+    def test_every_method_copies_contents(self):
+        for method in util.COPY_METHODS:
+            try:
+                util.copy_contents(self.path, self.dest, [method])
+            except (OSError, IOError) as exc:
+                # Not all filesystems can clone files.
+                if exc.errno not in util.UNSUPPORTED_ERRNOS:
+                    raise
+            else:
+                self.assertTrue(self._copied(), method[0])
+
+    def test_copy_reports_method(self):
+        method = util.copy(self.path, self.dest)
+        self.assertTrue(method in [name for name, _ in util.COPY_METHODS])
+        self.assertTrue(self._copied())
+
+    def test_falls_back_when_unsupported(self):
+        methods = [('unsupported', self._unsupported),
+                   ('buffered', util._copy_buffered)]
+        self.assertEqual(util.copy_contents(self.path, self.dest, methods),
+                         'buffered')
+        self.assertTrue(self._copied())
+
+    def test_other_errors_raised(self):
+        methods = [('failing', self._failing),
+                   ('buffered', util._copy_buffered)]
+        with self.assertRaises(OSError):
+            util.copy_contents(self.path, self.dest, methods)
+
+    def test_methods_found_without_ssize_t(self):
+        # Python 2.6's ctypes has no c_ssize_t.
+        ssize_t = getattr(ctypes, 'c_ssize_t', None)
+        if ssize_t is not None:
+            del ctypes.c_ssize_t
+        try:
+            methods = util._copy_methods()
+        finally:
+            if ssize_t is not None:
+                ctypes.c_ssize_t = ssize_t
+                util._copy_methods()
+        self.assertEqual([name for name, _ in methods],
+                         [name for name, _ in util.COPY_METHODS])
+
 class PruneTest(_common.TestCase):
     def setUp(self):
         super(PruneTest, self).setUp()
@@ -546,6 +636,65 @@ class WalkTest(_common.TestCase):
         self.assertEqual(res[0],
                          (self.base, [], []))
 
+    def test_ignore_multiple_patterns(self):
+        touch(os.path.join(self.base, 'x~'))
+        res = list(util.sorted_walk(self.base, ('*~', 'y', '[q-x]')))
+        self.assertEqual(res[0], (self.base, ['d'], []))
+
+    def test_workers_preserve_order(self):
+        for name in ('b', 'a', 'C'):
+            os.mkdir(os.path.join(self.base, 'd', name))
+            os.mkdir(os.path.join(self.base, 'd', name, 'sub'))
+            touch(os.path.join(self.base, 'd', name, 'sub', 'f'))
+        serial = list(util.sorted_walk(self.base))
+        self.assertEqual(list(util.sorted_walk(self.base, workers=3)),
+                         serial)
+        self.assertEqual([r[0] for r in serial], [
+            self.base,
+            os.path.join(self.base, 'd'),
+            os.path.join(self.base, 'd', 'a'),
+            os.path.join(self.base, 'd', 'a', 'sub'),
+            os.path.join(self.base, 'd', 'b'),
+            os.path.join(self.base, 'd', 'b', 'sub'),
+            os.path.join(self.base, 'd', 'C'),
+            os.path.join(self.base, 'd', 'C', 'sub'),
+        ])
+
+    def test_directory_entries_give_types(self):
+        class Entry(object):
+            def __init__(self, name, is_dir):
+                self.name = name
+                self._is_dir = is_dir
+            def is_dir(self):
+                return self._is_dir
+        def fake_scandir(path):
+            # Claim that everything but 'd' is a file without checking.
+            return [Entry(name, name == 'd') for name in os.listdir(path)]
+
+        old_scandir = util.scandir
+        util.scandir = fake_scandir
+        try:
+            res = list(util.sorted_walk(self.base))
+        finally:
+            util.scandir = old_scandir
+        self.assertEqual(res[0], (self.base, ['d'], ['x', 'y']))
+
+    def test_unchanged_directories_skipped(self):
+        mtimes = {}
+        first = list(util.sorted_walk(self.base, mtimes=mtimes))
+        self.assertEqual(len(first), 2)
+        self.assertEqual(list(util.sorted_walk(self.base, mtimes=mtimes)),
+                         [])
+
+    def test_changed_directory_walked_again(self):
+        mtimes = {}
+        list(util.sorted_walk(self.base, mtimes=mtimes))
+        subdir = os.path.join(self.base, 'd')
+        touch(os.path.join(subdir, 'new'))
+        os.utime(subdir, (0, 0))
+        res = list(util.sorted_walk(self.base, mtimes=mtimes))
+        self.assertEqual(res, [(subdir, [], ['new', 'z'])])
+
 class UniquePathTest(_common.TestCase):
     def setUp(self):
         super(UniquePathTest, self).setUp()
@@ -17,6 +17,10 @@
 import os
 import shutil
 import StringIO
+import pickle
+import sqlite3
+import time
+import threading
 
 import _common
 from _common import unittest
@@ -25,6 +29,9 @@ from beets import importer
 from beets import mediafile
 from beets.autotag import AlbumInfo, TrackInfo, AlbumMatch, TrackMatch
 from beets import config
+from beets import util
+from beets import plugins
+from beets.util import pipeline
 
 TEST_TITLES = ('The Opener', 'The Second Track', 'The Last Track')
 class NonAutotaggedImportTest(_common.TestCase):
@@ -62,7 +69,8 @@ class NonAutotaggedImportTest(_common.TestCase):
         return realpath
 
     def _run_import(self, titles=TEST_TITLES, delete=False, threaded=False,
-                    singletons=False, move=False):
+                    singletons=False, move=False, stats=None,
+                    file_workers=1, link=False):
         # Make a bunch of tracks to import.
         paths = []
         for i, title in enumerate(titles):
@@ -80,11 +88,14 @@ class NonAutotaggedImportTest(_common.TestCase):
         config['import']['threaded'] = threaded
         config['import']['singletons'] = singletons
         config['import']['move'] = move
+        config['import']['link'] = link
         config['import']['autotag'] = False
+        config['import']['file_workers'] = file_workers
         session = importer.ImportSession(self.lib,
                                             logfile=None,
                                             paths=[os.path.dirname(paths[0])],
                                             query=None)
+        session.stats = stats
         session.run()
 
         return paths
@@ -132,6 +143,54 @@ class NonAutotaggedImportTest(_common.TestCase):
         for path in paths:
             self.assertFalse(os.path.exists(path))
 
+    def test_import_link(self):
+        paths = self._run_import(link=True)
+        self._copy_arrives()
+        for path in paths:
+            self.assertEqual(os.stat(path).st_nlink, 2)
+        for item in self.lib.items():
+            self.assertTrue(item.path.startswith(self.libdir))
+
+    def test_import_move_overrides_link(self):
+        paths = self._run_import(move=True, link=True)
+        self._copy_arrives()
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_threaded_import_parallel_files(self):
+        paths = self._run_import(threaded=True, file_workers=2)
+        self._copy_arrives()
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+        for item in self.lib.items():
+            self.assertTrue(item.path.startswith(self.libdir))
+
+    def test_threaded_import_parallel_move(self):
+        paths = self._run_import(threaded=True, move=True, file_workers=2)
+        self._copy_arrives()
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+
+    def test_parallel_files_scheduled_in_own_stage(self):
+        stats = pipeline.PipelineStats()
+        self._run_import(threaded=True, stats=stats, file_workers=2)
+        names = [s['name'] for s in stats.summary()['stages']]
+        self.assertEqual(names[-3:], [
+            'schedule_files', 'manipulate_files', 'finalize',
+        ])
+
+    def test_threaded_import_records_stats(self):
+        stats = pipeline.PipelineStats()
+        self._run_import(threaded=True, stats=stats)
+        stages = stats.summary()['stages']
+        self.assertEqual([s['name'] for s in stages], [
+            'read_tasks', 'show_progress', 'apply_choices',
+            'manipulate_files', 'finalize',
+        ])
+        # One album task and its sentinel.
+        self.assertEqual(stages[0]['messages_out'], 2)
+        self.assertEqual(stages[-1]['messages_in'], 2)
+
     def test_import_no_delete(self):
         paths = self._run_import(['sometrack'], delete=False)
         self.assertTrue(os.path.exists(paths[0]))
@@ -171,6 +230,280 @@ def _call_stages(session, items, choice_or_info,
 
     return task
 
+class ReadTasksTest(_common.TestCase):
+    def setUp(self):
+        super(ReadTasksTest, self).setUp()
+        self.base = os.path.join(self.temp_dir, 'import')
+        self.dirs = []
+        for name in ('album1', 'album2', 'album3'):
+            path = os.path.join(self.base, name)
+            os.makedirs(path)
+            shutil.copy(os.path.join(_common.RSRC, 'min.mp3'),
+                        os.path.join(path, 'track.mp3'))
+            self.dirs.append(path)
+        self.session = importer.ImportSession(None, None, [self.base], None)
+
+        # Record the files that are read.
+        self.read = []
+        self.old_from_path = library.Item.from_path
+        def from_path(path):
+            self.read.append(path)
+            return self.old_from_path(path)
+        library.Item.from_path = staticmethod(from_path)
+
+    def tearDown(self):
+        super(ReadTasksTest, self).tearDown()
+        library.Item.from_path = self.old_from_path
+
+    def _task_paths(self):
+        return [task.paths for task in importer.read_tasks(self.session)
+                if not task.sentinel]
+
+    def test_reads_all_albums(self):
+        config['import']['resume'] = False
+        self.assertEqual(self._task_paths(), [[d] for d in self.dirs])
+        self.assertEqual(len(self.read), 3)
+
+    def test_resume_skips_reading_finished_albums(self):
+        config['import']['resume'] = True
+        importer.progress_set(self.base, [self.dirs[1]])
+        self.assertEqual(self._task_paths(), [[self.dirs[2]]])
+        self.assertEqual(self.read,
+                         [os.path.join(self.dirs[2], 'track.mp3')])
+
+    def test_incremental_skips_reading_imported_albums(self):
+        config['import']['resume'] = False
+        config['import']['incremental'] = True
+        importer.history_add([self.dirs[0]])
+        self.assertEqual(self._task_paths(), [[d] for d in self.dirs[1:]])
+        self.assertEqual(len(self.read), 2)
+
+class ImportStateTest(_common.TestCase):
+    def setUp(self):
+        super(ImportStateTest, self).setUp()
+        self.db_path = os.path.join(self.temp_dir, 'test_state.db')
+        self.pickle_path = os.path.join(self.temp_dir, 'test_state.pickle')
+
+    def _committed_history(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM history').fetchone()[0]
+        finally:
+            conn.close()
+
+    def test_progress_round_trip(self):
+        state = importer.ImportState(self.db_path)
+        state.progress_set('/top', ['/top/a', '/top/b'])
+        self.assertEqual(state.progress_get('/top'), ['/top/a', '/top/b'])
+        state.progress_set('/top', None)
+        self.assertEqual(state.progress_get('/top'), None)
+
+    def test_history_lookup(self):
+        state = importer.ImportState(self.db_path)
+        state.history_add(['/top/a'])
+        self.assertTrue(state.in_history(['/top/a']))
+        self.assertFalse(state.in_history(['/top/b']))
+        self.assertEqual(state.history(), set([('/top/a',)]))
+
+    def test_changes_committed_in_batches(self):
+        state = importer.ImportState(self.db_path)
+        state.COMMIT_CHANGES = 3
+        state.COMMIT_INTERVAL = 1000
+        state.history_add(['/a'])
+        state.history_add(['/b'])
+        self.assertEqual(self._committed_history(), 0)
+        state.history_add(['/c'])
+        self.assertEqual(self._committed_history(), 3)
+        state.history_add(['/d'])
+        state.flush()
+        self.assertEqual(self._committed_history(), 4)
+
+    def test_migrates_pickled_state(self):
+        with open(self.pickle_path, 'w') as f:
+            pickle.dump({
+                importer.PROGRESS_KEY: {'/top': ['/top/a']},
+                importer.HISTORY_KEY: set([('/old/a', '/old/b')]),
+            }, f)
+        state = importer.ImportState(self.db_path, self.pickle_path)
+        self.assertEqual(state.progress_get('/top'), ['/top/a'])
+        self.assertTrue(state.in_history(['/old/a', '/old/b']))
+
+    def test_migrates_only_once(self):
+        with open(self.pickle_path, 'w') as f:
+            pickle.dump({importer.PROGRESS_KEY: {'/top': ['/top/a']}}, f)
+        state = importer.ImportState(self.db_path, self.pickle_path)
+        state.progress_set('/top', None)
+        state.close()
+        state = importer.ImportState(self.db_path, self.pickle_path)
+        self.assertEqual(state.progress_get('/top'), None)
+
+class GroupCommitTest(_common.TestCase):
+    def setUp(self):
+        super(GroupCommitTest, self).setUp()
+        self.db_path = os.path.join(self.temp_dir, 'group.db')
+        self.lib = library.Library(self.db_path)
+        self.done = []
+
+    def _committed_items(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        finally:
+            conn.close()
+
+    def _task_done(self, commits, name):
+        self.lib.add(_common.item())
+        commits.task_done(lambda: self.done.append(name))
+
+    def test_tasks_committed_together(self):
+        with importer.GroupCommit(self.lib, 3, 1000) as commits:
+            self._task_done(commits, 'a')
+            self._task_done(commits, 'b')
+            self.assertEqual(self._committed_items(), 0)
+            self.assertEqual(self.done, [])
+            self._task_done(commits, 'c')
+            self.assertEqual(self._committed_items(), 3)
+            self.assertEqual(self.done, ['a', 'b', 'c'])
+
+    def test_flushed_when_aborted(self):
+        try:
+            with importer.GroupCommit(self.lib, 3, 1000) as commits:
+                self._task_done(commits, 'a')
+                raise importer.ImportAbort()
+        except importer.ImportAbort:
+            pass
+        self.assertEqual(self._committed_items(), 1)
+        self.assertEqual(self.done, ['a'])
+
+    def test_committed_after_delay(self):
+        with importer.GroupCommit(self.lib, 100, 0.01) as commits:
+            self._task_done(commits, 'a')
+            for _ in range(100):
+                if self._committed_items():
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self._committed_items(), 1)
+            # The function waits for the thread reporting tasks.
+            self.assertEqual(self.done, [])
+            self._task_done(commits, 'b')
+            self.assertEqual(self.done, ['a'])
+        self.assertEqual(self.done, ['a', 'b'])
+
+    def test_callbacks_called_in_reporting_thread(self):
+        threads = []
+        with importer.GroupCommit(self.lib, 100, 0.01) as commits:
+            commits.task_done(
+                lambda: threads.append(threading.current_thread())
+            )
+            time.sleep(0.05)
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_callback_error_raised_and_others_kept(self):
+        def fail():
+            raise util.FilesystemError('failed', 'delete', ('a',))
+        with importer.GroupCommit(self.lib, 3, 1000) as commits:
+            commits.task_done(fail)
+            self._task_done(commits, 'a')
+            self.assertRaises(util.FilesystemError,
+                              self._task_done, commits, 'b')
+            self.assertEqual(self.done, [])
+            commits.flush()
+            self.assertEqual(self.done, ['a', 'b'])
+
+    def test_callback_errors_logged_when_aborted(self):
+        def fail():
+            raise util.FilesystemError('failed', 'delete', ('a',))
+        try:
+            with importer.GroupCommit(self.lib, 3, 1000) as commits:
+                commits.task_done(fail)
+                self._task_done(commits, 'a')
+                raise importer.ImportAbort()
+        except importer.ImportAbort:
+            pass
+        self.assertEqual(self.done, ['a'])
+
+    def test_single_task_batches_commit_immediately(self):
+        with importer.GroupCommit(self.lib, 1) as commits:
+            self._task_done(commits, 'a')
+            self.assertEqual(self.done, ['a'])
+            self.assertEqual(self._committed_items(), 1)
+
+class FileOperationsTest(_common.TestCase):
+    def setUp(self):
+        super(FileOperationsTest, self).setUp()
+        self.ops = importer.FileOperations(4)
+        self.calls = []
+
+    def tearDown(self):
+        super(FileOperationsTest, self).tearDown()
+        self.ops.close()
+
+    def _op(self, name, delay=0):
+        time.sleep(delay)
+        self.calls.append(name)
+        return name
+
+    def _fail(self):
+        raise util.FilesystemError(OSError(), 'move', ('a', 'b'))
+
+    def test_same_directory_runs_in_order(self):
+        jobs = [self.ops.submit('dir', self._op, 'a', 0.05),
+                self.ops.submit('dir', self._op, 'b'),
+                self.ops.submit('dir', self._op, 'c')]
+        self.assertEqual([job.get() for job in jobs], ['a', 'b', 'c'])
+        self.assertEqual(self.calls, ['a', 'b', 'c'])
+
+    def test_other_directories_run_concurrently(self):
+        slow = self.ops.submit('one', self._op, 'slow', 0.1)
+        fast = self.ops.submit('two', self._op, 'fast')
+        fast.get()
+        slow.get()
+        self.assertEqual(self.calls, ['fast', 'slow'])
+
+    def test_error_raised_from_get(self):
+        job = self.ops.submit('dir', self._fail)
+        later = self.ops.submit('dir', self._op, 'a')
+        self.assertRaises(util.FilesystemError, job.get)
+        self.assertEqual(later.get(), 'a')
+
+    def test_single_worker_runs_inline(self):
+        ops = importer.FileOperations()
+        job = ops.submit('dir', self._op, 'a')
+        self.assertEqual(self.calls, ['a'])
+        self.assertEqual(job.get(), 'a')
+        ops.close()
+
+class PluginStageTest(_common.TestCase):
+    def setUp(self):
+        super(PluginStageTest, self).setUp()
+        self.lib = library.Library(':memory:')
+        self.session = _common.import_session(self.lib)
+        self.item = _common.item(self.lib)
+        self.task = importer.ImportTask(None, None, [self.item])
+        self.task.set_choice(importer.action.ASIS)
+
+    def _run_stage(self, func):
+        coro = importer.plugin_stage(self.session, func)
+        coro.next()
+        coro.send(self.task)
+
+    def test_direct_changes_not_reloaded(self):
+        counter = _common.count_statements(self.lib)
+        def func(session, task):
+            task.items[0].title = u'changed in place'
+            counter.reset()
+        self._run_stage(func)
+        self.assertEqual(self.item.title, u'changed in place')
+        self.assertEqual(counter.count, 0)
+
+    def test_changes_through_other_objects_reloaded(self):
+        def func(session, task):
+            other = session.lib.get_item(task.items[0].id)
+            other.title = u'changed in database'
+            other.store()
+        self._run_stage(func)
+        self.assertEqual(self.item.title, u'changed in database')
+
 class ImportApplyTest(_common.TestCase):
     def setUp(self):
         super(ImportApplyTest, self).setUp()
@@ -330,6 +663,103 @@ class ImportApplyTest(_common.TestCase):
                      stages=[importer.manipulate_files])
         self.assertExists(self.i.path)
 
+    def _second_item(self):
+        path = os.path.join(self.srcdir, 'testalbum', 'srcfile2.mp3')
+        shutil.copy(self.srcpath, path)
+        item = library.Item.from_path(path)
+        item.comp = False
+        self.lib.add(item)
+        return item
+
+    def test_partial_move_failure_stores_moved_paths(self):
+        i2 = self._second_item()
+        config['import']['move'] = True
+        real_move = util.move
+        def failing_move(path, dest, *args, **kwargs):
+            if path == i2.path:
+                raise util.FilesystemError('failed', 'move', (path, dest))
+            return real_move(path, dest, *args, **kwargs)
+        util.move = failing_move
+        try:
+            self.assertRaises(util.FilesystemError, _call_stages,
+                              self.session, [self.i, i2],
+                              importer.action.ASIS)
+        finally:
+            util.move = real_move
+        # Every stored path still points to the file.
+        for item in self.lib.items():
+            self.assertExists(item.path)
+        self.assertNotExists(self.srcpath)
+
+    def test_rows_committed_before_batched_move(self):
+        config['import']['move'] = True
+        committed = []
+        real_move = util.move
+        def checking_move(path, dest, *args, **kwargs):
+            conn = sqlite3.connect(self.libpath)
+            try:
+                committed.append(
+                    conn.execute('SELECT COUNT(*) FROM albums').fetchone()[0]
+                )
+            finally:
+                conn.close()
+            return real_move(path, dest, *args, **kwargs)
+        self.session.commits = importer.GroupCommit(self.lib, 100, 1000)
+        util.move = checking_move
+        try:
+            with self.session.commits:
+                _call_stages(self.session, [self.i], self.info)
+        finally:
+            util.move = real_move
+        self.assertEqual(committed, [1])
+
+    def test_moves_sent_as_events(self):
+        moved = []
+        class MovePlugin(plugins.BeetsPlugin):
+            pass
+        MovePlugin.register_listener(
+            'item_moved',
+            lambda item, source, destination:
+                moved.append((source, destination))
+        )
+        plugins._classes.append(MovePlugin)
+        plugins._invalidate_tables()
+        config['import']['move'] = True
+        try:
+            _call_stages(self.session, [self.i], self.info)
+        finally:
+            plugins._classes.remove(MovePlugin)
+            plugins._instances.pop(MovePlugin, None)
+            plugins._invalidate_tables()
+        self.assertEqual(moved, [(self.srcpath, self.i.path)])
+
+    def test_reimport_art_copied_from_outside_library(self):
+        # A file outside the library (copied) and, last, one inside it
+        # (moved).
+        internal = os.path.join(self.libdir, 'source.mp3')
+        shutil.copy(self.srcpath, internal)
+        self.lib.add(library.Item.from_path(internal))
+        inner = library.Item.from_path(internal)
+        inner.comp = False
+        art = os.path.join(self.srcdir, 'art.jpg')
+        _common.touch(art)
+
+        task = importer.ImportTask(None, None, [self.i, inner])
+        task.is_album = True
+        task.set_choice(importer.action.ASIS)
+        apply_coro = importer.apply_choices(self.session)
+        apply_coro.next()
+        apply_coro.send(task)
+        album = self.lib.get_album(task.album_id)
+        album.artpath = art
+        album.store()
+        manip_coro = importer.manipulate_files(self.session)
+        manip_coro.next()
+        manip_coro.send(task)
+
+        self.assertExists(art)
+        self.assertExists(self.lib.get_album(task.album_id).artpath)
+
 class AsIsApplyTest(_common.TestCase):
     def setUp(self):
         super(AsIsApplyTest, self).setUp()
@@ -649,6 +1079,7 @@ class DuplicateCheckTest(_common.TestCase):
         self.lib = library.Library(':memory:')
         self.i = _common.item()
         self.album = self.lib.add_album([self.i])
+        self.index = importer.DuplicateIndex(self.lib)
 
     def _album_task(self, asis, artist=None, album=None, existing=False):
         if existing:
@@ -686,60 +1117,122 @@ class DuplicateCheckTest(_common.TestCase):
         return task
 
     def test_duplicate_album_apply(self):
-        res = importer._duplicate_check(self.lib, self._album_task(False))
+        res = self.index.albums(self._album_task(False))
         self.assertTrue(res)
 
     def test_different_album_apply(self):
-        res = importer._duplicate_check(self.lib,
-                                        self._album_task(False, 'xxx', 'yyy'))
+        res = self.index.albums(self._album_task(False, 'xxx', 'yyy'))
         self.assertFalse(res)
 
     def test_duplicate_album_asis(self):
-        res = importer._duplicate_check(self.lib, self._album_task(True))
+        res = self.index.albums(self._album_task(True))
         self.assertTrue(res)
 
     def test_different_album_asis(self):
-        res = importer._duplicate_check(self.lib,
-                                        self._album_task(True, 'xxx', 'yyy'))
+        res = self.index.albums(self._album_task(True, 'xxx', 'yyy'))
         self.assertFalse(res)
 
     def test_duplicate_va_album(self):
         self.album.albumartist = 'an album artist'
         self.album.store()
-        res = importer._duplicate_check(self.lib,
-                    self._album_task(False, 'an album artist'))
+        res = self.index.albums(self._album_task(False, 'an album artist'))
         self.assertTrue(res)
 
     def test_duplicate_item_apply(self):
-        res = importer._item_duplicate_check(self.lib,
-                                             self._item_task(False))
+        res = self.index.items(self._item_task(False))
         self.assertTrue(res)
 
     def test_different_item_apply(self):
-        res = importer._item_duplicate_check(self.lib,
-                                    self._item_task(False, 'xxx', 'yyy'))
+        res = self.index.items(self._item_task(False, 'xxx', 'yyy'))
         self.assertFalse(res)
 
     def test_duplicate_item_asis(self):
-        res = importer._item_duplicate_check(self.lib,
-                                             self._item_task(True))
+        res = self.index.items(self._item_task(True))
         self.assertTrue(res)
 
     def test_different_item_asis(self):
-        res = importer._item_duplicate_check(self.lib,
-                                    self._item_task(True, 'xxx', 'yyy'))
+        res = self.index.items(self._item_task(True, 'xxx', 'yyy'))
         self.assertFalse(res)
 
     def test_duplicate_album_existing(self):
-        res = importer._duplicate_check(self.lib,
-                                        self._album_task(False, existing=True))
+        res = self.index.albums(self._album_task(False, existing=True))
         self.assertFalse(res)
 
     def test_duplicate_item_existing(self):
-        res = importer._item_duplicate_check(self.lib,
-                                        self._item_task(False, existing=True))
+        res = self.index.items(self._item_task(False, existing=True))
         self.assertFalse(res)
 
+    def test_duplicate_album_by_mbid(self):
+        task = self._album_task(False, 'xxx', 'yyy')
+        task.match.info.album_id = self.album.mb_albumid
+        res = self.index.albums(task)
+        self.assertEqual([a.id for a in res], [self.album.id])
+
+    def test_duplicate_item_by_mbid(self):
+        task = self._item_task(False, 'xxx', 'yyy')
+        task.match.info.track_id = self.i.mb_trackid
+        res = self.index.items(task)
+        self.assertEqual([i.id for i in res], [self.i.id])
+
+    def test_checks_after_first_do_not_query_library(self):
+        self.index.albums(self._album_task(False))
+        counter = _common.count_statements(self.lib)
+        self.assertFalse(self.index.albums(self._album_task(False, 'x', 'y')))
+        self.assertEqual(counter.count, 0)
+
+    def test_added_album_found(self):
+        self.index.albums(self._album_task(False))
+        new_item = _common.item()
+        new_item.albumartist = new_item.artist = 'new artist'
+        new_item.album = 'new album'
+        self.index.add_album(self.lib.add_album([new_item]))
+        res = self.index.albums(self._album_task(False, 'new artist',
+                                                 'new album'))
+        self.assertTrue(res)
+        res = self.index.items(self._item_task(False, 'new artist'))
+        self.assertTrue(res)
+
+    def test_album_added_while_building_found(self):
+        new_item = _common.item()
+        new_item.albumartist = new_item.artist = 'new artist'
+        new_item.album = 'new album'
+        real_index = self.index._index
+        def index_then_add(*args):
+            index = real_index(*args)
+            # Another thread adds an album after the query.
+            self.index.add_album(self.lib.add_album([new_item]))
+            return index
+        self.index._index = index_then_add
+        self.index.albums(self._album_task(False))
+        self.index._index = real_index
+        res = self.index.albums(self._album_task(False, 'new artist',
+                                                 'new album'))
+        self.assertTrue(res)
+
+    def test_index_built_while_transaction_held(self):
+        # Another thread builds the index while this one adds an album
+        # inside a transaction.
+        thread = threading.Thread(
+            target=self.index.albums, args=(self._album_task(False),)
+        )
+        with self.lib.transaction():
+            thread.start()
+            thread.join(0.1)
+            self.index.add_album(self.album)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_removed_album_not_found(self):
+        self.index.albums(self._album_task(False))
+        self.i.remove()
+        self.album.remove()
+        self.assertFalse(self.index.albums(self._album_task(False)))
+
+    def test_reserved_tasks_are_duplicates(self):
+        self.assertFalse(self.index.reserve(self._album_task(False, 'a', 'b')))
+        self.assertTrue(self.index.reserve(self._album_task(True, 'a', 'b')))
+        self.assertFalse(self.index.reserve(self._item_task(False, 'a', 'b')))
+
 class TagLogTest(_common.TestCase):
     def test_tag_log_line(self):
         sio = StringIO.StringIO()
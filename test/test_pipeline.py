@@ -14,6 +14,9 @@
 
 """Test the "pipeline.py" restricted parallel programming library.
 """
+import time
+import random
+
 from _common import unittest
 from beets.util import pipeline
 
@@ -58,6 +61,19 @@ def _multi_work():
         i = yield i
         i = pipeline.multiple([i, -i])
 
+# A worker that takes a varying amount of time.
+def _slow_work():
+    i = None
+    while True:
+        i = yield i
+        time.sleep(random.random() * 0.01)
+        if i % 3 == 0:
+            i = pipeline.multiple([i, -i])
+        elif i % 3 == 1:
+            i = pipeline.BUBBLE
+        else:
+            i *= 2
+
 class SimplePipelineTest(unittest.TestCase):
     def setUp(self):
         self.l = []
@@ -87,6 +103,54 @@ class ParallelStageTest(unittest.TestCase):
         # Order possibly not preserved; use set equality.
         self.assertEqual(set(self.l), set([0,2,4,6,8]))
 
+class OrderedStageTest(unittest.TestCase):
+    def _expected(self, num):
+        out = []
+        for i in range(num):
+            if i % 3 == 0:
+                out += [i, -i]
+            elif i % 3 == 2:
+                out.append(i * 2)
+        return out
+
+    def test_run_sequential(self):
+        l = []
+        pl = pipeline.Pipeline((
+            _produce(20), pipeline.OrderedStage([_slow_work(), _slow_work()]),
+            _consume(l)
+        ))
+        pl.run_sequential()
+        self.assertEqual(l, self._expected(20))
+
+    def test_run_parallel_preserves_order(self):
+        l = []
+        pl = pipeline.Pipeline((
+            _produce(100),
+            pipeline.OrderedStage([_slow_work() for _ in range(4)]),
+            _consume(l)
+        ))
+        pl.run_parallel()
+        self.assertEqual(l, self._expected(100))
+
+    def test_constrained_buffer(self):
+        l = []
+        pl = pipeline.Pipeline((
+            _produce(100),
+            pipeline.OrderedStage([_slow_work() for _ in range(4)], 1),
+            _consume(l)
+        ))
+        pl.run_parallel(1)
+        self.assertEqual(l, self._expected(100))
+
+    def test_exception(self):
+        l = []
+        pl = pipeline.Pipeline((
+            _produce(100),
+            pipeline.OrderedStage([_exc_work(), _exc_work()], 2),
+            _consume(l)
+        ))
+        self.assertRaises(TestException, pl.run_parallel, 1)
+
 class ExceptionTest(unittest.TestCase):
     def setUp(self):
         self.l = []
@@ -159,6 +223,72 @@ class MultiMessageTest(unittest.TestCase):
         self.pl.run_parallel()
         self.assertEqual(self.l, [0,0,1,-1,2,-2,3,-3,4,-4])
 
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        self.l = []
+        self.stats = pipeline.PipelineStats()
+
+    def _counts(self):
+        return [(s['name'], s['messages_in'], s['messages_out'])
+                for s in self.stats.summary()['stages']]
+
+    def test_run_sequential(self):
+        pl = pipeline.Pipeline((_produce(), _multi_work(), _consume(self.l)))
+        pl.run_sequential(self.stats)
+        self.assertEqual(self.l, [0,0,1,-1,2,-2,3,-3,4,-4])
+        self.assertEqual(self._counts(), [
+            ('_produce', 0, 5), ('_multi_work', 5, 10), ('_consume', 10, 0),
+        ])
+
+    def test_run_parallel(self):
+        pl = pipeline.Pipeline((
+            _produce(), (_work(), _work()), _consume(self.l)
+        ))
+        pl.run_parallel(2, self.stats)
+        self.assertEqual(set(self.l), set([0,2,4,6,8]))
+        self.assertEqual(self._counts(), [
+            ('_produce', 0, 5), ('_work', 5, 5), ('_consume', 5, 0),
+        ])
+        summary = self.stats.summary()
+        self.assertEqual([s['threads'] for s in summary['stages']],
+                         [1, 2, 1])
+        for queue in summary['queues']:
+            self.assertEqual(queue['size'], 2)
+            self.assertTrue(1 <= queue['high_water'] <= 2)
+
+    def test_ordered_stage(self):
+        pl = pipeline.Pipeline((
+            _produce(30),
+            pipeline.OrderedStage([_slow_work() for _ in range(3)]),
+            _consume(self.l)
+        ))
+        pl.run_parallel(stats=self.stats)
+        self.assertEqual(self._counts()[1], ('_slow_work', 30, 30))
+        self.assertEqual(self._counts()[2][1], len(self.l))
+
+    def test_waiting_time_recorded(self):
+        def slow_consume():
+            while True:
+                yield
+                time.sleep(0.01)
+        pl = pipeline.Pipeline((_produce(10), _work(), slow_consume()))
+        pl.run_parallel(1, self.stats)
+        stages = self.stats.summary()['stages']
+        self.assertTrue(stages[0]['wait_out'] > 0.0)
+        self.assertTrue(stages[2]['work'] >= 0.09)
+
+    def test_custom_names_and_report(self):
+        pl = pipeline.Pipeline((_produce(), _work(), _consume(self.l)),
+                               ['read', None])
+        pl.run_parallel(stats=self.stats)
+        report = self.stats.report()
+        self.assertEqual(len(report), 6)
+        self.assertTrue(
+            report[1].startswith(u'read (threads: 1): 0 in, 5 out')
+        )
+        self.assertTrue(report[2].startswith(u'  queue: at most'))
+        self.assertTrue(report[3].startswith(u'_work (threads: 1)'))
+
 def suite():
     return unittest.TestLoader().loadTestsFromName(__name__)
 
@@ -0,0 +1,126 @@
+# This file is part of beets.
+# Copyright 2013, Adrian Sampson.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Tests for plugin event and template dispatch.
+"""
+import _common
+from _common import unittest
+import beets.library
+from beets import plugins
+
+
+class DispatchTest(_common.TestCase):
+    def setUp(self):
+        super(DispatchTest, self).setUp()
+        self.calls = []
+
+        class TestPlugin(plugins.BeetsPlugin):
+            pass
+        self.plugin_class = TestPlugin
+        self._register(TestPlugin)
+        plugins.reset_timings()
+
+    def tearDown(self):
+        super(DispatchTest, self).tearDown()
+        plugins._classes.remove(self.plugin_class)
+        plugins._instances.pop(self.plugin_class, None)
+        plugins._invalidate_tables()
+        plugins.reset_timings()
+
+    def _register(self, cls):
+        plugins._classes.append(cls)
+        plugins._invalidate_tables()
+
+    def _handler(self, **kwargs):
+        self.calls.append(kwargs)
+
+    def test_send_calls_registered_listener(self):
+        self.plugin_class.register_listener('test_event', self._handler)
+        self.assertEqual(plugins.send('test_event', foo='bar'), 1)
+        self.assertEqual(self.calls, [{'foo': 'bar'}])
+
+    def test_send_unknown_event(self):
+        self.assertEqual(plugins.send('test_nothing'), 0)
+
+    def test_tables_reused_between_events(self):
+        self.plugin_class.register_listener('test_event', self._handler)
+        plugins.send('test_event')
+        tables = plugins._dispatch_tables()
+        plugins.send('test_event')
+        self.assertTrue(plugins._dispatch_tables() is tables)
+
+    def test_listener_registered_after_dispatch(self):
+        plugins.send('test_event')
+        self.plugin_class.register_listener('test_event', self._handler)
+        self.assertEqual(plugins.send('test_event'), 1)
+
+    def test_template_field_of_new_plugin(self):
+        plugins.template_field_getters()
+
+        class OtherPlugin(plugins.BeetsPlugin):
+            def __init__(self):
+                super(OtherPlugin, self).__init__()
+                self.template_fields['testfield'] = len
+        self._register(OtherPlugin)
+        try:
+            self.assertTrue(
+                plugins.template_field_getters()['testfield'] is len
+            )
+        finally:
+            plugins._classes.remove(OtherPlugin)
+            plugins._instances.pop(OtherPlugin, None)
+
+    def test_sql_function_on_existing_connection(self):
+        lib = beets.library.Library(':memory:')
+        with lib.transaction() as tx:
+            tx.query('SELECT 1')
+
+        class OtherPlugin(plugins.BeetsPlugin):
+            def sql_functions(self):
+                return {'testfunc': lambda *args: len(args)}
+        self._register(OtherPlugin)
+        try:
+            with lib.transaction() as tx:
+                rows = tx.query('SELECT testfunc(1, 2)')
+            self.assertEqual(rows[0][0], 2)
+        finally:
+            plugins._classes.remove(OtherPlugin)
+            plugins._instances.pop(OtherPlugin, None)
+
+    def test_timings_counted_per_event_and_handler(self):
+        self.plugin_class.register_listener('test_event', self._handler)
+        plugins.send('test_event')
+        plugins.send('test_event')
+        events, handlers = plugins.event_timings()
+        self.assertEqual([(e, c) for e, c, _ in events], [('test_event', 2)])
+        self.assertEqual(len(handlers), 1)
+        event, name, calls, _ = handlers[0]
+        self.assertEqual(event, 'test_event')
+        self.assertTrue(name.endswith('DispatchTest._handler'))
+        self.assertEqual(calls, 2)
+
+    def test_timing_report_lists_handlers(self):
+        self.plugin_class.register_listener('test_event', self._handler)
+        plugins.send('test_event')
+        report = plugins.timing_report()
+        self.assertEqual(len(report), 2)
+        self.assertTrue(report[0].startswith(u'event test_event: 1 calls'))
+        self.assertTrue(u'_handler: 1 calls' in report[1])
+
+
+def suite():
+    return unittest.TestLoader().loadTestsFromName(__name__)
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -93,9 +93,11 @@ class AssertsMixin(object):
 # A test case class providing a library with some dummy data and some
 # assertions involving that data.
 class DummyDataTestCase(_common.TestCase, AssertsMixin):
+    fts = False
+
     def setUp(self):
         super(DummyDataTestCase, self).setUp()
-        self.lib = beets.library.Library(':memory:')
+        self.lib = beets.library.Library(':memory:', fts=self.fts)
         items = [_common.item() for _ in range(3)]
         items[0].title = 'foo bar'
         items[0].artist = 'one'
@@ -432,6 +434,203 @@ class DefaultSearchFieldsTest(DummyDataTestCase):
         self.assert_matched(items, [])
 
 
+class SplitClauseTest(DummyDataTestCase):
+    def test_fast_query_has_no_remainder(self):
+        q = beets.library.AndQuery.from_string(u'artist:one year:2001')
+        clause, subvals, rest = q.split_clause()
+        self.assertTrue(clause)
+        self.assertEqual(rest, None)
+
+    def test_slow_query_has_no_clause(self):
+        q = beets.library.AndQuery.from_string(u'flex::^foo')
+        clause, subvals, rest = q.split_clause()
+        self.assertEqual(clause, None)
+        self.assertTrue(rest is q)
+
+    def test_mixed_query_pushes_fast_part(self):
+        q = beets.library.AndQuery.from_string(u'artist:one flex::^foo')
+        clause, subvals, rest = q.split_clause()
+        self.assertTrue('artist' in clause)
+        self.assertTrue(isinstance(rest, beets.library.RegexpQuery))
+
+    def test_flexattr_query_uses_attribute_table(self):
+        q = beets.library.AndQuery.from_string(u'year:2001 flexattr:yes')
+        clause, subvals, rest = q.split_clause(beets.library.Item)
+        self.assertTrue('item_attributes' in clause)
+        self.assertEqual(rest, None)
+
+    def test_flexattr_query_matching_missing_attribute_is_slow(self):
+        q = beets.library.AndQuery.from_string(u'flexattr::^$')
+        clause, subvals, rest = q.split_clause(beets.library.Item)
+        self.assertEqual(clause, None)
+
+    def test_regexp_query_is_fast(self):
+        q = beets.library.AndQuery.from_string(u'artist:one title::^foo')
+        clause, subvals, rest = q.split_clause()
+        self.assertTrue('REGEXP' in clause)
+        self.assertEqual(rest, None)
+
+    def test_invalid_regexp_matches_nothing(self):
+        results = self.lib.items(u'title::(')
+        self.assert_matched(results, [])
+
+    def test_mixed_query_matches(self):
+        results = self.lib.items(u'artist:o title::^foo')
+        self.assert_matched(results, ['foo bar'])
+
+    def test_mixed_query_with_flexattr(self):
+        item = self.lib.items(u'beets').get()
+        item.flexattr = u'yes'
+        item.store()
+        results = self.lib.items(u'year:2000..2005 flexattr:yes')
+        self.assert_matched(results, ['beets 4 eva'])
+
+    def test_mixed_query_only_filters_fast_results(self):
+        for item in self.lib.items():
+            item.flexattr = u'yes' if item.title == u'baz qux' else u'no'
+            item.store()
+        # This pattern also matches a missing attribute, so it must be
+        # evaluated in Python.
+        results = self.lib.items(u'album:baz flexattr::^(yes)?$')
+        self.assertEqual(len(list(results.rows)), 2)
+        self.assert_matched(results, ['baz qux'])
+
+
+class ResultsTest(DummyDataTestCase):
+    # Items are sorted by album: "baz", "baz", "foo".
+    def test_len_fast_query(self):
+        self.assertEqual(len(self.lib.items(u'baz')), 2)
+
+    def test_len_slow_query(self):
+        self.assertEqual(len(self.lib.items(u'flex::.')), 0)
+
+    def test_index(self):
+        results = self.lib.items()
+        self.assertEqual(results[1].title, 'baz qux')
+
+    def test_negative_index(self):
+        results = self.lib.items()
+        self.assertEqual(results[-1].title, 'beets 4 eva')
+
+    def test_index_out_of_range(self):
+        results = self.lib.items()
+        self.assertRaises(IndexError, results.__getitem__, 3)
+
+    def test_slice(self):
+        results = self.lib.items()[1:3]
+        self.assert_matched(results, ['baz qux', 'beets 4 eva'])
+        self.assertEqual(len(results), 2)
+
+    def test_open_slice(self):
+        results = self.lib.items()[1:]
+        self.assert_matched(results, ['baz qux', 'beets 4 eva'])
+
+    def test_slice_of_slice(self):
+        results = self.lib.items()[1:][1:5]
+        self.assert_matched(results, ['beets 4 eva'])
+        self.assertEqual(len(results), 1)
+
+    def test_slice_uses_limit(self):
+        sql, subvals = self.lib.items()[1:2]._statement()
+        self.assertTrue('LIMIT' in sql)
+        self.assertEqual(subvals[-2:], [1, 1])
+
+    def test_slice_slow_query(self):
+        for item in self.lib.items():
+            item.flex = u'yes'
+            item.store()
+        results = self.lib.items(u'flex:yes')[1:2]
+        self.assert_matched(results, ['baz qux'])
+        self.assertEqual(len(results), 1)
+
+    def test_slice_past_end(self):
+        results = self.lib.items()[5:10]
+        self.assert_matched(results, [])
+        self.assertFalse(results)
+
+    def test_stream_matches_all(self):
+        results = self.lib.items(stream=True)
+        results.flex_batch_size = 2
+        self.assert_matched_all(results)
+
+    def test_stream_does_not_fetch_all_rows(self):
+        results = self.lib.items(stream=True)
+        list(results)
+        self.assertEqual(results._rows, None)
+
+    def test_get_first(self):
+        self.assertEqual(self.lib.items().get().title, 'foo bar')
+
+
+class FullTextTest(DummyDataTestCase):
+    fts = True
+
+    def test_bare_term_uses_index(self):
+        q = beets.library.get_query('baz', beets.library.Item, True)
+        self.assertTrue(isinstance(q.subqueries[0],
+                                   beets.library.FullTextQuery))
+        clause, subvals, slow = q.split_clause(beets.library.Item)
+        self.assertEqual(slow, None)
+        self.assert_matched(self.lib.items('baz'), ['foo bar', 'baz qux'])
+
+    def test_bare_term_matches_whole_words(self):
+        self.assert_matched(self.lib.items('ba'), [])
+        self.assert_matched(self.lib.items('BEETS'), ['beets 4 eva'])
+
+    def test_prefix_term(self):
+        self.assert_matched(self.lib.items('ba*'), ['foo bar', 'baz qux'])
+        self.assert_matched(self.lib.items('ev*'), ['beets 4 eva'])
+
+    def test_term_without_words_uses_substring_match(self):
+        q = beets.library.get_query('-', beets.library.Item, True)
+        self.assertTrue(isinstance(q.subqueries[0],
+                                   beets.library.AnyFieldQuery))
+
+    def test_index_follows_store(self):
+        item = self.lib.items('eva').get()
+        item.title = 'xyzzy'
+        item.store()
+        self.assert_matched(self.lib.items('eva'), [])
+        self.assert_matched(self.lib.items('xyzzy'), ['xyzzy'])
+
+    def test_index_follows_add_and_remove(self):
+        item = _common.item()
+        item.title = 'plugh'
+        self.lib.add(item)
+        self.assert_matched(self.lib.items('plugh'), ['plugh'])
+        item.remove()
+        self.assert_matched(self.lib.items('plugh'), [])
+
+    def test_album_index(self):
+        results = self.lib.albums('baz')
+        self.assertEqual([a.album for a in results], ['baz'])
+
+    def test_match_agrees_with_index(self):
+        for pattern, prefix in (('baz', False), ('ba', True),
+                                ('beets 4', False), ('4 ev', True)):
+            q = beets.library.FullTextQuery(
+                pattern, beets.library.ITEM_DEFAULT_FIELDS,
+                beets.library.Item._fts_table, prefix
+            )
+            matched = [i.title for i in self.lib.items() if q.match(i)]
+            self.assert_matched(self.lib.items(q), matched)
+
+    def test_asterisk_without_index_is_literal(self):
+        lib = beets.library.Library(':memory:')
+        for title in ('foo bar', 'foo ba*'):
+            item = _common.item()
+            item.title = title
+            lib.add(item)
+        self.assert_matched(lib.items('ba*'), ['foo ba*'])
+
+    def test_disabling_drops_index(self):
+        self.lib._make_fts(beets.library.Item, False)
+        with self.lib.transaction() as tx:
+            rows = tx.query("SELECT name FROM sqlite_master "
+                            "WHERE name LIKE 'items_fts%'")
+        self.assertEqual(list(rows), [])
+
+
 class StringParseTest(_common.TestCase):
     def test_single_field_query(self):
         q = beets.library.AndQuery.from_string(u'albumtype:soundtrack')
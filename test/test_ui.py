@@ -112,6 +112,22 @@ class ListTest(_common.TestCase):
         self.assertTrue(u'the genre' in out)
         self.assertTrue(u'the album' not in out)
 
+    def test_list_output_written_in_chunks(self):
+        for i in range(4):
+            item = _common.item()
+            item.title = u'title %i' % i
+            self.lib.add(item)
+        old_size = ui.PRINT_BUFFER_SIZE
+        ui.PRINT_BUFFER_SIZE = 10
+        try:
+            self._run_list(fmt='$title')
+        finally:
+            ui.PRINT_BUFFER_SIZE = old_size
+        out = self.io.getoutput()
+        self.assertEqual(out.split('\n'), [
+            'the title', 'title 0', 'title 1', 'title 2', 'title 3', '',
+        ])
+
 class RemoveTest(_common.TestCase):
     def setUp(self):
         super(RemoveTest, self).setUp()